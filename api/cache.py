@@ -0,0 +1,96 @@
+import time
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    A bounded, thread-safe, in-memory cache that evicts the least recently
+    used entries once it holds more than +max_size+ entries. Entries can
+    optionally expire +ttl+ seconds after they were set.
+
+    The cache keeps hit and miss counters, see +stats+.
+    """
+    def __init__(self, max_size=1000, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = threading.RLock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value, expires = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if expires is not None and expires < time.time():
+                self.misses += 1
+                return default
+
+            # re-insert to mark it as most recently used
+            self.entries[key] = (value, expires)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        expires = time.time() + self.ttl if self.ttl else None
+
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, expires)
+
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def __contains__(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            return entry is not None and (entry[1] is None or entry[1] >= time.time())
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def dump(self):
+        """ The unexpired entries, least recently used first, as a list
+        of [key, value, expiry time] lists, eg. to be saved with JSON.
+        """
+        now = time.time()
+        with self.lock:
+            return [[key, value, expires] for key, (value, expires) in self.entries.iteritems()
+                    if expires is None or expires >= now]
+
+    def load(self, entries):
+        """ Add +entries+ as returned by +dump+, skipping any that have
+        since expired.
+        """
+        now = time.time()
+        with self.lock:
+            for key, value, expires in entries:
+                if expires is None or expires >= now:
+                    self.entries.pop(key, None)
+                    self.entries[key] = (value, expires)
+
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
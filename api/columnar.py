@@ -0,0 +1,111 @@
+import json
+import struct
+
+
+'''
+A compact, columnar layout for data API responses.
+
+The default layout of `/data/show` repeats every column id for every
+geography and always includes an error for each value, even though the
+errors for census data are always zero:
+
+    {'ward-1': {'POPULATION': {'estimate': {'total': 10}, 'error': {'total': 0}}}}
+
+In the columnar layout, the geographies are listed once, each table lists its
+column ids once, and the values of each column are an array aligned with the
+geographies. Errors are left out for tables where they're all zero.
+
+    {
+      'geo_ids': ['ward-1', 'ward-2'],
+      'data': {
+        'POPULATION': {
+          'columns': ['total'],
+          'estimate': [[10, 20]],
+        }
+      }
+    }
+
+Missing values are null.
+
+There's also a binary version, for clients that want typed arrays:
+
+    magic 'WZCD', format version (uint16), padding (uint16),
+    header length (uint32), padding (uint32),
+    header: the JSON columnar response, with each table's 'estimate'
+            replaced by the number of columns and 'error' by true
+            if errors follow, padded with spaces to a multiple of 8 bytes
+    arrays: for each table in the order of 'table_ids', the estimates for
+            each column and then the errors for each column (if any), each as:
+            number of values (uint32), padding (uint32), values (float64)
+
+All numbers are little-endian and missing values are NaN. Every array starts
+on an 8-byte boundary, so it can be read with a `Float64Array` without copying.
+'''
+
+MAGIC = 'WZCD'
+FORMAT_VERSION = 1
+
+BINARY_HEADER = struct.Struct('<4sHHII')
+ARRAY_HEADER = struct.Struct('<II')
+
+
+def columnar_data(tables, geo_ids, data):
+    """
+    Arrange +data+, as returned by `get_raw_data`, into columns for
+    each of +tables+, aligned with +geo_ids+.
+    """
+    columnar = {}
+
+    for table in tables:
+        table_id = table.id.upper()
+        columns = list(table.columns.iterkeys())
+        table_data = [data.get(geo_id, {}).get(table_id, {}) for geo_id in geo_ids]
+
+        estimates = [[d.get('estimate', {}).get(col) for d in table_data] for col in columns]
+        errors = [[d.get('error', {}).get(col) for d in table_data] for col in columns]
+
+        columnar[table_id] = {
+            'columns': columns,
+            'estimate': estimates,
+        }
+        if any(e for col in errors for e in col):
+            columnar[table_id]['error'] = errors
+
+    return columnar
+
+
+def pack_columnar(response, table_ids):
+    """
+    Pack a columnar +response+, with columnar data from `columnar_data` in
+    +response['data']+, into the binary layout. +table_ids+ gives the
+    order in which the tables' arrays are written.
+    """
+    header = dict(response)
+    header['table_ids'] = table_ids
+    header['data'] = {}
+
+    arrays = []
+    for table_id in table_ids:
+        table_data = response['data'][table_id]
+        has_errors = 'error' in table_data
+
+        header['data'][table_id] = {
+            'columns': table_data['columns'],
+            'estimate': len(table_data['estimate']),
+            'error': has_errors,
+        }
+
+        arrays.extend(table_data['estimate'])
+        if has_errors:
+            arrays.extend(table_data['error'])
+
+    header = json.dumps(header, separators=(',', ':'))
+    header += ' ' * (-len(header) % 8)
+
+    chunks = [BINARY_HEADER.pack(MAGIC, FORMAT_VERSION, 0, len(header), 0), header]
+    for values in arrays:
+        values = [float('nan') if v is None else v for v in values]
+        chunks.append(ARRAY_HEADER.pack(len(values), 0))
+        chunks.append(struct.pack('<%dd' % len(values), *values))
+
+    return ''.join(chunks)
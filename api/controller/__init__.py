@@ -1,7 +1,10 @@
 from .census import get_census_profile
 from .crime import get_crime_profile
+from .data import get_raw_data
 from .elections import get_elections_profile
-from .geography import get_geography, get_locations, get_locations_from_coords
+from .geography import (get_geography, get_locations, get_locations_from_coords, get_locations_batch,
+                        split_geography)
 
 __all__ = ['get_census_profile', 'get_elections_profile', 'get_geography',
-           'get_locations', 'get_locations_from_coords', 'get_crime_profile']
+           'get_locations', 'get_locations_from_coords', 'get_locations_batch',
+           'get_crime_profile', 'split_geography', 'get_raw_data']
@@ -1,14 +1,13 @@
 from collections import OrderedDict
 
-from sqlalchemy import func
-
 from api.models import get_model_from_fields
 from api.models.tables import get_datatable, get_table_id
 from api.utils import get_session, add_metadata
 from api.controller.geography import get_geography
 
 from .utils import (collapse_categories, calculate_median, calculate_median_stat, get_summary_geo_info,
-                    merge_dicts, group_remainder, get_stat_data, get_objects_by_geo, percent)
+                    merge_dicts, group_remainder, get_stat_data, get_stat_result, get_objects_by_geo, percent,
+                    memoize_section, build_profile_sections)
 
 
 PROFILE_SECTIONS = (
@@ -279,40 +278,37 @@ def get_census_profile(geo_code, geo_level):
 
     try:
         geo_summary_levels = get_summary_geo_info(geo_code, geo_level, session)
-        data = {}
-
-        sections = list(PROFILE_SECTIONS)
-        if geo_level in ['country', 'province']:
-            sections.append('crime')
-
-        for section in sections:
-            function_name = 'get_%s_profile' % section
-            if function_name in globals():
-                func = globals()[function_name]
-                data[section] = func(geo_code, geo_level, session)
-
-                # get profiles for province and/or country
-                for level, code in geo_summary_levels:
-                    # merge summary profile into current geo profile
-                    merge_dicts(data[section], func(code, level, session), level)
-
-        # tweaks to make the data nicer
-        # show 3 largest groups on their own and group the rest as 'Other'
-        group_remainder(data['service_delivery']['water_source_distribution'], 5)
-        group_remainder(data['service_delivery']['refuse_disposal_distribution'], 5)
-        group_remainder(data['service_delivery']['toilet_facilities_distribution'], 5)
-        group_remainder(data['demographics']['language_distribution'], 7)
-        group_remainder(data['demographics']['province_of_birth_distribution'], 7)
-        group_remainder(data['demographics']['region_of_birth_distribution'], 5)
-        group_remainder(data['households']['type_of_dwelling_distribution'], 5)
-        group_remainder(data['child_households']['type_of_dwelling_distribution'], 5)
-        
-        return data
-
     finally:
         session.close()
 
+    sections = list(PROFILE_SECTIONS)
+    if geo_level in ['country', 'province']:
+        sections.append('crime')
+
+    section_funcs = []
+    for section in sections:
+        function_name = 'get_%s_profile' % section
+        if function_name in globals():
+            section_funcs.append((section, globals()[function_name], ()))
+
+    # build this geo and the province and/or country, and merge them
+    data = dict(build_profile_sections(section_funcs, geo_code, geo_level, geo_summary_levels))
+
+    # tweaks to make the data nicer
+    # show 3 largest groups on their own and group the rest as 'Other'
+    group_remainder(data['service_delivery']['water_source_distribution'], 5)
+    group_remainder(data['service_delivery']['refuse_disposal_distribution'], 5)
+    group_remainder(data['service_delivery']['toilet_facilities_distribution'], 5)
+    group_remainder(data['demographics']['language_distribution'], 7)
+    group_remainder(data['demographics']['province_of_birth_distribution'], 7)
+    group_remainder(data['demographics']['region_of_birth_distribution'], 5)
+    group_remainder(data['households']['type_of_dwelling_distribution'], 5)
+    group_remainder(data['child_households']['type_of_dwelling_distribution'], 5)
+
+    return data
+
 
+@memoize_section
 def get_demographics_profile(geo_code, geo_level, session):
     # population group
     pop_dist_data, total_pop = get_stat_data(
@@ -335,11 +331,8 @@ def get_demographics_profile(geo_code, geo_level, session):
 
     # sex
     db_model_sex = get_model_from_fields(['gender'], geo_level, table_name='gender_%s' % geo_level)
-    query = session.query(func.sum(db_model_sex.total)) \
-                   .filter(db_model_sex.gender == 'Male')
-    geo_attr = '%s_code' % geo_level
-    query = query.filter(getattr(db_model_sex, geo_attr) == geo_code)
-    total_male = query.one()[0]
+    objects = get_objects_by_geo(db_model_sex, geo_code, geo_level, session)
+    total_male = sum(o.total for o in objects if o.gender == 'Male')
 
     sex_data = OrderedDict((  # census data refers to sex as gender
             ('Female', {
@@ -447,6 +440,7 @@ def get_demographics_profile(geo_code, geo_level, session):
     return final_data
 
 
+@memoize_section
 def get_households_profile(geo_code, geo_level, session):
     # head of household
     # gender
@@ -536,6 +530,7 @@ def get_households_profile(geo_code, geo_level, session):
            }
 
 
+@memoize_section
 def get_economics_profile(geo_code, geo_level, session):
     # income
     income_dist_data, total_workers = get_stat_data(
@@ -562,11 +557,11 @@ def get_economics_profile(geo_code, geo_level, session):
             order_by='type of sector')
 
     # access to internet
-    internet_access_dist, total_with_access = get_stat_data(
-            ['access to internet'], geo_level, geo_code, session, exclude=['No access to internet'],
-            order_by='access to internet')
-    _, total_without_access = get_stat_data(
-            ['access to internet'], geo_level, geo_code, session, only=['No access to internet'])
+    internet_access = get_stat_result(['access to internet'], geo_level, geo_code, session)
+    internet_access_dist, total_with_access = internet_access.get_stat_data(
+            exclude=['No access to internet'], order_by='access to internet')
+    _, total_without_access = internet_access.get_stat_data(
+            only=['No access to internet'])
     total_households = total_with_access + total_without_access
 
     return {'individual_income_distribution': income_dist_data,
@@ -585,6 +580,7 @@ def get_economics_profile(geo_code, geo_level, session):
             }
 
 
+@memoize_section
 def get_service_delivery_profile(geo_code, geo_level, session):
     # water source
     water_src_data, total_wsrc = get_stat_data(
@@ -708,6 +704,7 @@ def get_service_delivery_profile(geo_code, geo_level, session):
     }
 
 
+@memoize_section
 def get_education_profile(geo_code, geo_level, session):
     db_model = get_model_from_fields(['highest educational level 20 and older'], geo_level)
     objects = get_objects_by_geo(db_model, geo_code, geo_level, session)
@@ -757,6 +754,7 @@ def get_education_profile(geo_code, geo_level, session):
             'educational_attainment': edu_split_data}
 
 
+@memoize_section
 def get_children_profile(geo_code, geo_level, session):
     # age
     child_adult_dist, _ = get_stat_data(
@@ -870,6 +868,7 @@ def get_children_profile(geo_code, geo_level, session):
     }
 
 
+@memoize_section
 def get_child_households_profile(geo_code, geo_level, session):
     # head of household
     # gender
@@ -932,6 +931,7 @@ def get_child_households_profile(geo_code, geo_level, session):
     }
 
 
+@memoize_section
 def get_crime_profile(geo_code, geo_level, session):
     child_crime, total = get_stat_data(
         ['crime'], geo_level, geo_code, session,
@@ -6,8 +6,8 @@ from api.models import get_model_from_fields
 from api.utils import get_session, LocationNotFound
 
 from .utils import (collapse_categories, calculate_median, calculate_median_stat, get_summary_geo_info,
-                    merge_dicts, group_remainder, add_metadata, get_stat_data, get_objects_by_geo, percent,
-                    create_debug_dump)
+                    merge_dicts, group_remainder, add_metadata, get_stat_data, get_stat_result, get_objects_by_geo, percent,
+                    create_debug_dump, memoize_section, build_profile_sections)
 
 
 def get_crime_profile(geo_code, geo_level):
@@ -15,19 +15,13 @@ def get_crime_profile(geo_code, geo_level):
 
     try:
         geo_summary_levels = get_summary_geo_info(geo_code, geo_level, session)
-        data = {}
-        data['crime'] = get_crime_breakdown_profile(geo_code, geo_level, session)
-
-        # get profiles for province and/or country
-        for level, code in geo_summary_levels:
-            # merge summary profile into current geo profile
-            merge_dicts(data['crime'], get_crime_breakdown_profile(code, level, session), level)
-
-        return data
-
     finally:
         session.close()
 
+    # get profiles for this geo and province and/or country, merged
+    sections = [('crime', get_crime_breakdown_profile, ())]
+    return dict(build_profile_sections(sections, geo_code, geo_level, geo_summary_levels))
+
 
 CRIME_CLASSES = {
     'contact': [
@@ -74,15 +68,16 @@ CRIME_CLASSES = {
 }
 
 
+@memoize_section
 def get_crime_breakdown_profile(geo_code, geo_level, session):
-    crime_distribution, _ = get_stat_data(
-            ['crime'], geo_level, geo_code, session,
+    crime = get_stat_result(['crime'], geo_level, geo_code, session)
+
+    crime_distribution, _ = crime.get_stat_data(
             percent=False, exclude_zero=True, order_by='-total')
 
     classes = {}
     for name, crimes in CRIME_CLASSES.iteritems():
-        classes[name], _ = get_stat_data(
-            ['crime'], geo_level, geo_code, session,
+        classes[name], _ = crime.get_stat_data(
             only=crimes,
             percent=False, exclude_zero=True, order_by='-total')
 
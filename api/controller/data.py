@@ -0,0 +1,44 @@
+from api.executor import run_concurrently
+from api.models.tables import geo_codes_by_level
+from api.utils import get_session
+
+
+def get_raw_data(tables, geos):
+    """
+    Get the raw data for each of +tables+ for each of +geos+, as used by
+    the data API.
+
+    Rather than going table by table, this plans all the queries needed
+    for every table up front: one per underlying table model, covering all
+    the geographies at once. The queries are independent, so they're run
+    concurrently where possible (see `api.executor`); otherwise they're run
+    one after the other on the same session.
+
+    :return: dict from geo id to table id to table data,
+             eg. {'province-WC': {'POPULATION': {'estimate': ..., 'error': ...}}}
+    """
+    geo_codes = geo_codes_by_level(geos)
+
+    queries = []
+    for table in tables:
+        for part in table.raw_data_queries(geo_codes):
+            queries.append((table, part))
+
+    def make_task(table, part):
+        def task():
+            session = get_session()
+            try:
+                return table.query_raw_data(session, part)
+            finally:
+                session.close()
+        return task
+
+    results = run_concurrently([make_task(table, part) for table, part in queries])
+
+    data = {}
+    for (table, part), rows in zip(queries, results):
+        table_id = table.id.upper()
+        for geo_id, table_data in table.build_raw_data(part, rows).iteritems():
+            data.setdefault(geo_id, {})[table_id] = table_data
+
+    return data
@@ -3,7 +3,8 @@ from collections import OrderedDict
 from api.utils import get_session
 from api.models.tables import get_datatable
 
-from .utils import get_summary_geo_info, get_stat_data, merge_dicts, group_remainder
+from .utils import (get_summary_geo_info, get_stat_data, group_remainder, memoize_section,
+                    build_profile_sections)
 
 
 ELECTIONS = [
@@ -52,32 +53,29 @@ def make_party_acronym(name):
 
 
 def get_elections_profile(geo_code, geo_level):
-    data = OrderedDict()
     session = get_session()
     try:
         geo_summary_levels = get_summary_geo_info(geo_code, geo_level, session)
+    finally:
+        session.close()
 
-        for election in ELECTIONS:
-            section = election['name'].lower().replace(' ', '_')
-            data[section] = get_election_data(geo_code, geo_level, election, session)
-
-            # get profiles for province and/or country
-            for level, code in geo_summary_levels:
-                # merge summary profile into current geo profile
-                merge_dicts(data[section], get_election_data(code, level, election, session), level)
+    # get profiles for this geo and province and/or country, merged
+    sections = [(election['name'].lower().replace(' ', '_'), get_election_data, (election, ))
+                for election in ELECTIONS]
+    data = build_profile_sections(sections, geo_code, geo_level, geo_summary_levels)
 
-            # tweaks to make the data nicer
-            # show 8 largest parties on their own and group the rest as 'Other'
-            group_remainder(data[section]['party_distribution'], 9)
+    for section in data.iterkeys():
+        # tweaks to make the data nicer
+        # show 8 largest parties on their own and group the rest as 'Other'
+        group_remainder(data[section]['party_distribution'], 9)
 
-        if geo_level == 'country':
-            add_elections_media_coverage(data)
+    if geo_level == 'country':
+        add_elections_media_coverage(data)
 
-        return data
-    finally:
-        session.close()
+    return data
 
 
+@memoize_section
 def get_election_data(geo_code, geo_level, election, session):
     party_data, total_valid_votes = get_stat_data(
         ['party'], geo_level, geo_code, session,
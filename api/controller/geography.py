@@ -3,32 +3,57 @@ from sqlalchemy.sql.expression import or_
 from sqlalchemy import func
 
 from api.models import Ward, District, Municipality, Province, Subplace, Country, geo_levels, get_geo_model
-from api.utils import get_session, ward_search_api, LocationNotFound
+from api.cache import LRUCache
+from api.config import GEO_SPLIT_CACHE_SIZE, PLACE_SEARCH_BACKEND, BATCH_LOCATE_CONCURRENCY
+from api.executor import run_concurrently
+from api.utils import get_session, ward_search_api, LocationNotFound, WardSearchException
+from api.geo_index import get_geo_index
+from api.search_index import get_place_search_index
+from api.search_db import search_locations_postgres
+from api.ward_locator import get_ward_locator
+
+import logging
+log = logging.getLogger('censusreporter')
+
+
+# geographies split into their descendants, see split_geography
+_split_cache = LRUCache(max_size=GEO_SPLIT_CACHE_SIZE)
 
 
 def get_geography(geo_code, geo_level):
     """
-    Get a geography model (Ward, Province, etc.) for this geography, or
+    Get the geography record (see `api.geo_index`) for this geography, or
     raise LocationNotFound if it doesn't exist.
     """
-    session = get_session()
+    if geo_level not in geo_levels:
+        raise LocationNotFound('Invalid level: %s' % geo_level)
 
-    try:
-        try:
-            model = get_geo_model(geo_level)
-        except KeyError:
-            raise LocationNotFound('Invalid level: %s' % geo_level)
+    geo = get_geo_index().get(geo_level, geo_code)
+    if not geo:
+        raise LocationNotFound('Invalid level and code: %s-%s' % (geo_level, geo_code))
 
-        geo = session.query(model).get(geo_code)
-        if not geo:
-            raise LocationNotFound('Invalid level and code: %s-%s' % (geo_level, geo_code))
+    return geo
 
-        return geo
-    finally:
-        session.close()
+
+def split_geography(geo, level):
+    """
+    Split +geo+ into its descendants at +level+, as `GeoRecord.split_into`
+    does. The data API asks for the same few expansions over and over (eg.
+    all the wards in a province), so they're cached.
+    """
+    key = '%s|%s' % (level, geo.full_geoid)
+    geos = _split_cache.get(key)
+    if geos is None:
+        geos = geo.split_into(level)
+        _split_cache.set(key, geos)
+    return list(geos)
 
 
 def get_locations(search_term, levels=None, year='2011'):
+    """
+    Search for places matching +search_term+ at the comma-separated +levels+,
+    using the `PLACE_SEARCH_BACKEND`.
+    """
     if levels:
         levels = levels.split(',')
         for level in levels:
@@ -37,6 +62,18 @@ def get_locations(search_term, levels=None, year='2011'):
     else:
         levels = ['country', 'province', 'municipality', 'ward', 'subplace']
 
+    if PLACE_SEARCH_BACKEND == 'memory':
+        objects = get_place_search_index().search(search_term, levels, year)
+    elif PLACE_SEARCH_BACKEND == 'postgres':
+        objects = search_locations_postgres(search_term, levels, year)
+    else:
+        objects = search_locations_db(search_term, levels, year)
+
+    return serialize_demarcations(objects)
+
+
+def search_locations_db(search_term, levels, year):
+    """ Search for places with a query at each level. """
     search_term = search_term.strip()
     session = get_session()
     try:
@@ -88,43 +125,141 @@ def get_locations(search_term, levels=None, year='2011'):
         order_map = {Country: 4, Ward: 3, Municipality: 2, Province: 1}
         objects = sorted(objects, key=lambda o: [order_map[o.__class__], getattr(o, 'name', getattr(o, 'code'))])
 
-        return serialize_demarcations(objects[0:10])
+        return objects[0:10]
     finally:
         session.close()
 
 
 def get_locations_from_coords(longitude, latitude):
     '''
-    Calls the Wards API to get a single ward containing the coordinates.
-    Returns the serialized ward, municipality and province.
+    Finds the single ward containing the coordinates, with the local
+    ward boundaries if we have them and they have a ward for it, otherwise
+    with the Wards API. Returns the serialized ward, municipality and province.
     '''
-    location = ward_search_api.search("%s,%s" % (latitude, longitude))
-    if len(location) == 0:
-        return []
-    # there should only be 1 ward since wards don't overlap
-    location = location[0]
+    locator = get_ward_locator()
+    ward_code = None
+    if locator is not None:
+        try:
+            ward_code = locator.locate(float(longitude), float(latitude))
+        except ValueError:
+            return []
 
-    session = get_session()
-    try:
-        ward = session.query(Ward).get(location.ward_code)
-        if ward is None:
+    if ward_code is None:
+        location = ward_search_api.search("%s,%s" % (latitude, longitude))
+        if len(location) == 0:
             return []
+        # there should only be 1 ward since wards don't overlap
+        ward_code = location[0].ward_code
 
-        # this is the reverse order of a normal search - the
-        # narrowest location match comes first.
-        objects = [ward, ward.municipality, ward.province, ward.country]
-        objects = filter(lambda o: bool(o), objects)  # remove None
+    return ward_demarcations(ward_code)
 
-        return serialize_demarcations(objects)
 
-    finally:
-        session.close()
+def ward_demarcations(ward_code):
+    """ The serialized ward, municipality and province for +ward_code+,
+    narrowest first, from the geography index.
+    """
+    ward = get_geo_index().get('ward', ward_code)
+    if ward is None:
+        return []
+
+    # this is the reverse order of a normal search - the
+    # narrowest location match comes first.
+    objects = [ward, ward.municipality, ward.province, ward.country]
+    objects = filter(lambda o: bool(o), objects)  # remove None
+
+    return serialize_demarcations(objects)
+
+
+def get_locations_batch(items):
+    '''
+    Finds the wards for many places at once. Each of +items+ is a dict with
+    either an 'address', or 'lat' and 'lon' coordinates.
+
+    Points are located with the local ward boundaries if we have them.
+    Addresses, and points that they don't place in a ward, are looked up
+    with the Wards API, each distinct one once, several at a time. The wards
+    and their parents all come from the geography index.
+
+    Returns a list with a result for each item, in the same order: a dict
+    with the item's 'places' (as from `get_locations_from_coords`), or an
+    'error' message.
+    '''
+    locator = get_ward_locator()
+    # the ward code, or an error, for each item
+    found = [None] * len(items)
+    # search terms for the Wards API, and the items waiting on each
+    searches = {}
+
+    for i, item in enumerate(items):
+        if not isinstance(item, dict):
+            found[i] = LocationNotFound('Expected an address, or lat and lon')
+            continue
+
+        if item.get('address'):
+            term = unicode(item['address']).strip()
+        else:
+            try:
+                latitude, longitude = float(item['lat']), float(item['lon'])
+            except (KeyError, TypeError, ValueError):
+                found[i] = LocationNotFound('Expected an address, or lat and lon')
+                continue
+
+            if locator is not None:
+                found[i] = locator.locate(longitude, latitude)
+                if found[i] is not None:
+                    continue
+            # not in any of our wards, eg. near a boundary
+            term = "%s,%s" % (latitude, longitude)
+
+        searches.setdefault(term, []).append(i)
+
+    def search(term):
+        try:
+            location = ward_search_api.search(term)
+        except WardSearchException as e:
+            return e
+        except Exception as e:
+            # eg. a response we can't parse, which only fails this item
+            log.error("Error searching for %r in a batch: %s" % (term, e), exc_info=True)
+            return WardSearchException('Search failed')
+        # there should only be 1 ward for a point, since wards don't
+        # overlap. For an address, use the best match.
+        return location[0].ward_code if location else None
+
+    terms = searches.keys()
+    tasks = [lambda term=term: search(term) for term in terms]
+    for term, ward_code in zip(terms, run_concurrently(tasks, concurrency=BATCH_LOCATE_CONCURRENCY)):
+        for i in searches[term]:
+            found[i] = ward_code
+
+    results = []
+    for ward_code in found:
+        if isinstance(ward_code, Exception):
+            results.append({'error': str(ward_code)})
+            continue
+
+        places = ward_demarcations(ward_code) if ward_code else []
+        if places:
+            results.append({'places': places})
+        else:
+            results.append({'error': 'Location not found'})
+
+    return results
 
 
 def serialize_demarcations(objects):
-    return [{
-            'full_name': obj.long_name,
-            'full_geoid': '%s-%s' % (obj.level, obj.code),
-            'geo_level': obj.level,
-            'geo_code': obj.code,
-            } for obj in objects]
+    index = get_geo_index()
+    results = []
+
+    for obj in objects:
+        # use the index's precomputed names rather than walking
+        # the ORM relationships
+        geo = index.get(obj.level, obj.code) or obj
+        results.append({
+            'full_name': geo.long_name,
+            'full_geoid': geo.full_geoid,
+            'geo_level': geo.level,
+            'geo_code': geo.code,
+        })
+
+    return results
@@ -0,0 +1,217 @@
+import threading
+from collections import OrderedDict
+
+from sqlalchemy import func, literal, select, union_all, and_
+
+
+'''
+Batched fetching of statistics for profiles.
+
+A profile page is built for a geography and again for each of its summary
+geographies (its province and the country), and each profile section asks for
+many data tables. Asking the database for every (table, geography) pair
+separately means hundreds of round trips for a single ward page.
+
+A `QueryPlanner` is attached to a session and knows which geographies a profile
+is going to be built for. The first time any of those geographies asks for
+rows from a data table, the planner fetches the rows for *all* of the planned
+geographies in one UNION ALL query, across the per-level tables. Subsequent
+requests for that data table are served from memory, grouped and ordered as
+`get_objects_by_geo` would have done in SQL.
+
+A planner can be shared by sessions running concurrently on different
+threads or greenlets. Only one of them fetches a data table, the others
+wait for its results.
+'''
+
+
+# the key a planner is stored under in `session.info`
+PLANNER_KEY = 'query_planner'
+
+
+class StatRow(object):
+    """ A row of summed statistics that behaves like a SQLAlchemy result row:
+    field values are available as attributes and the sum is in +total+.
+
+    Rows also remember the rank of each field's value, as ordered by the
+    database, so that they can be sorted in memory in exactly the same
+    order as an ORDER BY on that field.
+    """
+    __slots__ = ('total', 'values', 'ranks')
+
+    def __init__(self, total, values, ranks):
+        self.total = total
+        self.values = values
+        self.ranks = ranks
+
+    def __getattr__(self, attr):
+        try:
+            return self.values[attr]
+        except KeyError:
+            raise AttributeError(attr)
+
+    def __repr__(self):
+        return 'StatRow(total=%s, %s)' % (self.total, self.values)
+
+
+def group_rows(rows, fields):
+    """ Sum +rows+ over the values of +fields+, like a GROUP BY on those fields.
+    """
+    groups = OrderedDict()
+
+    for row in rows:
+        key = tuple(row.values[f] for f in fields)
+        group = groups.get(key)
+        if group is None:
+            groups[key] = StatRow(row.total,
+                                  dict((f, row.values[f]) for f in fields),
+                                  dict((f, row.ranks[f]) for f in fields))
+        else:
+            group.total += row.total
+
+    return groups.values()
+
+
+def sort_rows(rows, fields, order_by=None):
+    """ Sort +rows+ in memory, with the same semantics as the +order_by+
+    argument of `get_objects_by_geo`. Rows are always ordered by +fields+
+    first, so that ties are broken consistently.
+    """
+    rows = sorted(rows, key=lambda r: [r.ranks[f] for f in fields])
+
+    if order_by is not None:
+        attr = order_by
+        is_desc = False
+        if order_by[0] == '-':
+            is_desc = True
+            attr = attr[1:]
+
+        if attr == 'total':
+            rows.sort(key=lambda r: r.total, reverse=is_desc)
+        else:
+            rows.sort(key=lambda r: r.ranks[attr], reverse=is_desc)
+
+    return rows
+
+
+class QueryPlanner(object):
+    """
+    Fetches the rows of a data table for a fixed set of geographies at once.
+
+    :param list geos: list of (geo_level, geo_code) tuples that will be queried
+    """
+    def __init__(self, geos):
+        self.geos = list(geos)
+        self.geo_set = set(self.geos)
+        # map from data table id to a dict from (geo_level, geo_code) to rows
+        self.rows = {}
+        self.query_count = 0
+        # data table ids currently being fetched, mapped to an event that
+        # is set once they're done
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def covers(self, geo_level, geo_code):
+        return (geo_level, geo_code) in self.geo_set
+
+    def get_objects(self, db_model, geo_level, geo_code, session, fields, order_by=None):
+        """ Get rows for a geography from the model's data table, summed over
+        +fields+ and sorted by +order_by+, just like `get_objects_by_geo`.
+        """
+        rows = self.get_rows(db_model.data_table, session).get((geo_level, geo_code), [])
+        return sort_rows(group_rows(rows, fields), fields, order_by)
+
+    def get_rows(self, data_table, session):
+        while True:
+            with self.lock:
+                if data_table.id in self.rows:
+                    return self.rows[data_table.id]
+
+                event = self.pending.get(data_table.id)
+                if event is None:
+                    # we're going to fetch it
+                    event = self.pending[data_table.id] = threading.Event()
+                    break
+
+            # someone else is fetching it, wait for them. If they fail,
+            # we'll try ourselves.
+            event.wait()
+
+        try:
+            rows = self.fetch(data_table, session)
+            with self.lock:
+                self.rows[data_table.id] = rows
+            return rows
+        finally:
+            with self.lock:
+                del self.pending[data_table.id]
+            event.set()
+
+    def fetch(self, data_table, session):
+        """ Fetch all the rows of +data_table+ for our geographies, with
+        one query.
+        """
+        fields = data_table.fields
+
+        codes_by_level = OrderedDict()
+        for geo_level, geo_code in self.geos:
+            codes_by_level.setdefault(geo_level, []).append(geo_code)
+
+        selects = []
+        for geo_level, geo_codes in codes_by_level.iteritems():
+            if data_table.table_per_level:
+                if geo_level not in data_table.models:
+                    # this table doesn't exist at this level
+                    continue
+                table = data_table.get_model(geo_level).__table__
+                code_col = table.c['%s_code' % geo_level]
+                where = code_col.in_(geo_codes)
+            else:
+                table = data_table.model.__table__
+                code_col = table.c.geo_code
+                where = and_(table.c.geo_level == geo_level, code_col.in_(geo_codes))
+
+            selects.append(
+                select([literal(geo_level).label('geo_level'),
+                        code_col.label('geo_code'),
+                        table.c.total.label('total')] +
+                       [table.c[f] for f in fields])
+                .where(where))
+
+        if not selects:
+            return {}
+
+        if len(selects) == 1:
+            planned = selects[0].alias('planned')
+        else:
+            planned = union_all(*selects).alias('planned')
+
+        # rank the values of each field as postgres orders them, so that we
+        # can sort in memory exactly as an ORDER BY would
+        ranks = [func.dense_rank().over(order_by=planned.c[f]).label('rank_%d' % i)
+                 for i, f in enumerate(fields)]
+        query = select([planned.c.geo_level, planned.c.geo_code, planned.c.total] +
+                       [planned.c[f] for f in fields] +
+                       ranks)
+
+        self.query_count += 1
+        rows = {}
+        for row in session.execute(query):
+            values = dict((f, row[planned.c[f]]) for f in fields)
+            row_ranks = dict((f, row['rank_%d' % i]) for i, f in enumerate(fields))
+            rows.setdefault((row.geo_level, row.geo_code), [])\
+                .append(StatRow(row.total, values, row_ranks))
+
+        return rows
+
+
+def use_planner(session, planner):
+    session.info[PLANNER_KEY] = planner
+
+
+def unplan_profile_queries(session):
+    session.info.pop(PLANNER_KEY, None)
+
+
+def get_planner(session):
+    return session.info.get(PLANNER_KEY)
@@ -1,18 +1,85 @@
 from collections import OrderedDict
+from copy import deepcopy
+from functools import wraps
 
 from sqlalchemy import func
-from sqlalchemy.orm import class_mapper
+from sqlalchemy.orm import class_mapper, Session
 
 
+from api.cache import LRUCache
+from api.config import (PROFILE_SECTION_CACHE_LEVELS, PROFILE_SECTION_CACHE_SIZE,
+                        PROFILE_SECTION_CACHE_TTL)
 from api.controller.geography import LocationNotFound
-from api.models import Ward, Municipality, District, Province
+from api.geo_index import get_geo_index
 from api.models import get_model_from_fields
-from api.utils import capitalize, percent, add_metadata
+from api.executor import run_concurrently
+from api.utils import (capitalize, percent, add_metadata, get_data_version, get_session,
+                       on_data_version_change)
+
+from .planner import (get_planner, QueryPlanner, StatRow, sort_rows, use_planner,
+                      unplan_profile_queries)
 
 
 # dictionaries that merge_dicts will merge
 MERGE_KEYS = set(['values', 'numerators'])
 
+# cache of profile sections for the summary levels, see memoize_section
+profile_section_cache = LRUCache(max_size=PROFILE_SECTION_CACHE_SIZE,
+                                 ttl=PROFILE_SECTION_CACHE_TTL)
+
+
+def memoize_section(func):
+    '''
+    Decorator for profile section functions with the signature
+    (geo_code, geo_level, [args...], session) that caches their results in
+    `profile_section_cache` for the levels in `PROFILE_SECTION_CACHE_LEVELS`.
+
+    The province and country sections are merged into every ward and
+    municipality profile, so caching them means only the geography being
+    viewed needs to be computed for most requests.
+
+    Sessions are left out of the cache key and dict arguments are keyed on
+    their items. Results are copied in and out of the cache, since callers
+    modify them.
+
+    The decorated function's +is_cached+ attribute tells whether a call with
+    the same arguments (without the session) would be a cache hit.
+    '''
+    def cache_key(geo_code, geo_level, args):
+        key = (func.__module__, func.__name__, geo_level, geo_code, get_data_version())
+        return key + tuple(tuple(sorted(a.iteritems())) if isinstance(a, dict) else a
+                           for a in args if not isinstance(a, Session))
+
+    def is_cached(geo_code, geo_level, *args):
+        return (geo_level in PROFILE_SECTION_CACHE_LEVELS and
+                cache_key(geo_code, geo_level, args) in profile_section_cache)
+
+    @wraps(func)
+    def wrapper(geo_code, geo_level, *args):
+        if geo_level not in PROFILE_SECTION_CACHE_LEVELS:
+            return func(geo_code, geo_level, *args)
+
+        key = cache_key(geo_code, geo_level, args)
+        result = profile_section_cache.get(key)
+        if result is None:
+            result = func(geo_code, geo_level, *args)
+            profile_section_cache.set(key, deepcopy(result))
+            return result
+
+        return deepcopy(result)
+
+    wrapper.is_cached = is_cached
+    return wrapper
+
+
+@on_data_version_change
+def invalidate_profile_sections():
+    '''
+    Throw away all cached profile sections. This is called whenever the
+    data version changes, since they're all from the old data.
+    '''
+    profile_section_cache.clear()
+
 
 def collapse_categories(data, categories, key_order=None):
     if key_order:
@@ -117,17 +184,64 @@ def get_summary_geo_info(geo_code=None, geo_level=None, session=None,
 
 
 def get_geo_object(geo_code, geo_level, session):
-    model = {
-        'ward': Ward,
-        'district': District,
-        'municipality': Municipality,
-        'province': Province,
-        'country': None,
-    }[geo_level]
-
-    if model is None:
+    if geo_level == 'country':
         return None
-    return session.query(model).get(geo_code)
+    return get_geo_index().get(geo_level, geo_code)
+
+
+def build_profile_sections(sections, geo_code, geo_level, geo_summary_levels):
+    '''
+    Build the data for each profile section for a geography and its summary
+    geographies, and merge the summary data into the geography's data.
+
+    +sections+ is a list of (key, func, args) tuples. Each section is built by
+    calling func(geo_code, geo_level, *args, session) once per geography.
+    Every call runs with its own session and they may be run concurrently
+    (see `api.executor`), but they share a `QueryPlanner` so each data table
+    is only fetched once. Only the geographies with sections that aren't
+    already cached (see `memoize_section`) are planned, and if every section
+    is cached there's no planner at all.
+
+    Returns an OrderedDict from section key to the merged section data, in
+    the same order as +sections+.
+    '''
+    geos = [(geo_level, geo_code)] + list(geo_summary_levels)
+
+    def is_cached(func, level, code, args):
+        return getattr(func, 'is_cached', None) is not None and func.is_cached(code, level, *args)
+
+    missed = [(level, code) for level, code in geos
+              if not all(is_cached(func, level, code, args) for key, func, args in sections)]
+    planner = QueryPlanner(missed) if missed else None
+
+    def make_task(func, args, level, code):
+        def task():
+            session = get_session()
+            if planner is not None:
+                use_planner(session, planner)
+            try:
+                return func(code, level, *(tuple(args) + (session,)))
+            finally:
+                unplan_profile_queries(session)
+                session.close()
+        return task
+
+    tasks = []
+    for key, func, args in sections:
+        for level, code in geos:
+            tasks.append(make_task(func, args, level, code))
+
+    results = iter(run_concurrently(tasks))
+
+    # merge in a fixed order, regardless of when tasks finished
+    data = OrderedDict()
+    for key, func, args in sections:
+        data[key] = next(results)
+        for level, code in geo_summary_levels:
+            # merge summary profile into current geo profile
+            merge_dicts(data[key], next(results), level)
+
+    return data
 
 
 def merge_dicts(this, other, other_key):
@@ -187,6 +301,9 @@ def get_objects_by_geo(db_model, geo_code, geo_level, session, fields=None, orde
     """ Get rows of statistics from the stats mode +db_model+ at a particular
     geo_code and geo_level, summing over the 'total' field and grouping by
     +fields+.
+
+    If the session has a `QueryPlanner` that covers this geography, the rows
+    are served from the planner's batched results rather than a new query.
     """
     if db_model.data_table.table_per_level:
         geo_attr = '%s_code' % geo_level
@@ -196,6 +313,24 @@ def get_objects_by_geo(db_model, geo_code, geo_level, session, fields=None, orde
     if fields is None:
         fields = [c.key for c in class_mapper(db_model).attrs if c.key not in [geo_attr, 'geo_level', 'total']]
 
+    planner = get_planner(session)
+    if planner is not None and planner.covers(geo_level, geo_code):
+        # this data has been (or will be) fetched in bulk for the profile
+        objects = planner.get_objects(db_model, geo_level, geo_code, session,
+                                      fields, order_by=order_by)
+    else:
+        objects = query_objects_by_geo(db_model, geo_code, geo_level, session,
+                                       geo_attr, fields, order_by)
+
+    if len(objects) == 0:
+        raise LocationNotFound("%s for geography '%s-%s' not found"
+                               % (db_model.__table__.name, geo_level, geo_code))
+    return objects
+
+
+def query_objects_by_geo(db_model, geo_code, geo_level, session, geo_attr, fields, order_by=None):
+    """ Query the database for the rows that `get_objects_by_geo` returns.
+    """
     fields = [getattr(db_model, f) for f in fields]
 
     objects = session\
@@ -223,11 +358,7 @@ def get_objects_by_geo(db_model, geo_code, geo_level, session, fields=None, orde
 
         objects = objects.order_by(attr)
 
-    objects = objects.all()
-    if len(objects) == 0:
-        raise LocationNotFound("%s for geography '%s-%s' not found"
-                               % (db_model.__table__.name, geo_level, geo_code))
-    return objects
+    return objects.all()
 
 
 def get_stat_data(fields, geo_level, geo_code, session, order_by=None,
@@ -273,137 +404,216 @@ def get_stat_data(fields, geo_level, geo_code, session, order_by=None,
                                    The default ordering is determined by +order+.
     :param str table_dataset: dataset used to help find the table if +table_name+ isn't given.
 
+    To build several views of the same statistic, fetch it once with `get_stat_result`
+    and call `StatResult.get_stat_data` for each view.
+
     :return: (data-dictionary, total)
     """
+    result = get_stat_result(fields, geo_level, geo_code, session, table_fields=table_fields,
+                             table_name=table_name, table_dataset=table_dataset)
+    return result.get_stat_data(order_by=order_by, percent=percent, total=total, only=only,
+                                exclude=exclude, exclude_zero=exclude_zero, recode=recode,
+                                key_order=key_order)
 
-    if not isinstance(fields, list):
-        fields = [fields]
 
-    n_fields = len(fields)
-    many_fields = n_fields > 1
+def get_stat_result(fields, geo_level, geo_code, session, table_fields=None,
+                    table_name=None, table_dataset=None):
+    """
+    Fetch the rows for a statistic once, so that many views of it (filtered,
+    recoded, reordered, with or without percentages) can be built with
+    `StatResult.get_stat_data` without going back to the database.
 
-    if order_by is None:
-        order_by = fields[0]
+    The arguments are the same as for `get_stat_data`.
 
-    if only is not None:
-        if not isinstance(only, dict):
-            if many_fields:
-                raise ValueError("If many fields are given, then only must be a dict. I got %s instead" % only)
-            else:
-                only = {fields[0]: set(only)}
+    :return: a `StatResult`
+    """
+    if not isinstance(fields, list):
+        fields = [fields]
 
-    if exclude is not None:
-        if not isinstance(exclude, dict):
-            if many_fields:
-                raise ValueError("If many fields are given, then exclude must be a dict. I got %s instead" % exclude)
-            else:
-                exclude = {fields[0]: set(exclude)}
+    model = get_model_from_fields(table_fields or fields, geo_level, table_name, table_dataset)
 
-    if key_order:
-        if not isinstance(key_order, dict):
-            if many_fields:
-                raise ValueError("If many fields are given, then key_order must be a dict. I got %s instead" % key_order)
-            else:
-                key_order = {fields[0]: key_order}
+    planner = get_planner(session)
+    if planner is not None and planner.covers(geo_level, geo_code):
+        rows = planner.get_objects(model, geo_level, geo_code, session, fields)
     else:
-        key_order = {}
+        rows = query_stat_rows(model, geo_code, geo_level, session, fields)
 
-    if total is not None and many_fields:
-        raise ValueError("Cannot specify a total if many fields are given")
+    if len(rows) == 0:
+        raise LocationNotFound("%s for geography '%s-%s' not found"
+                               % (model.__table__.name, geo_level, geo_code))
 
-    if recode:
-        if not isinstance(recode, dict) or not many_fields:
-            recode = dict((f, recode) for f in fields)
+    return StatResult(fields, model, rows)
 
-    model = get_model_from_fields(table_fields or fields, geo_level, table_name, table_dataset)
-    objects = get_objects_by_geo(model, geo_code, geo_level, session, fields=fields, order_by=order_by)
 
-    root_data = OrderedDict()
-    our_total = {}
+def query_stat_rows(db_model, geo_code, geo_level, session, fields):
+    """ Query the database for the rows of a `StatResult`, summed over +fields+
+    and ranked on each field so that they can be ordered in memory.
+    """
+    geo_attr = '%s_code' % geo_level if db_model.data_table.table_per_level else 'geo_code'
+    columns = [getattr(db_model, f) for f in fields]
+    ranks = [func.dense_rank().over(order_by=c).label('rank_%d' % i)
+             for i, c in enumerate(columns)]
 
-    def get_data_object(obj):
-        """ Recurse down the list of fields and return the
-        final resting place for data for this stat. """
-        data = root_data
+    objects = session\
+        .query(func.sum(db_model.total).label('total'), *(columns + ranks))\
+        .group_by(*columns)\
+        .filter(getattr(db_model, geo_attr) == geo_code)
 
-        for i, field in enumerate(fields):
-            key = getattr(obj, field)
+    if not db_model.data_table.table_per_level:
+        objects = objects.filter(db_model.geo_level == geo_level)
 
-            if only and field in only and key not in only.get(field, {}):
-                return key, None
+    return [StatRow(row.total,
+                    dict((f, row[i + 1]) for i, f in enumerate(fields)),
+                    dict((f, getattr(row, 'rank_%d' % i)) for i, f in enumerate(fields)))
+            for row in objects]
 
-            if exclude and key in exclude.get(field, {}):
-                return key, None
 
-            if recode and field in recode:
-                recoder = recode[field]
-                if isinstance(recoder, dict):
-                    key = recoder.get(key, key)
+class StatResult(object):
+    """
+    The rows of a statistic for a place, as fetched by `get_stat_result`.
+    Any number of views of the statistic can be built from the same rows
+    with +get_stat_data+.
+    """
+    def __init__(self, fields, model, rows):
+        self.fields = fields
+        self.model = model
+        self.rows = rows
+
+    def get_stat_data(self, order_by=None, percent=True, total=None, only=None,
+                      exclude=None, exclude_zero=False, recode=None, key_order=None):
+        """
+        Build a data dictionary for this statistic, in memory. The arguments
+        are the same as for `get_stat_data`.
+
+        :return: (data-dictionary, total)
+        """
+        fields = self.fields
+        model = self.model
+
+        n_fields = len(fields)
+        many_fields = n_fields > 1
+
+        if order_by is None:
+            order_by = fields[0]
+
+        if only is not None:
+            if not isinstance(only, dict):
+                if many_fields:
+                    raise ValueError("If many fields are given, then only must be a dict. I got %s instead" % only)
                 else:
-                    key = recoder(field, key)
-            else:
-                key = capitalize(key)
+                    only = {fields[0]: set(only)}
 
-            # enforce key ordering
-            if not data and field in key_order:
-                for fld in key_order[field]:
-                    data[fld] = OrderedDict()
+        if exclude is not None:
+            if not isinstance(exclude, dict):
+                if many_fields:
+                    raise ValueError("If many fields are given, then exclude must be a dict. I got %s instead" % exclude)
+                else:
+                    exclude = {fields[0]: set(exclude)}
 
-            # ensure it's there
-            if key not in data:
-                data[key] = OrderedDict()
+        if key_order:
+            if not isinstance(key_order, dict):
+                if many_fields:
+                    raise ValueError("If many fields are given, then key_order must be a dict. I got %s instead" % key_order)
+                else:
+                    key_order = {fields[0]: key_order}
+        else:
+            key_order = {}
 
-            data = data[key]
+        if total is not None and many_fields:
+            raise ValueError("Cannot specify a total if many fields are given")
 
-            # default values for intermediate fields
-            if data is not None and i < n_fields - 1:
-                data['metadata'] = {'name': key}
+        if recode:
+            if not isinstance(recode, dict) or not many_fields:
+                recode = dict((f, recode) for f in fields)
 
-        # data is now the dict where the end value is going to go
-        if not data:
-            data['name'] = key
-            data['numerators'] = {'this': 0.0}
+        objects = sort_rows(self.rows, fields, order_by)
 
-        return key, data
+        root_data = OrderedDict()
+        our_total = {}
 
-    # run the stats for the objects
-    for obj in objects:
-        if obj.total == 0 and exclude_zero:
-            continue
+        def get_data_object(obj):
+            """ Recurse down the list of fields and return the
+            final resting place for data for this stat. """
+            data = root_data
 
-        # get the data dict where these values must go
-        key, data = get_data_object(obj)
-        if not data:
-            continue
+            for i, field in enumerate(fields):
+                key = getattr(obj, field)
 
-        our_total[key] = our_total.get(key, 0.0) + obj.total
-        data['numerators']['this'] += obj.total
+                if only and field in only and key not in only.get(field, {}):
+                    return key, None
 
-    if total is not None:
-        grand_total = total
-    else:
-        grand_total = sum(our_total.values())
-
-    # add in percentages
-    def calc_percent(data):
-        for key, data in data.iteritems():
-            if not key == 'metadata':
-                if 'numerators' in data:
-                    if percent:
-                        tot = our_total[key] if many_fields else grand_total
-                        perc = 0 if tot == 0 else (data['numerators']['this'] / tot * 100)
-                        data['values'] = {'this': round(perc, 2)}
+                if exclude and key in exclude.get(field, {}):
+                    return key, None
+
+                if recode and field in recode:
+                    recoder = recode[field]
+                    if isinstance(recoder, dict):
+                        key = recoder.get(key, key)
                     else:
-                        data['values'] = dict(data['numerators'])
-                        data['numerators']['this'] = None
+                        key = recoder(field, key)
                 else:
-                    calc_percent(data)
+                    key = capitalize(key)
+
+                # enforce key ordering
+                if not data and field in key_order:
+                    for fld in key_order[field]:
+                        data[fld] = OrderedDict()
+
+                # ensure it's there
+                if key not in data:
+                    data[key] = OrderedDict()
+
+                data = data[key]
+
+                # default values for intermediate fields
+                if data is not None and i < n_fields - 1:
+                    data['metadata'] = {'name': key}
+
+            # data is now the dict where the end value is going to go
+            if not data:
+                data['name'] = key
+                data['numerators'] = {'this': 0.0}
+
+            return key, data
+
+        # run the stats for the objects
+        for obj in objects:
+            if obj.total == 0 and exclude_zero:
+                continue
+
+            # get the data dict where these values must go
+            key, data = get_data_object(obj)
+            if not data:
+                continue
+
+            our_total[key] = our_total.get(key, 0.0) + obj.total
+            data['numerators']['this'] += obj.total
+
+        if total is not None:
+            grand_total = total
+        else:
+            grand_total = sum(our_total.values())
+
+        # add in percentages
+        def calc_percent(data):
+            for key, data in data.iteritems():
+                if not key == 'metadata':
+                    if 'numerators' in data:
+                        if percent:
+                            tot = our_total[key] if many_fields else grand_total
+                            perc = 0 if tot == 0 else (data['numerators']['this'] / tot * 100)
+                            data['values'] = {'this': round(perc, 2)}
+                        else:
+                            data['values'] = dict(data['numerators'])
+                            data['numerators']['this'] = None
+                    else:
+                        calc_percent(data)
 
-    calc_percent(root_data)
+        calc_percent(root_data)
 
-    add_metadata(root_data, model)
+        add_metadata(root_data, model)
 
-    return root_data, grand_total
+        return root_data, grand_total
 
 
 def create_debug_dump(data, geo_level, name):
@@ -5,11 +5,17 @@ import logging
 import zipfile
 import re
 import json
+import csv
+from cStringIO import StringIO
 
 import requests
 from osgeo import ogr, osr
 from django.core.cache import cache
 
+from api.controller.data import get_raw_data
+from api.geometry_store import get_geometry_store
+from api.zipstream import stream_zip
+
 # Amount of time to cache geometry data
 CACHE_SECS = 24*60*60
 
@@ -20,27 +26,98 @@ supported_formats = {
     'csv':      {"driver": "CSV",     'geometry': False, 'mime': 'text/csv'},
 }
 
+# Formats that are streamed straight to the client, rather than built with OGR
+streaming_formats = set(['csv'])
+
+# Number of geographies to fetch data for at a time when streaming
+STREAM_BATCH_SIZE = 500
+
 log = logging.getLogger('censusreporter')
 
 bad_layer_chars = re.compile('[ /#-]')
 
+
+def get_file_ident(tables, geos):
+    return "%s_%s" % (
+        tables[0].id.upper(),
+        # The gdal KML driver doesn't like certain chars in its layer names.
+        # It will replace them for you, but then subsequent calls hang.
+        bad_layer_chars.sub('_', geos[0].short_name))
+
+
+def stream_download_bundle(tables, geos, fmt):
+    """
+    Build a download bundle for one of the `streaming_formats` as it's sent.
+
+    Unlike `generate_download_bundle`, nothing is written to disk and the whole
+    bundle is never held in memory: the data is fetched a batch of geographies
+    at a time and written straight into a zip that's generated as the client
+    reads it.
+
+    :return: (iterator of zip chunks, filename, mime type)
+    """
+    file_ident = get_file_ident(tables, geos)
+    name = '%s/%s.%s' % (file_ident, file_ident, fmt)
+
+    log.info("Streaming download %s" % name)
+    chunks = stream_zip([(name, generate_csv(tables, geos))])
+
+    return chunks, file_ident + '.zip', 'application/zip'
+
+
+def generate_csv(tables, geos):
+    """
+    Generate the chunks of a CSV file with the data for +tables+ for +geos+,
+    with one row per geography, as the OGR CSV driver would.
+    """
+    buf = StringIO()
+    writer = csv.writer(buf)
+
+    def flush():
+        chunk = buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+        return chunk
+
+    header = ['geo_level', 'geo_code', 'geoid', 'name']
+    for table in tables:
+        header.extend(str(column_id) for column_id in table.columns.iterkeys())
+    writer.writerow(header)
+    yield flush()
+
+    for i in xrange(0, len(geos), STREAM_BATCH_SIZE):
+        batch = geos[i:i + STREAM_BATCH_SIZE]
+        data = get_raw_data(tables, batch)
+
+        for geo in batch:
+            geoid = geo.full_geoid
+            name = geo.short_name
+            if isinstance(name, unicode):
+                name = name.encode('utf-8')
+            row = [geo.level, geo.code, geoid, name]
+
+            for table in tables:
+                table_estimates = data[geoid][table.id.upper()]['estimate']
+                row.extend(table_estimates.get(column_id, '') for column_id in table.columns.iterkeys())
+
+            writer.writerow(row)
+
+        yield flush()
+
+
 def generate_download_bundle(tables, geos, geo_ids, data, fmt):
     ogr.UseExceptions()
 
     format = supported_formats[fmt]
     if format['geometry']:
-        geometries = load_geometries(geo_ids)
+        geometries = load_geometries(geo_ids, geos)
     else:
         geometries = {}
 
     # where we're going to put the data temporarily
     temp_path = tempfile.mkdtemp()
     try:
-        file_ident = "%s_%s" % (
-                tables[0].id.upper(),
-                # The gdal KML driver doesn't like certain chars in its layer names.
-                # It will replace them for you, but then subsequent calls hang.
-                bad_layer_chars.sub('_', geos[0].short_name))
+        file_ident = get_file_ident(tables, geos)
 
         # where the files go, what we'll eventually zip up
         inner_path = os.path.join(temp_path, file_ident)
@@ -71,8 +148,7 @@ def generate_download_bundle(tables, geos, geo_ids, data, fmt):
             out_feat = ogr.Feature(out_layer.GetLayerDefn())
 
             if format['geometry']:
-                geom = geometries[geoid]
-                out_feat.SetGeometry(geom.GetGeometryRef())
+                out_feat.SetGeometry(geometries[geoid])
 
             out_feat.SetField2('geo_level', geo.level)
             out_feat.SetField2('geo_code', geo.code)
@@ -116,10 +192,32 @@ def generate_download_bundle(tables, geos, geo_ids, data, fmt):
     finally:
         shutil.rmtree(temp_path)
 
-def load_geometries(geo_ids):
+def load_geometries(geo_ids, geos):
+    """
+    Load geometries for +geos+, and return a map from each geo's
+    geoid to its geometry.
+
+    Geometries come from the local geometry store (see `api.geometry_store`).
+    If it doesn't have them all, they're fetched from MapIt using +geo_ids+,
+    the geo ids that were requested.
+    """
+    store = get_geometry_store()
+    geometries = {}
+
+    for geo in geos:
+        wkb = store.get(geo.full_geoid)
+        if wkb is None:
+            log.info("%s isn't in the geometry store, fetching geometries from MapIt" % geo.full_geoid)
+            return load_mapit_geometries(geo_ids)
+        geometries[geo.full_geoid] = ogr.CreateGeometryFromWkb(wkb)
+
+    return geometries
+
+
+def load_mapit_geometries(geo_ids):
     """
-    Load geometries for geo_ids, and return a map
-    from a feature's geoid to the feature object.
+    Load geometries for geo_ids from MapIt, and return a map
+    from a feature's geoid to its geometry.
     """
     geometries = {}
 
@@ -137,7 +235,7 @@ def load_geometries(geo_ids):
             # XXX: parse the codes attribute as a json string
             # XXX: GDAL 2.0 might fix this?
             code = json.loads(feat['codes'])['MDB']
-            geometries[level + '-' + code] = feat
+            geometries[level + '-' + code] = feat.GetGeometryRef().Clone()
 
     return geometries
 
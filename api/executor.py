@@ -0,0 +1,108 @@
+import logging
+
+from .config import EXECUTOR_MODE, EXECUTOR_CONCURRENCY
+
+log = logging.getLogger('censusreporter')
+
+
+'''
+Running independent units of work, such as profile sections, concurrently.
+
+The site is served by gunicorn's gevent workers, so the natural way to overlap
+the database waits of a single request is to run its independent queries on
+separate greenlets. Outside of gevent (management commands, scripts, the dev
+server) work runs serially, unless threads are explicitly asked for.
+
+The mode is chosen with `EXECUTOR_MODE`:
+
+* `auto`: use gevent if it has monkey patched the socket module, else serial
+* `gevent`: always use greenlets
+* `threads`: use a thread pool
+* `serial`: run everything one after the other
+'''
+
+_green_psycopg = False
+
+
+def get_executor_mode():
+    mode = EXECUTOR_MODE
+
+    if mode == 'auto':
+        try:
+            from gevent import monkey
+            mode = 'gevent' if 'socket' in monkey.saved else 'serial'
+        except ImportError:
+            mode = 'serial'
+
+    return mode
+
+
+def make_psycopg_green():
+    """
+    Make psycopg2 cooperate with gevent. Without this, a query blocks the
+    whole process and greenlets can't overlap their database waits.
+
+    This must be called before any connections are opened, so gevent
+    workers call it when they start (see config/gunicorn.py).
+    """
+    global _green_psycopg
+    if _green_psycopg:
+        return
+
+    from psycopg2 import extensions, OperationalError
+    from gevent.socket import wait_read, wait_write
+
+    def gevent_wait_callback(conn, timeout=None):
+        while True:
+            state = conn.poll()
+            if state == extensions.POLL_OK:
+                break
+            elif state == extensions.POLL_READ:
+                wait_read(conn.fileno(), timeout=timeout)
+            elif state == extensions.POLL_WRITE:
+                wait_write(conn.fileno(), timeout=timeout)
+            else:
+                raise OperationalError("Bad result from poll: %r" % state)
+
+    extensions.set_wait_callback(gevent_wait_callback)
+    _green_psycopg = True
+
+
+def run_concurrently(tasks, concurrency=None, mode=None):
+    """
+    Call each of the callables in +tasks+, running at most +concurrency+
+    at a time, and return their results in the same order as +tasks+.
+
+    If any task raises an exception, the remaining tasks are stopped (where
+    possible) and the exception is re-raised.
+    """
+    tasks = list(tasks)
+    concurrency = concurrency or EXECUTOR_CONCURRENCY
+    mode = mode or get_executor_mode()
+
+    if mode == 'serial' or concurrency <= 1 or len(tasks) <= 1:
+        return [task() for task in tasks]
+
+    if mode == 'gevent':
+        import gevent
+        from gevent.pool import Pool
+
+        # in case the worker didn't already, see config/gunicorn.py
+        make_psycopg_green()
+        pool = Pool(concurrency)
+        greenlets = [pool.spawn(task) for task in tasks]
+        try:
+            gevent.joinall(greenlets, raise_error=True)
+        except:
+            pool.kill()
+            raise
+        return [g.value for g in greenlets]
+
+    if mode == 'threads':
+        from concurrent.futures import ThreadPoolExecutor
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = [executor.submit(task) for task in tasks]
+            return [f.result() for f in futures]
+
+    raise ValueError('Unknown executor mode: %s' % mode)
@@ -5,6 +5,7 @@ from api.config import DB_USER, DB_NAME, DB_PASSWORD
 
 
 DATA_DIR = 'censusreporter/api/data'
+SCRIPTS_DIR = 'censusreporter/api/scripts'
 PSQL_STRING = 'PGPASSWORD=%s psql -d %s -U %s -h localhost' \
               % (DB_PASSWORD, DB_NAME, DB_USER)
 
@@ -42,6 +43,8 @@ def load_api_data():
     commands = (
         'for fp in `ls %s/*.tar.gz`; do tar -xvzf ${fp} -C %s/; done' % (data_dir_abs, data_dir_abs),
         'for fp in `ls %s/*.sql`; do echo loading $fp; %s -f ${fp}; done' % (data_dir_abs, PSQL_STRING),
+        # the data has changed, so anything derived from it is stale
+        'python %s' % os.path.join(env.repo_dir, SCRIPTS_DIR, 'bump_data_version.py'),
     )
 
     if env.deploy_type == 'dev':
@@ -0,0 +1,92 @@
+import json
+import threading
+import time
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+
+'''
+A stand-in for the wards API, for testing without calling the real one.
+
+    server = FakeWardSearchServer({'1 main road': [...]}, delay=0.1)
+    server.start()
+    api = WardSearchAPI(server.url)
+    ...
+    server.stop()
+
+Addresses it doesn't know get the API's "not found" response, and those in
++failures+ get a 500 error. It counts the requests it answers, so tests can
+check which lookups were cached. It can
+also be run on its own, and WARD_SEARCH_ENDPOINT pointed at it:
+
+    python -m api.fake_ward_search 8001
+'''
+
+NOT_FOUND = {'error': 'No results found'}
+
+
+class FakeWardSearchHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        params = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+        address = params.get('address', [''])[0]
+
+        with server.lock:
+            server.requests.append(address)
+
+        if server.delay:
+            time.sleep(server.delay)
+
+        if address in server.failures:
+            self.send_error(500)
+            return
+
+        body = json.dumps(server.responses.get(address, NOT_FOUND))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeWardSearchServer(ThreadingMixIn, HTTPServer):
+    """
+    Answers ward searches with +responses+, a map from address to the
+    JSON data to return for it, after waiting +delay+ seconds. Addresses
+    in +failures+ get a 500 error.
+    """
+    daemon_threads = True
+
+    def __init__(self, responses=None, delay=0, port=0, failures=()):
+        HTTPServer.__init__(self, ('127.0.0.1', port), FakeWardSearchHandler)
+        self.responses = responses or {}
+        self.failures = set(failures)
+        self.delay = delay
+        # the addresses asked for, in order
+        self.requests = []
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://%s:%d/' % self.server_address
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == '__main__':
+    import sys
+    server = FakeWardSearchServer(port=int(sys.argv[1]) if len(sys.argv) > 1 else 8001)
+    print 'Fake wards API on %s' % server.url
+    server.serve_forever()
@@ -0,0 +1,264 @@
+import threading
+
+from api.models import (Country, Province, District, Municipality, Ward, Subplace, PoliceDistrict,
+                        geo_levels)
+from api.utils import get_session
+
+
+'''
+A read-only, in-memory index of all geographies.
+
+The demarcations only change when the data is reloaded, yet finding a
+geography, its parents and its names through the ORM costs a query and then
+lazy loads for each relationship. Instead, every process loads all the
+geographies once into compact `GeoRecord` objects, with their parents,
+children and names worked out up front, and looks them up by level and code.
+
+A `GeoRecord` can stand in for the ORM models (Ward, Province, etc.) wherever
+a geography is only read: it has the same attributes and +as_dict+,
++as_dict_deep+, +parents+, +children+ and +split_into+ methods.
+'''
+
+# the models in the index, parents before children
+GEO_MODELS = [
+    ('country', Country),
+    ('province', Province),
+    ('district', District),
+    ('municipality', Municipality),
+    ('ward', Ward),
+    ('policedistrict', PoliceDistrict),
+    ('subplace', Subplace),
+]
+
+# the levels of a geography's parents, nearest first, as
+# returned by `GeoMixin.parents`
+PARENT_LEVELS = {
+    'country': [],
+    'province': ['country'],
+    'district': ['province', 'country'],
+    'municipality': ['province', 'country'],
+    'ward': ['municipality', 'province', 'country'],
+    'policedistrict': ['province', 'country'],
+    'subplace': ['ward', 'municipality', 'province', 'country'],
+}
+
+# the child level of each level, as in `GeoMixin.child_level`
+CHILD_LEVELS = dict((level, getattr(model, 'child_level', None)) for level, model in GEO_MODELS)
+
+# columns loaded for each geography, where the model has them
+GEO_COLUMNS = ['code', 'name', 'year', 'square_kms', 'ward_no', 'country_code',
+               'province_code', 'district_code', 'municipality_code', 'ward_code']
+
+
+class GeoRecord(object):
+    """ A geography in the `GeoIndex`. Records are shared between threads
+    and must not be changed once the index is built; use +reparent+ to get
+    a copy with a different parent.
+    """
+    __slots__ = GEO_COLUMNS + ['level', 'child_level', 'full_geoid', 'short_name',
+                               'context_name', 'long_name', 'parent', '_parents', '_descendants']
+
+    def __init__(self, level, child_level=None, **kwargs):
+        self.level = level
+        self.child_level = child_level
+        for attr in GEO_COLUMNS:
+            setattr(self, attr, kwargs.get(attr))
+
+        self.full_geoid = '%s-%s' % (self.level, self.code)
+        self.short_name = self.context_name = self.long_name = self.name or ''
+        self.parent = None
+        self._parents = ()
+        # map from level to our descendants at that level
+        self._descendants = {}
+
+    def parents(self):
+        return list(self._parents)
+
+    def children(self):
+        return list(self._descendants.get(self.child_level, ()))
+
+    def descendant_levels(self):
+        levels = []
+        level = self.child_level
+        while level:
+            levels.append(level)
+            level = CHILD_LEVELS[level]
+        return levels
+
+    def split_into(self, level):
+        if level not in geo_levels:
+            raise ValueError(level)
+
+        if level == self.child_level:
+            return self.children()
+
+        if level not in self.descendant_levels():
+            return []
+
+        # when splitting into a lower level, the children's parent
+        # is us, which allows the UI to handle that case correctly
+        return [k.reparent(self) for k in self._descendants.get(level, ())]
+
+    def reparent(self, parent):
+        """ A copy of this record with +parent+ as its parent. """
+        copy = GeoRecord.__new__(GeoRecord)
+        for attr in GeoRecord.__slots__:
+            setattr(copy, attr, getattr(self, attr))
+        copy.parent = parent
+        return copy
+
+    def parent_at(self, level):
+        for p in self._parents:
+            if p.level == level:
+                return p
+        return None
+
+    @property
+    def province(self):
+        return self.parent_at('province')
+
+    @property
+    def municipality(self):
+        return self.parent_at('municipality')
+
+    @property
+    def country(self):
+        return self.parent_at('country')
+
+    def as_dict(self):
+        return {
+            'full_geoid': self.full_geoid,
+            'full_name': self.long_name,
+            'short_name': self.short_name,
+            'name': self.context_name,
+            'geo_level': self.level,
+            'geo_code': self.code,
+            'child_level': self.child_level,
+            'parent_geoid': self.parent.full_geoid if self.parent else None,
+            'square_kms': self.square_kms,
+        }
+
+    def as_dict_deep(self):
+        return {
+            'this': self.as_dict(),
+            'parents': dict((p.level, p.as_dict()) for p in self._parents),
+            'parents_ordering': [p.level for p in self._parents],
+        }
+
+    def __unicode__(self):
+        return self.long_name
+
+    def __repr__(self):
+        return 'GeoRecord(%s)' % self.full_geoid
+
+
+class GeoIndex(object):
+    """ All geographies, by level and code. """
+
+    def __init__(self, records):
+        self.records = dict((r.full_geoid, r) for r in records)
+        self.link()
+
+    def get(self, geo_level, geo_code):
+        return self.records.get('%s-%s' % (geo_level, geo_code))
+
+    def at_level(self, geo_level):
+        return [r for r in self.records.itervalues() if r.level == geo_level]
+
+    def __len__(self):
+        return len(self.records)
+
+    def link(self):
+        """ Work out each record's parents, descendants and names. """
+        descendants = {}
+
+        for r in self.records.itervalues():
+            parents = []
+            for level in PARENT_LEVELS[r.level]:
+                code = 'ZA' if level == 'country' else getattr(r, '%s_code' % level)
+                p = self.get(level, code)
+                if p is not None:
+                    parents.append(p)
+
+            r._parents = tuple(parents)
+            r.parent = parents[0] if parents else None
+
+            # we're a descendant of every geography whose code we have,
+            # eg. a ward is a descendant of its municipality, district
+            # and province
+            ancestors = [('country', 'ZA')] + [
+                (level, getattr(r, '%s_code' % level))
+                for level in ('province', 'district', 'municipality', 'ward')]
+            for level, code in ancestors:
+                if level != r.level and code is not None:
+                    descendants.setdefault((level, code, r.level), []).append(r)
+
+        for (level, code, descendant_level), kids in descendants.iteritems():
+            ancestor = self.get(level, code)
+            if ancestor is not None:
+                kids.sort(key=lambda k: k.code)
+                ancestor._descendants[descendant_level] = tuple(kids)
+
+        for r in self.records.itervalues():
+            self.set_names(r)
+
+    def set_names(self, r):
+        if r.level == 'ward':
+            r.short_name = 'Ward %d (%s)' % (r.ward_no, r.code)
+            municipality, province = r.municipality, r.province
+            if municipality and province:
+                r.context_name = '%s, %s, %s' % (r.short_name, municipality.name, province.code)
+            else:
+                r.context_name = r.short_name
+        elif r.level in ('municipality', 'policedistrict') and r.province:
+            r.context_name = '%s, %s' % (r.short_name, r.province.code)
+
+        parent_names = [p.name for p in r._parents
+                        if p.name and p.level != 'district' and p.level != 'country']
+        if parent_names:
+            r.long_name = '%s, %s' % (r.short_name, ', '.join(parent_names))
+        else:
+            r.long_name = r.short_name
+
+
+def load_geo_index(session):
+    records = []
+
+    for level, model in GEO_MODELS:
+        columns = [c for c in GEO_COLUMNS if hasattr(model, c)]
+        query = [getattr(model, c) for c in columns]
+
+        if model is Subplace:
+            columns.append('name')
+            query.append(Subplace.subplace_name)
+
+        child_level = getattr(model, 'child_level', None)
+        for row in session.query(*query):
+            records.append(GeoRecord(level, child_level, **dict(zip(columns, row))))
+
+    if not any(r.level == 'country' for r in records):
+        za = Country.ZA()
+        records.append(GeoRecord('country', Country.child_level, code=za.code,
+                                 name=za.name, year=za.year))
+
+    return GeoIndex(records)
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_geo_index():
+    """ The geography index for this process, loaded on first use. """
+    global _index
+
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                session = get_session()
+                try:
+                    _index = load_geo_index(session)
+                finally:
+                    session.close()
+
+    return _index
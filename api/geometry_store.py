@@ -0,0 +1,184 @@
+import mmap
+import os
+import struct
+import threading
+
+from .config import GEOMETRY_STORE_PATH, WARD_BOUNDARIES_PATH
+
+import logging
+log = logging.getLogger('censusreporter')
+
+
+'''
+A read-only, memory-mapped store of geometries, looked up by `full_geoid`.
+
+Downloads in formats with geometries (KML, GeoJSON) used to fetch boundaries
+from MapIt for every request and parse them with OGR. Instead, the
+`build_geometry_store` command reads local boundary files once, simplifies
+each geometry with the tolerance for its level and writes them here as WKB.
+
+The file is laid out as:
+
+    header:  magic, format version, number of geometries, offset of the index
+    data:    the WKB of each geometry, one after the other
+    index:   one fixed-width entry per geometry, sorted by geoid:
+             (geoid padded with NULs, offset of its WKB, length of its WKB)
+
+so a geometry is found with a binary search over the index, and only the
+pages that are actually read are loaded from disk.
+'''
+
+MAGIC = 'WZGS'
+FORMAT_VERSION = 1
+
+HEADER = struct.Struct('<4sHHIQ')
+INDEX_ENTRY = struct.Struct('<64sQI')
+MAX_GEOID_LENGTH = 64
+
+
+class GeometryStore(object):
+    """ Reads geometries from a store file. """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.mmap = None
+        self.mtime = None
+        self.count = 0
+        self.index_offset = 0
+
+    def get(self, geoid):
+        """ Get the WKB for +geoid+, or None if it isn't in the store. """
+        if not self.open():
+            return None
+
+        mm, count, index_offset = self.mmap, self.count, self.index_offset
+        key = geoid.encode('utf-8') if isinstance(geoid, unicode) else geoid
+
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            entry_geoid, offset, length = INDEX_ENTRY.unpack_from(mm, index_offset + mid * INDEX_ENTRY.size)
+            entry_geoid = entry_geoid.rstrip('\0')
+
+            if entry_geoid == key:
+                return mm[offset:offset + length]
+            elif entry_geoid < key:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        return None
+
+    def geoids(self, prefix=''):
+        """ Generate the geoids in the store that start with +prefix+,
+        in order.
+        """
+        if not self.open():
+            return
+
+        mm, count, index_offset = self.mmap, self.count, self.index_offset
+        for i in xrange(count):
+            geoid = INDEX_ENTRY.unpack_from(mm, index_offset + i * INDEX_ENTRY.size)[0].rstrip('\0')
+            if geoid.startswith(prefix):
+                yield geoid
+
+    def __contains__(self, geoid):
+        return self.get(geoid) is not None
+
+    def open(self):
+        """ Map the store file, re-mapping it if it has been rebuilt since.
+        Returns False if there is no usable store.
+        """
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            return False
+
+        with self.lock:
+            if self.mmap is None or mtime != self.mtime:
+                self.close()
+                with open(self.path, 'rb') as f:
+                    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+                magic, version, _, count, index_offset = HEADER.unpack_from(mm, 0)
+                if magic != MAGIC or version != FORMAT_VERSION:
+                    log.warn("Ignoring geometry store %s with unknown format" % self.path)
+                    mm.close()
+                    return False
+
+                self.mmap, self.mtime = mm, mtime
+                self.count, self.index_offset = count, index_offset
+
+        return True
+
+    def close(self):
+        if self.mmap is not None:
+            # readers may still be using the old map, leave it to be
+            # garbage collected
+            self.mmap = None
+
+
+class GeometryStoreWriter(object):
+    """ Writes a new geometry store. Geometries are added with +add+ and the
+    store replaces any existing one at +path+ when +commit+ is called.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        # map from geoid to (offset, length)
+        self.index = {}
+
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+        self.f = open(self.tmp_path, 'wb')
+        # placeholder until we know where the index is
+        self.f.write(HEADER.pack(MAGIC, FORMAT_VERSION, 0, 0, 0))
+
+    def add(self, geoid, wkb):
+        if isinstance(geoid, unicode):
+            geoid = geoid.encode('utf-8')
+        if len(geoid) > MAX_GEOID_LENGTH:
+            raise ValueError("Geoid is too long for the geometry store: %s" % geoid)
+
+        offset = self.f.tell()
+        self.f.write(wkb)
+        self.index[geoid] = (offset, len(wkb))
+
+    def commit(self):
+        index_offset = self.f.tell()
+        for geoid in sorted(self.index.iterkeys()):
+            offset, length = self.index[geoid]
+            self.f.write(INDEX_ENTRY.pack(geoid, offset, length))
+
+        self.f.seek(0)
+        self.f.write(HEADER.pack(MAGIC, FORMAT_VERSION, 0, len(self.index), index_offset))
+        self.f.close()
+
+        os.rename(self.tmp_path, self.path)
+
+    def abort(self):
+        self.f.close()
+        os.remove(self.tmp_path)
+
+
+_store = None
+_ward_boundaries = None
+
+
+def get_geometry_store():
+    global _store
+    if _store is None:
+        _store = GeometryStore(GEOMETRY_STORE_PATH)
+    return _store
+
+
+def get_ward_boundaries():
+    """ The store of unsimplified ward boundaries, see `api.ward_locator`. """
+    global _ward_boundaries
+    if _ward_boundaries is None:
+        _ward_boundaries = GeometryStore(WARD_BOUNDARIES_PATH)
+    return _ward_boundaries
@@ -67,20 +67,39 @@ class GeoMixin(object):
         if level not in geo_levels:
             raise ValueError(level)
 
-        kids = self.children()
         if level == self.child_level:
-            return kids
-        else:
-            splits = []
-            for k in kids:
-                splits.extend(k.split_into(level))
-            # when splitting into a lower level, ensure
-            # that we update the children's parent to be us,
-            # which allows the UI to handle that case
-            # correctly
-            for k in splits:
-                k.parent = self
-            return splits
+            return self.children()
+
+        if level not in self.descendant_levels():
+            return []
+
+        # fetch all the descendants at +level+ at once, using the
+        # parent codes each geography has (eg. Ward.province_code)
+        session = get_session()
+        try:
+            model = get_geo_model(level)
+            query = session.query(model)
+            if self.level != 'country':
+                query = query.filter(getattr(model, '%s_code' % self.level) == self.code)
+            splits = query.order_by(model.code).all()
+        finally:
+            session.close()
+
+        # when splitting into a lower level, ensure
+        # that we update the children's parent to be us,
+        # which allows the UI to handle that case
+        # correctly
+        for k in splits:
+            k.parent = self
+        return splits
+
+    def descendant_levels(self):
+        levels = []
+        level = self.child_level
+        while level:
+            levels.append(level)
+            level = get_geo_model(level).child_level
+        return levels
 
     @property
     def short_name(self):
@@ -1,11 +1,20 @@
+import json
+import os
 import re
 from itertools import groupby
 from collections import OrderedDict
 
-from sqlalchemy import Column, ForeignKey, Integer, String, Table, func
+from sqlalchemy import (Column, ForeignKey, Integer, String, Table, MetaData, func, types, and_, or_,
+                        case)
+from sqlalchemy.dialects import postgresql
 
 from .base import Base, geo_levels
-from api.utils import get_session, get_table_model, capitalize, percent as p, add_metadata
+from api.config import TABLE_MANIFEST_FILE
+from api.utils import (get_session, get_table_model, get_data_version, capitalize,
+                       percent as p, add_metadata)
+
+import logging
+log = logging.getLogger('censusreporter')
 
 
 '''
@@ -31,6 +40,14 @@ A `FieldTable` can be looked up based on a required set of fields. This
 means that the census controller doesn't care about table names, only
 about what fields it requires. If more than one FieldTable could serve
 for a set of fields, the one with the fewest extraneous fields is chosen.
+
+The columns of each table depend on the data in the database, and working
+them out means a query per table. So that starting the site doesn't need
+the database at all, the columns are read from a manifest file
+(`TABLE_MANIFEST_FILE`) written by `manage.py sync_tables`, which also
+creates any missing tables. Simple tables that aren't in the manifest are
+reflected from the database; field tables that aren't in it have no columns
+until `sync_tables` has created them and added them to the manifest.
 '''
 
 
@@ -44,6 +61,69 @@ TABLE_BAD_CHARS = re.compile('[ /-]')
 # All SimpleTable and FieldTable instances by id
 DATA_TABLES = {}
 
+MANIFEST_FORMAT = 1
+
+# type attributes of simple table columns to keep in the manifest
+MANIFEST_TYPE_ARGS = ['length', 'precision', 'scale']
+
+_manifest = None
+
+
+def get_table_manifest():
+    """ The table manifest written by `sync_table_manifest`, or an empty
+    one if there isn't a usable manifest. This is read once per process.
+    """
+    global _manifest
+
+    if _manifest is None:
+        manifest = {}
+        try:
+            with open(TABLE_MANIFEST_FILE) as f:
+                manifest = json.load(f)
+        except IOError:
+            log.warn("No table manifest at %s. Run manage.py sync_tables to create one."
+                     % TABLE_MANIFEST_FILE)
+        except ValueError as e:
+            log.warn("Couldn't load table manifest %s: %s" % (TABLE_MANIFEST_FILE, e))
+
+        if manifest and manifest.get('format') != MANIFEST_FORMAT:
+            log.warn("Ignoring table manifest with unknown format %s" % manifest.get('format'))
+            manifest = {}
+        elif manifest and manifest.get('data_version') != get_data_version():
+            log.warn("Table manifest was built for data version %s, but %s is loaded. "
+                     "Run manage.py sync_tables to update it."
+                     % (manifest.get('data_version'), get_data_version()))
+
+        _manifest = manifest
+
+    return _manifest
+
+
+def _str(value):
+    # json gives us unicode, but column names and ids are used as utf-8
+    # byte strings everywhere else
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def column_to_manifest(column):
+    info = {
+        'name': column.name,
+        'type': column.type.__class__.__name__,
+        'primary_key': column.primary_key,
+    }
+    for arg in MANIFEST_TYPE_ARGS:
+        if getattr(column.type, arg, None) is not None:
+            info[arg] = getattr(column.type, arg)
+    return info
+
+
+def column_from_manifest(info):
+    type_class = getattr(postgresql, info['type'], None) or getattr(types, info['type'])
+    type_args = dict((arg, info[arg]) for arg in MANIFEST_TYPE_ARGS if arg in info)
+    return Column(_str(info['name']), type_class(**type_args), primary_key=info['primary_key'])
+
 
 def get_datatable(id):
     return DATA_TABLES[id.lower()]
@@ -76,7 +156,11 @@ class SimpleTable(object):
         self.id = id
 
         if model == 'auto':
-            model = get_table_model(id)
+            entry = get_table_manifest().get('simple_tables', {}).get(id)
+            if entry:
+                model = get_table_model(id, [column_from_manifest(c) for c in entry['columns']])
+            else:
+                model = get_table_model(id)
 
         self.model = model
         self.universe = universe
@@ -110,37 +194,63 @@ class SimpleTable(object):
             }
 
     def raw_data_for_geos(self, geos):
+        """
+        Pull raw data for a list of geo models.
+
+        Returns a dict mapping the geo ids to table data.
+        """
         data = {}
+        session = get_session()
+        try:
+            for geo_codes in self.raw_data_queries(geo_codes_by_level(geos)):
+                data.update(self.build_raw_data(geo_codes, self.query_raw_data(session, geo_codes)))
+        finally:
+            session.close()
+
+        return data
+
+    def raw_data_queries(self, geo_codes):
+        """
+        Split +geo_codes+, a map from geo levels to lists of geo codes, into
+        the parts that can each be fetched with a single query. Simple tables
+        have one model for all levels, so everything is fetched at once.
+        """
+        return [geo_codes]
 
-        # group by geo level
-        geos = sorted(geos, key=lambda g: g.level)
-        for geo_level, geos in groupby(geos, lambda g: g.level):
-            geo_codes = [g.code for g in geos]
+    def query_raw_data(self, session, geo_codes):
+        """
+        Fetch the rows for +geo_codes+, one of the parts returned by
+        `raw_data_queries`.
+        """
+        model = self.model
+        return session\
+            .query(model)\
+            .filter(or_(*[and_(model.c.geo_level == geo_level, model.c.geo_code.in_(codes))
+                          for geo_level, codes in geo_codes.iteritems()]))\
+            .all()
+
+    def build_raw_data(self, geo_codes, rows):
+        """
+        Build the table data for each geography in +geo_codes+ from +rows+, as
+        returned by `query_raw_data`.
+
+        Returns a dict mapping the geo ids to table data.
+        """
+        data = {}
 
-            # initial values
-            for geo_code in geo_codes:
+        # initial values
+        for geo_level, codes in geo_codes.iteritems():
+            for geo_code in codes:
                 data['%s-%s' % (geo_level, geo_code)] = {
                     'estimate': {},
                     'error': {}}
 
-            session = get_session()
-            try:
-                geo_values = None
-                rows = session\
-                    .query(self.model)\
-                    .filter(self.model.c.geo_level == geo_level)\
-                    .filter(self.model.c.geo_code.in_(geo_codes))\
-                    .all()
-
-                for row in rows:
-                    geo_values = data['%s-%s' % (geo_level, row.geo_code)]
+        for row in rows:
+            geo_values = data['%s-%s' % (row.geo_level, row.geo_code)]
 
-                    for col in self.columns.iterkeys():
-                        geo_values['estimate'][col] = getattr(row, col)
-                        geo_values['error'][col] = 0
-
-            finally:
-                session.close()
+            for col in self.columns.iterkeys():
+                geo_values['estimate'][col] = getattr(row, col)
+                geo_values['error'][col] = 0
 
         return data
 
@@ -253,6 +363,13 @@ class SimpleTable(object):
             'table_id': self.id.upper(),
         }
 
+    def manifest_entry(self, session):
+        """ The description of this table for the table manifest, read from
+        the database.
+        """
+        table = Table(self.id, MetaData(), autoload=True, autoload_with=session.get_bind())
+        return {'columns': [column_to_manifest(c) for c in table.columns]}
+
 
 FIELD_TABLE_FIELDS = set()
 FIELD_TABLES = {}
@@ -377,126 +494,164 @@ class FieldTable(SimpleTable):
         self.columns = OrderedDict()
         self.columns[self.total_column] = {'name': 'Total', 'indent': 0}
 
-        session = get_session()
-        try:
-            model = self.get_model('country')
-            fields = [getattr(model, f) for f in self.fields]
-
-            # get distinct permutations for all fields
-            rows = session\
-                .query(*fields)\
-                .order_by(*fields)\
-                .distinct()\
-                .all()
-
-            def permute(indent, field_values, rows):
-                field = self.fields[indent - 1]
-                last = indent == len(self.fields)
-
-                for val, rows in groupby(rows, lambda r: getattr(r, field)):
-                    # this is used to calculate the column id
-                    new_values = field_values + [val]
-                    col_id = self.column_id(new_values)
-
-                    self.columns[col_id] = {
-                        'name': capitalize(val) + ('' if last else ':'),
-                        'indent': 0 if col_id == self.total_column else indent,
-                    }
-
-                    if not last:
-                        permute(indent + 1, new_values, rows)
-
-            permute(1, [], rows)
-        finally:
-            session.close()
+        entry = get_table_manifest().get('field_tables', {}).get(self.id)
+        if entry and entry['fields'] == self.fields:
+            rows = [[_str(v) for v in row] for row in entry['permutations']]
+        else:
+            # sync_tables creates the table and adds it to the manifest, don't
+            # touch the database while we're being imported
+            log.error("Table %s isn't in the table manifest, it has no columns. "
+                      "Run manage.py sync_tables to add it." % self.id)
+            rows = []
+
+        def permute(indent, field_values, rows):
+            last = indent == len(self.fields)
+
+            for val, rows in groupby(rows, lambda r: r[indent - 1]):
+                # this is used to calculate the column id
+                new_values = field_values + [val]
+                col_id = self.column_id(new_values)
+
+                self.columns[col_id] = {
+                    'name': capitalize(val) + ('' if last else ':'),
+                    'indent': 0 if col_id == self.total_column else indent,
+                }
+
+                if not last:
+                    permute(indent + 1, new_values, rows)
+
+        permute(1, [], rows)
+
+    def get_permutations(self, session):
+        """ Get the distinct permutations of the values of our fields, in order.
+        """
+        model = self.get_model('country')
+        fields = [getattr(model, f) for f in self.fields]
+
+        return session\
+            .query(*fields)\
+            .order_by(*fields)\
+            .distinct()\
+            .all()
+
+    def create_tables(self, session):
+        """ Create the underlying database tables, if they don't exist.
+        """
+        if self.table_per_level:
+            models = self.models.values()
+        else:
+            models = [self.model]
+
+        for model in models:
+            model.__table__.create(session.get_bind(), checkfirst=True)
+
+    def manifest_entry(self, session):
+        return {
+            'fields': self.fields,
+            'total_column': self.total_column,
+            'permutations': [list(row) for row in self.get_permutations(session)],
+        }
 
     def column_id(self, field_values):
         return '-'.join(field_values)
 
-    def raw_data_for_geos(self, geos):
+    def raw_data_queries(self, geo_codes):
         """
-        Pull raw data for a list of geo models.
-
-        Returns a dict mapping the geo ids to table data.
+        Split +geo_codes+ into the parts that can each be fetched with a single
+        query: one per level if there's a table for each level, otherwise
+        everything at once.
         """
-        data = {}
+        if self.table_per_level:
+            return [OrderedDict([(geo_level, codes)]) for geo_level, codes in geo_codes.iteritems()]
+        return [geo_codes]
 
-        # group by geo level
-        geos = sorted(geos, key=lambda g: g.level)
-        for geo_level, geos in groupby(geos, lambda g: g.level):
+    def query_raw_data(self, session, geo_codes):
+        """
+        Fetch the rows for +geo_codes+, one of the parts returned by
+        `raw_data_queries`.
+
+        The values for every column in the table, including the subtotal
+        for each prefix of our fields and the grand total, are summed by
+        the database with a ROLLUP over our fields. Each row's +grouping+
+        has a bit set for each field it's been summed over, and +denominator+
+        is the sum of the rows for the +denominator_key+, if any.
+        """
+        if self.table_per_level:
+            (geo_level, codes), = geo_codes.items()
             model = self.get_model(geo_level)
-            geo_codes = [g.code for g in geos]
+            code_attr = getattr(model, '%s_code' % geo_level)
+            geo_attrs = [code_attr]
+            where = code_attr.in_(codes)
+        else:
+            model = self.model
+            code_attr = model.geo_code
+            geo_attrs = [model.geo_level, code_attr]
+            where = or_(*[and_(model.geo_level == geo_level, code_attr.in_(codes))
+                          for geo_level, codes in geo_codes.iteritems()])
+
+        fields = [getattr(model, f) for f in self.fields]
+
+        sums = [func.sum(model.total).label('total')]
+        if self.denominator_key:
+            sums.append(func.sum(case([(fields[-1] == self.denominator_key, model.total)], else_=0))
+                        .label('denominator'))
+
+        return session\
+            .query(code_attr.label('geo_code'),
+                   func.grouping(*fields).label('grouping'),
+                   *(sums + geo_attrs[:-1] + fields))\
+            .filter(where)\
+            .group_by(*(geo_attrs + [func.rollup(*fields)]))\
+            .all()
+
+    def build_raw_data(self, geo_codes, rows):
+        """
+        Build the table data for each geography in +geo_codes+ from +rows+, as
+        returned by `query_raw_data`.
 
-            if self.table_per_level:
-                code = '%s_code' % geo_level
-            else:
-                code = 'geo_code'
-            code_attr = getattr(model, code)
+        Returns a dict mapping the geo ids to table data.
+        """
+        data = {}
 
-            # initial values
-            for geo_code in geo_codes:
+        # initial values
+        for geo_level, codes in geo_codes.iteritems():
+            for geo_code in codes:
                 data['%s-%s' % (geo_level, geo_code)] = {
                     'estimate': {},
                     'error': {}}
 
-            session = get_session()
-            try:
-                geo_values = None
-                fields = [getattr(model, f) for f in self.fields]
-                rows = session\
-                    .query(code_attr,
-                           func.sum(model.total).label('total'),
-                           *fields)\
-                    .group_by(code_attr, *fields)\
-                    .order_by(code_attr, *fields)\
-                    .filter(code_attr.in_(geo_codes))
-
-                if not self.table_per_level:
-                    rows = rows.filter(model.geo_level == geo_level)
-
-                rows = rows.all()
-
-                def permute(level, field_keys, rows):
-                    field = self.fields[level]
-                    total = 0
-                    denominator = 0
-
-                    for key, rows in groupby(rows, lambda r: getattr(r, field)):
-                        new_keys = field_keys + [key]
-                        col_id = self.column_id(new_keys)
-
-                        if level + 1 < len(self.fields):
-                            count = permute(level + 1, new_keys, rows)
-                        else:
-                            # we've bottomed out
-                            count = sum(row.total for row in rows)
-
-                            if self.denominator_key and self.denominator_key == key:
-                                # this row must be used as the denominator total,
-                                # rather than as an entry in the table
-                                denominator = count
-                                continue
-
-                        total += count
-                        geo_values['estimate'][col_id] = count
-                        geo_values['error'][col_id] = 0
-
-                    if self.denominator_key:
-                        total = denominator
-
-                    return total
-
-                # rows for each geo
-                for geo_code, geo_rows in groupby(rows, lambda r: getattr(r, code)):
-                    geo_values = data['%s-%s' % (geo_level, geo_code)]
-                    total = permute(0, [], geo_rows)
-
-                    # total
-                    geo_values['estimate'][self.total_column] = total
-                    geo_values['error'][self.total_column] = 0
-
-            finally:
-                session.close()
+        if self.table_per_level:
+            geo_level = geo_codes.keys()[0]
+            geo_id = lambda r: '%s-%s' % (geo_level, r.geo_code)
+        else:
+            geo_id = lambda r: '%s-%s' % (r.geo_level, r.geo_code)
+
+        n_fields = len(self.fields)
+
+        for row in rows:
+            geo_values = data[geo_id(row)]
+
+            # the number of fields this row is for, the rest have been
+            # summed over
+            depth = n_fields - bin(row.grouping).count('1')
+
+            if depth == 0:
+                col_id = self.total_column
+            else:
+                keys = [getattr(row, f) for f in self.fields[:depth]]
+                if depth == n_fields and self.denominator_key == keys[-1]:
+                    # this row is used as the denominator total,
+                    # rather than as an entry in the table
+                    continue
+                col_id = self.column_id(keys)
+
+            if depth < n_fields and self.denominator_key:
+                count = row.denominator
+            else:
+                count = row.total
+
+            geo_values['estimate'][col_id] = count
+            geo_values['error'][col_id] = 0
 
         return data
 
@@ -546,13 +701,6 @@ class FieldTable(SimpleTable):
             __table__ = Table(table_name, Base.metadata, *table_args)
         _census_table_models[table_name] = Model
 
-        # ensure it exists in the DB
-        session = get_session()
-        try:
-            Model.__table__.create(session.get_bind(), checkfirst=True)
-        finally:
-            session.close()
-
         return Model
 
     def _table_name(self, geo_level=None):
@@ -608,6 +756,50 @@ def get_model_from_fields(fields, geo_level, table_name=None, table_dataset=None
     return table.get_model(geo_level)
 
 
+def sync_table_manifest(path=None):
+    """ Create any missing field tables in the database, then read the
+    columns of every data table from the database and write them to the
+    table manifest at +path+ (default: `TABLE_MANIFEST_FILE`).
+
+    :return: the manifest
+    """
+    path = path or TABLE_MANIFEST_FILE
+
+    manifest = {
+        'format': MANIFEST_FORMAT,
+        'data_version': get_data_version(),
+        'field_tables': {},
+        'simple_tables': {},
+    }
+
+    session = get_session()
+    try:
+        for table in DATA_TABLES.itervalues():
+            if isinstance(table, FieldTable):
+                table.create_tables(session)
+                manifest['field_tables'][table.id] = table.manifest_entry(session)
+            else:
+                manifest['simple_tables'][table.id] = table.manifest_entry(session)
+    finally:
+        session.close()
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.rename(tmp_path, path)
+
+    return manifest
+
+
+def geo_codes_by_level(geos):
+    """ Map each geo level in +geos+ to the codes of the geos at that level.
+    """
+    geo_codes = OrderedDict()
+    for geo in sorted(geos, key=lambda g: g.level):
+        geo_codes.setdefault(geo.level, []).append(geo.code)
+    return geo_codes
+
+
 def get_table_id(fields):
     sorted_fields = sorted(fields)
     table_id = TABLE_BAD_CHARS.sub('', '_'.join(sorted_fields))
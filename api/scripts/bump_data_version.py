@@ -0,0 +1,19 @@
+import os
+import sys
+
+sys.path.append(os.path.dirname(__file__) + "/../../")
+
+from api.utils import bump_data_version
+
+"""
+Record that the data in the database has changed, so that anything derived
+from the old data (cached profiles, downloads, ETags) is no longer used.
+
+The loader scripts do this themselves, run this after changing the data
+any other way:
+
+    python api/scripts/bump_data_version.py
+"""
+
+if __name__ == '__main__':
+    print 'Data version is now %s' % bump_data_version()
@@ -1,133 +1,247 @@
+import argparse
+import os
 import sys
+import time
+from multiprocessing.pool import ThreadPool
 
-from sqlalchemy import func
+from sqlalchemy.sql.expression import text
 
-from api.models import (Votes, VoteSummary, Municipality, Province, Ward,
-                        District, Base)
-from api.utils import get_session, _engine
+from api.models import Votes, VoteSummary, Base
+from api.utils import _engine
 
 
-def apply_votes_filters(query, election, ballot_type):
-    '''
-    Limits Votes query to only include records for the specified
-    election and ballot type.
-    '''
-    return query.filter(Votes.ballot_type == ballot_type) \
-                .filter(Votes.electoral_event == election)
+"""
+Computes the summary of an election's results for every ward, municipality,
+district and province, and the country, and stores it in the votesummary
+table, replacing any summary the election already has.
 
+Each voting district's figures (registered voters, total votes, etc.) are
+repeated on its rows for every party, so they're first taken once per
+voting district, and per ballot type where they differ by ballot. These,
+and the parties' votes, are then summed with a ROLLUP over province,
+district, municipality and ward, which gives the totals at every level in
+one pass. The summary is computed and inserted by a single statement.
 
-def apply_geo_filters(query, geo_code, geo_level):
-    '''
-    Limits Votes query to only include records for the specified
-    ward, municipality, district or province. If geo_level is 'country'
-    the query is returned as is.
+With --jobs, each province is summarised separately, several at a time,
+and the country by its own statement with a plain GROUP BY. They're written
+to a staging table, and only once they've all succeeded is the election's
+summary replaced, in one transaction.
+"""
+
+# the levels summed over by the ROLLUP, narrowest first, and the code
+# column for each
+GEO_COLUMNS = [
+    ('ward', 'ward_code'),
+    ('municipality', 'municipality_code'),
+    ('district', 'district_code'),
+    ('province', 'province_code'),
+]
+
+SUMMARY_COLUMNS = ['geo_level', 'geo_code', 'electoral_event', 'party', 'ballot_type', 'registered_voters',
+                   'total_votes', 'mec7_votes', 'section_24a_votes', 'special_votes', 'valid_votes',
+                   'spoilt_votes', 'average_voter_turnout']
+
+
+def geo_expressions(country_only=False):
     '''
-    try:
-        if geo_level == 'country':
-            return query
+    The geo_level and geo_code columns for a row of the ROLLUP, and the
+    ROLLUP to group by. The grouping() of the code columns, widest first,
+    has a bit set for each level that's been summed over, so a
+    municipality's rows have 1, a district's 3 and so on.
 
-        field_name = {
-            'ward': 'ward_code',
-            'province': 'province_code',
-            'municipality': 'municipality_code',
-            'district': 'district_code',
-        }[geo_level]
-        return query.filter(getattr(Votes, field_name) == geo_code)
+    If +country_only+, everything is summed for the country, and there's
+    nothing to group by.
+    '''
+    if country_only:
+        return "'country' AS geo_level, 'ZA' AS geo_code", None
 
-    except KeyError:
-        raise ValueError('Invalid geo_level: %s' % geo_level)
+    codes = ', '.join(column for level, column in reversed(GEO_COLUMNS))
+    grouping = 'grouping(%s)' % codes
 
+    levels = ' '.join("WHEN %d THEN '%s'" % (2 ** i - 1, level) for i, (level, column) in enumerate(GEO_COLUMNS))
+    columns = ' '.join("WHEN %d THEN %s" % (2 ** i - 1, column) for i, (level, column) in enumerate(GEO_COLUMNS))
 
-def clean_str(var):
-    out = '\N'
-    if var:
-        out = str(var)
-    return out
+    return ("CASE %s %s ELSE 'country' END AS geo_level, CASE %s %s ELSE 'ZA' END AS geo_code"
+            % (grouping, levels, grouping, columns),
+            'ROLLUP(%s)' % codes)
 
-if __name__ == '__main__':
-    if len(sys.argv) != 2:
-        raise ValueError("Requires 'electoral event' argument")
-    election = sys.argv[1]
 
+def summary_statement(province=None, country_only=False, table=None):
+    '''
+    The statement that inserts the summary of an election into +table+
+    (the votesummary table by default), for the geographies in +province+
+    if it's given, or only the country if +country_only+, otherwise for all
+    geographies.
+    '''
+    geo, rollup = geo_expressions(country_only)
+    codes = ', '.join(column for level, column in reversed(GEO_COLUMNS))
+
+    def group_by(*columns):
+        columns = list(columns) + ([rollup] if rollup else [])
+        return 'GROUP BY %s' % ', '.join(columns) if columns else ''
+
+    return text('''
+        WITH event_votes AS (
+            SELECT * FROM %(votes)s
+            WHERE electoral_event = :election %(province_filter)s
+        ),
+        voting_districts AS (
+            SELECT %(codes)s, voting_district_code,
+                max(registered_voters) AS registered_voters,
+                max(total_votes) AS total_votes,
+                max(mec7_votes) AS mec7_votes,
+                max(section_24a_votes) AS section_24a_votes,
+                max(special_votes) AS special_votes
+            FROM event_votes
+            GROUP BY %(codes)s, voting_district_code
+        ),
+        voting_district_ballots AS (
+            SELECT %(codes)s, voting_district_code, ballot_type,
+                max(total_votes) AS total_votes,
+                max(spoilt_votes) AS spoilt_votes
+            FROM event_votes
+            GROUP BY %(codes)s, voting_district_code, ballot_type
+        ),
+        geo_voters AS (
+            SELECT %(geo)s,
+                sum(registered_voters) AS registered_voters,
+                sum(total_votes) AS total_votes,
+                sum(mec7_votes) AS mec7_votes,
+                sum(section_24a_votes) AS section_24a_votes,
+                sum(special_votes) AS special_votes
+            FROM voting_districts
+            %(voters_group_by)s
+        ),
+        geo_ballots AS (
+            SELECT %(geo)s, ballot_type,
+                sum(total_votes) AS total_votes,
+                sum(spoilt_votes) AS spoilt_votes
+            FROM voting_district_ballots
+            %(ballots_group_by)s
+        ),
+        geo_parties AS (
+            SELECT %(geo)s, ballot_type, party,
+                sum(valid_votes) AS valid_votes
+            FROM event_votes
+            %(parties_group_by)s
+        )
+        INSERT INTO %(summary)s (%(summary_columns)s)
+        SELECT p.geo_level, p.geo_code, :election, p.party, p.ballot_type,
+            v.registered_voters,
+            b.total_votes,
+            -- mec7 votes only count for PR ballots
+            CASE WHEN p.ballot_type = 'PR' THEN v.mec7_votes END,
+            v.section_24a_votes,
+            v.special_votes,
+            p.valid_votes,
+            b.spoilt_votes,
+            round(100.0 * (v.total_votes + coalesce(v.mec7_votes, 0)) / nullif(v.registered_voters, 0), 2)
+        FROM geo_parties p
+        JOIN geo_voters v
+            ON v.geo_level = p.geo_level AND v.geo_code = p.geo_code
+        JOIN geo_ballots b
+            ON b.geo_level = p.geo_level AND b.geo_code = p.geo_code
+            AND b.ballot_type IS NOT DISTINCT FROM p.ballot_type
+        -- eg. metros aren't in a district
+        WHERE p.geo_code IS NOT NULL %(level_filter)s
+    ''' % {
+        'votes': Votes.__table__.name,
+        'summary': table or VoteSummary.__table__.name,
+        'summary_columns': ', '.join(SUMMARY_COLUMNS),
+        'codes': codes,
+        'geo': geo,
+        'voters_group_by': group_by(),
+        'ballots_group_by': group_by('ballot_type'),
+        'parties_group_by': group_by('ballot_type', 'party'),
+        'province_filter': 'AND province_code = :province' if province else '',
+        # the country is summarised separately when we're split by province
+        'level_filter': "AND p.geo_level != 'country'" if province else '',
+    })
+
+
+def summarise(election, province, table):
+    ''' Insert the summary for +province+, or for the country if it's None,
+    into +table+. '''
+    start = time.time()
+
+    with _engine.begin() as conn:
+        if province:
+            result = conn.execute(summary_statement(province, table=table), election=election, province=province)
+        else:
+            result = conn.execute(summary_statement(country_only=True, table=table), election=election)
+
+    sys.stderr.write('%s: %d rows (%.1fs)\n' % (province or 'country', result.rowcount, time.time() - start))
+    return result.rowcount
+
+
+def compute_summary(election, jobs=1):
     Base.metadata.create_all(_engine, tables=[VoteSummary.__table__])
+    delete = text('DELETE FROM %s WHERE electoral_event = :election' % VoteSummary.__table__.name)
 
-    session = get_session()
+    if jobs <= 1:
+        # replace the summary in one transaction
+        with _engine.begin() as conn:
+            conn.execute(delete, election=election)
+            rows = conn.execute(summary_statement(), election=election).rowcount
+        return rows
 
-    try:
-        total = (1 + session.query(Province).count() + session.query(District).count() + \
-            session.query(Municipality).count() + session.query(Ward).count()) * 3
-        counter = 0.0
-
-        sys.stdout.write('COPY votesummary (geo_level, geo_code, electoral_event, party, '
-                         'ballot_type, registered_voters, total_votes, mec7_votes, section_24a_votes, special_votes, '
-                         'valid_votes, spoilt_votes, average_voter_turnout) FROM stdin;\n')
-
-        for geo_model in (None, Province, District, Municipality, Ward):
-            if geo_model is None:
-                level = 'country'
-                codes = [('ZA', )]
-            else:
-                level = geo_model.level
-                codes = session.query(geo_model.code).all()
-
-            votes_by_party = session \
-                    .query(Votes.party, func.sum(Votes.valid_votes).label('vote_sum')) \
-                    .group_by(Votes.party)
-            subquery = session \
-                    .query(Votes.total_votes, Votes.spoilt_votes) \
-                    .distinct(Votes.voting_district_code)
-
-            for code in codes:
-                code = code[0]
-                votes_by_party_geo = apply_geo_filters(votes_by_party, code, level)
-                subquery_geo = apply_geo_filters(subquery, code, level)
-
-                sq = session \
-                        .query(func.max(Votes.registered_voters).label('max_rv'),
-                               func.max(Votes.total_votes).label('max_tv'),
-                               func.max(Votes.mec7_votes).label('max_mv'),
-                               func.max(Votes.section_24a_votes).label('max_section_24a_votes'),
-                               func.max(Votes.special_votes).label('max_special_votes')) \
-                        .group_by(Votes.voting_district_code) \
-                        .filter(Votes.electoral_event == election)
-                sq = apply_geo_filters(sq, code, level).subquery()
-                registered_voters, total_votes, mec7_votes, section_24a_votes, special_votes = session \
-                        .query(func.sum(sq.c.max_rv),
-                               func.sum(sq.c.max_tv),
-                               func.sum(sq.c.max_mv),
-                               func.sum(sq.c.max_section_24a_votes),
-                               func.sum(sq.c.max_special_votes)) \
-                        .one()
-                tmp = total_votes
-                if mec7_votes:
-                    tmp += mec7_votes
-                voter_turnout = round(float(tmp)
-                                      / registered_voters * 100, 2)
-
-                ballot_types = (None,)
-                if election == "municipal 2011":
-                    ballot_types = ('WARD', 'PR', 'DC 40%')
-                for ballot in ballot_types:
-                    vbp = apply_votes_filters(votes_by_party_geo, election, ballot)
-                    sq = apply_votes_filters(subquery_geo, election, ballot).subquery()
-                    total_votes, spoilt_votes = \
-                            session.query(func.sum(sq.c.total_votes),
-                                          func.sum(sq.c.spoilt_votes)) \
-                                   .one()
-                    mec7 = mec7_votes if ballot == 'PR' else 0
-
-                    for party, votes in vbp:
-                        sys.stdout.write('%s\n' % '\t'.join(map(
-                            clean_str,
-                            [level, code, election, party, ballot, registered_voters,
-                             total_votes, mec7, section_24a_votes, special_votes, votes, spoilt_votes, voter_turnout]
-                        )))
-                    counter += 1
-                    sys.stderr.write('\r%d / %d' % (counter, total))
-                    sys.stderr.flush()
-
-        sys.stdout.write('\.\n')
-        sys.stderr.write('\nDone\n')
+    summary = VoteSummary.__table__.name
+    staging = '%s_staging_%d' % (summary, os.getpid())
+    columns = ', '.join(SUMMARY_COLUMNS)
+
+    with _engine.begin() as conn:
+        provinces = [code for code, in conn.execute(
+            text('SELECT DISTINCT province_code FROM %s WHERE electoral_event = :election'
+                 ' AND province_code IS NOT NULL' % Votes.__table__.name),
+            election=election)]
+
+    with _engine.begin() as conn:
+        conn.execute(text('CREATE UNLOGGED TABLE %s (LIKE %s INCLUDING DEFAULTS)' % (staging, summary)))
 
+    try:
+        # None is the country
+        pool = ThreadPool(min(jobs, len(provinces) + 1))
+        try:
+            pool.map(lambda province: summarise(election, province, staging), [None] + provinces)
+        finally:
+            pool.close()
+
+        # only replace the summary once every part has succeeded
+        with _engine.begin() as conn:
+            conn.execute(delete, election=election)
+            rows = conn.execute(text('INSERT INTO %s (%s) SELECT %s FROM %s'
+                                     % (summary, columns, columns, staging))).rowcount
     finally:
-        session.close()
+        with _engine.begin() as conn:
+            conn.execute(text('DROP TABLE IF EXISTS %s' % staging))
+
+    return rows
+
+
+def create_arg_parser():
+    parser = argparse.ArgumentParser(
+        description='Computes the summary of an election for every geography and stores it '
+                    'in the votesummary table, replacing any existing summary for it.'
+    )
+    parser.add_argument(
+        'election',
+        action='store',
+        help="the electoral event, eg. 'municipal 2011'"
+    )
+    parser.add_argument(
+        '--jobs',
+        action='store',
+        dest='jobs',
+        type=int,
+        default=1,
+        help='the number of provinces to summarise at once'
+    )
+    return parser
+
+
+if __name__ == '__main__':
+    args = create_arg_parser().parse_args()
+
+    start = time.time()
+    rows = compute_summary(args.election, args.jobs)
+    sys.stderr.write('Stored %d summary rows in %.1fs\n' % (rows, time.time() - start))
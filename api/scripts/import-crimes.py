@@ -6,7 +6,7 @@ import csv
 import re
 
 from api.models import Base, Province, PoliceDistrict, geo_levels
-from api.utils import get_session, _engine
+from api.utils import get_session, _engine, bump_data_version
 from api.models.tables import get_datatable
 
 import logging
@@ -127,3 +127,4 @@ if __name__ == '__main__':
         importer.import_districts()
     else:
         importer.import_crimes()
+    bump_data_version()
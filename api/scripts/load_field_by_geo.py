@@ -1,14 +1,20 @@
 import argparse
 import os
 import sys
+import tempfile
+import time
+from multiprocessing.pool import ThreadPool
 
 import csv
 import re
 
 sys.path.append(os.path.dirname(__file__) + "/../../")
 
-from api.models import get_model_from_fields, Base, Province
-from api.utils import get_session, _engine
+from sqlalchemy import Table, Column, MetaData, PrimaryKeyConstraint, ForeignKeyConstraint
+from sqlalchemy.schema import CreateTable, AddConstraint, CreateIndex
+
+from api.models import get_model_from_fields, Province
+from api.utils import get_session, _engine, bump_data_version, copy_line, copy_from
 
 import logging
 
@@ -19,21 +25,57 @@ logging.getLogger('sqlalchemy.engine').setLevel(logging.WARN)
 This is a helper script that reads in a SuperCROSS or SuperWEB
 CSV file and imports the data into the Wazi database, creating
 tables as necessary.
+
+The rows for each geo level are written to a temporary file in COPY
+format as the CSV is read, and then each file is loaded with a single
+COPY. New tables are created without their primary key, foreign key and
+indexes, which are added once the data is in.
 """
 
 muni_re = re.compile('^[A-Z]{3}: .*')
 
+# report progress after this many geographies
+PROGRESS_ROWS = 1000
+
+
+class LevelBuffer(object):
+    """ The rows for one geo level of +table+, in COPY format
+    in a temporary file. """
+
+    def __init__(self, geo_level, table, fields):
+        self.geo_level = geo_level
+        self.table = table
+        self.file = tempfile.TemporaryFile()
+        self.count = 0
+
+        # tables for all levels identify the geography by level and code
+        if 'geo_level' in table.c:
+            self.geo_columns = ['geo_level', 'geo_code']
+        else:
+            self.geo_columns = ['%s_code' % geo_level]
+        self.columns = self.geo_columns + fields + ['total']
+
+    def add(self, geo_code, category, total):
+        geo_values = [self.geo_level, geo_code] if len(self.geo_columns) == 2 else [geo_code]
+        self.file.write(copy_line(geo_values + list(category) + [total]))
+        self.count += 1
+
+
 class SuperImporter(object):
-    def __init__(self, filepath):
+    def __init__(self, filepath, jobs=1):
         self.filepath = filepath
         self.includes_total = False
         self.table_name = None
+        # number of tables to load at once
+        self.jobs = jobs
 
     def run(self):
-        with open(filepath) as f:
+        with open(self.filepath) as f:
             self.f = f
             self.read_headers()
-            self.store_values()
+            buffers = self.store_values()
+
+        self.load_buffers(buffers)
         
     def read_headers(self):
         line = next(self.f)
@@ -186,57 +228,113 @@ class SuperImporter(object):
 
 
     def store_values(self):
+        """
+        Write the values for each geo level to a temporary file in COPY
+        format, returning a map from geo level to a `LevelBuffer`.
+        """
         session = get_session()
         province_codes = dict((p.name, p.code) for p in session.query(Province))
-        session.commit()
+        session.close()
 
-        # cache of the db models for each geo level
-        models = {}
+        buffers = {}
         count = 0
+        start = time.time()
 
         for geo_name, values in self.read_rows():
             count += 1
             geo_level = self.determine_level(geo_name)
 
-            print geo_level, geo_name
-
             if geo_level == 'province':
                 code = province_codes[geo_name]
             elif geo_level == 'country':
                 code = 'ZA'
             else:
                 code = geo_name.split(':')[0]
-            base_kwargs = {'%s_code' % geo_level: code}
 
-            # get db model and create table if necessary
-            if geo_level in models:
-                db_model = models[geo_level]
-            else:
+            # get db model and buffer for this level
+            if geo_level not in buffers:
                 if self.table_name:
                     table_name = self.table_name + '_' + geo_level
                 else:
                     table_name = None
 
-                models[geo_level] = db_model = get_model_from_fields(self.fields, geo_level, table_name)
-                Base.metadata.create_all(_engine, tables=[db_model.__table__])
+                db_model = get_model_from_fields(self.fields, geo_level, table_name)
+                buffers[geo_level] = LevelBuffer(geo_level, db_model.__table__, self.fields)
 
+            buf = buffers[geo_level]
             for category, value in zip(self.categories, values):
-                # prepare the dict of args to pass to the db model for this row
-                kwargs = base_kwargs.copy()
-                if value.strip() == '-':
+                value = value.strip()
+                if value == '-':
                     value = '0'
 
-                kwargs.update(dict((f, v) for f, v in zip(self.fields, category)))
-                kwargs['total'] = int(value.replace(',', ''))
+                buf.add(code, category, int(value.replace(',', '')))
 
-                # create and add the row
-                session.add(db_model(**kwargs))
+            if count % PROGRESS_ROWS == 0:
+                print "Read %d geographies (%.1fs)" % (count, time.time() - start)
 
-            if count % 100 == 0:
-                session.flush()
+        print "Read %d geographies (%.1fs)" % (count, time.time() - start)
+        return buffers
 
-        session.commit()
-        session.close()
+    def load_buffers(self, buffers):
+        """ Load the buffered values with COPY, +jobs+ tables at a time. """
+        # levels that share a table are loaded together
+        tables = {}
+        for buf in buffers.itervalues():
+            tables.setdefault(buf.table.name, []).append(buf)
+        tables = tables.values()
+
+        if self.jobs > 1 and len(tables) > 1:
+            pool = ThreadPool(min(self.jobs, len(tables)))
+            try:
+                pool.map(self.load_table, tables)
+            finally:
+                pool.close()
+        else:
+            for bufs in tables:
+                self.load_table(bufs)
+
+    def load_table(self, buffers):
+        table = buffers[0].table
+        start = time.time()
+
+        conn = _engine.raw_connection()
+        try:
+            cursor = conn.cursor()
+
+            # a new table is loaded before its constraints and indexes
+            # are added, which is much faster than maintaining them row
+            # by row
+            created = not _engine.has_table(table.name)
+            if created:
+                cursor.execute(self.compile(CreateTable(self.bare_table(table))))
+
+            for buf in buffers:
+                buf.file.seek(0)
+                copy_from(cursor, table.name, buf.columns, buf.file)
+                print "Copied %d %s rows into %s (%.1fs)" % (buf.count, buf.geo_level, table.name,
+                                                              time.time() - start)
+
+            if created:
+                for constraint in table.constraints:
+                    if isinstance(constraint, (PrimaryKeyConstraint, ForeignKeyConstraint)):
+                        cursor.execute(self.compile(AddConstraint(constraint)))
+                for index in table.indexes:
+                    cursor.execute(self.compile(CreateIndex(index)))
+                print "Added constraints and indexes to %s (%.1fs)" % (table.name, time.time() - start)
+
+            conn.commit()
+        finally:
+            for buf in buffers:
+                buf.file.close()
+            conn.close()
+
+    def bare_table(self, table):
+        """ A copy of +table+ without constraints or indexes. """
+        return Table(table.name, MetaData(),
+                     *[Column(c.name, c.type, nullable=c.nullable) for c in table.columns])
+
+    def compile(self, ddl):
+        return unicode(ddl.compile(dialect=_engine.dialect))
 
     def determine_level(self, geo_name):
         if geo_name == "":
@@ -272,6 +370,14 @@ def create_arg_parser():
         help='the name of the database table where the imported data will be stored. '
              'If not provided, it is generated from the field names'
     )
+    parser.add_argument(
+        '--jobs',
+        action='store',
+        dest='jobs',
+        type=int,
+        default=1,
+        help='the number of geo levels to load at once'
+    )
     return parser
 
 
@@ -282,7 +388,8 @@ if __name__ == '__main__':
     if not os.path.isabs(filepath):
         filepath = os.path.join(os.getcwd(), filepath)
 
-    importer = SuperImporter(filepath)
+    importer = SuperImporter(filepath, jobs=args.jobs)
     importer.table_name = args.tablename
     importer.run()
+    bump_data_version()
 
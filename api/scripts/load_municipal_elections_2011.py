@@ -3,26 +3,27 @@ import sys
 
 import unicodecsv as csv
 
-from api.models import Municipality, Province, Votes, Base
-from api.utils import get_session, _engine
+from api.utils import get_session, bump_data_version
+from api.votes_loader import GeoLookups, VotesLoader
 
 
-def parse_integer(val, s):
+def parse_integer(val, geos):
     return int(val.replace(',', ''))
 
 
 field_mapper = {
     "Electoral Event": (
         'electoral_event',
-        lambda val, s: 'municipal 2011'
+        lambda val, geos: 'municipal 2011'
     ),
     "Province": (
         'province_code',
-        lambda val, s: s.query(Province).filter(Province.name == val).one().code
+        # unknown names are kept, to be reported by the validation
+        lambda val, geos: geos.province_codes.get(val, val)
     ),
     "Municipality": (
         'municipality_code',
-        lambda val, s: s.query(Municipality).get(val.split('-', 1)[0].strip()).code
+        lambda val, geos: val.split('-', 1)[0].strip()
     ),
     "Ward": ('ward_code', None),
     "Voting \nDistrict": ('voting_district_code', None),
@@ -31,7 +32,7 @@ field_mapper = {
     "Registered\nVoters": ('registered_voters', parse_integer),
     "% Voter \nTurnout": (
         'voter_turnout',
-        lambda val, s: float(val.rstrip('%'))
+        lambda val, geos: float(val.rstrip('%'))
     ),
     "MEC7\nVotes": ('mec7_votes', parse_integer),
     "Total Votes \nCast": ('total_votes', parse_integer),
@@ -40,19 +41,17 @@ field_mapper = {
 }
 
 
-def open_elections_csv(filepath):
+def open_elections_csv(filepath, geos):
     f = open(filepath)
     reader = csv.DictReader(f)
-    session = get_session()
 
     for values in reader:
         mapped_values = dict((field_mapper[k][0],
-                              field_mapper[k][1](v, session)
+                              field_mapper[k][1](v, geos)
                               if field_mapper[k][1] is not None else v)
                               for k, v in values.iteritems())
         yield mapped_values
 
-    session.close()
     f.close()
 
 
@@ -63,23 +62,22 @@ if __name__ == '__main__':
     if not os.path.isabs(filepath):
         filepath = os.path.join(os.getcwd(), filepath)
 
-    # create table if necessary
-    Base.metadata.create_all(_engine, tables=[Votes.__table__])
     session = get_session()
+    geos = GeoLookups(session)
+    session.close()
 
+    loader = VotesLoader()
     total = 474395
-    for i, values in enumerate(open_elections_csv(filepath)):
-        values['district_code'] = session.query(Municipality) \
-                                         .get(values['municipality_code']) \
-                                         .district_code
+    for i, values in enumerate(open_elections_csv(filepath, geos)):
+        values['district_code'] = geos.district_codes.get(values['municipality_code'])
         values['section_24a_votes'] = None
         values['special_votes'] = None
-        session.add(Votes(**values))
-        if i % 1000 == 0:
-            session.flush()
+        loader.add(values)
+        if i % 10000 == 0:
             sys.stdout.write('\r%s of %s' % (i + 1, total))
             sys.stdout.flush()
 
-    print '\nDone'
-    session.commit()
-    session.close()
+    print '\nRead %d rows' % loader.count
+    loader.validate(geos)
+    print 'Loaded in %.1fs' % loader.load()
+    bump_data_version()
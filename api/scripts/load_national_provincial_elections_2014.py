@@ -3,9 +3,8 @@ import sys
 
 import unicodecsv as csv
 
-from api.models import Municipality, Province, Votes, Base
-from api.utils import get_session, _engine
-from sqlalchemy import or_
+from api.utils import get_session, bump_data_version
+from api.votes_loader import GeoLookups, VotesLoader
 
 
 def parse_integer(val):
@@ -72,10 +71,11 @@ if __name__ == '__main__':
     if not os.path.isabs(filepath):
         filepath = os.path.join(os.getcwd(), filepath)
 
-    # create table if necessary
-    Base.metadata.create_all(_engine, tables=[Votes.__table__])
     session = get_session()
+    geos = GeoLookups(session)
+    session.close()
 
+    loader = VotesLoader()
     with open(filepath) as f:
         reader = csv.DictReader(f, encoding='CP949')
 
@@ -86,27 +86,16 @@ if __name__ == '__main__':
                                   field_mapper[k][1](val)
                                   if field_mapper[k][1] is not None else val)
                                  for k, val in values.iteritems())
-            district_code = None
-            mapped_values['district_code'] = district_code
+            mapped_values['district_code'] = geos.district_codes.get(mapped_values['municipality_code'])
             mapped_values['mec7_votes'] = None
             mapped_values['ballot_type'] = None
-            session.add(Votes(**mapped_values))
-            if i % 1000 == 0:
-                session.flush()
+            loader.add(mapped_values)
+            if i % 10000 == 0:
                 sys.stdout.write('\r%s of %s' % (i + 1, total))
                 sys.stdout.flush()
             i += 1
 
-    print '\nDone'
-    session.commit()
-
-    # update district_code values
-    municipalities = session.query(Municipality).all()
-    for municipality in municipalities:
-        session.query(Votes) \
-            .filter(
-            or_(Votes.electoral_event=="2014 NATIONAL ELECTION", Votes.electoral_event=="2014 PROVINCIAL ELECTION")) \
-            .filter(Votes.municipality_code==municipality.code) \
-            .update({"district_code": municipality.district_code})
-    session.commit()
-    session.close()
+    print '\nRead %d rows' % loader.count
+    loader.validate(geos)
+    print 'Loaded in %.1fs' % loader.load()
+    bump_data_version()
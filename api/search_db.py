@@ -0,0 +1,124 @@
+from sqlalchemy import func, literal, select, union_all, case, or_, and_, desc
+from sqlalchemy.sql.expression import text
+
+from api.geo_index import get_geo_index
+from api.models import Subplace, Ward, get_geo_model
+from api.search_index import ORDER
+from api.utils import get_session
+
+
+'''
+Place search in a single Postgres query, for deployments where each process
+building its own in-memory index (see `api.search_index`) isn't wanted.
+
+The search at each level is one branch of a UNION ALL, and the results are
+ranked and limited together, so a search is one round trip. Names are also
+matched by trigram similarity, which tolerates typos. Trigram GIN indexes,
+created by `create_search_indexes`, let Postgres answer both the prefix
+and the similarity matches without scanning the tables.
+'''
+
+# (table, column) pairs with trigram indexes
+SEARCH_INDEXES = [
+    ('province', 'name'),
+    ('municipality', 'name'),
+    ('subplace', 'subplace_name'),
+    ('subplace', 'mainplace_name'),
+    ('ward', 'code'),
+]
+
+
+def create_search_indexes(session):
+    """ Create the pg_trgm extension and trigram indexes used by the search,
+    if they don't exist. Needs PostgreSQL 9.5 or later.
+    """
+    session.execute(text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+    for table, column in SEARCH_INDEXES:
+        session.execute(text('CREATE INDEX IF NOT EXISTS %s_%s_trgm ON %s USING gin (%s gin_trgm_ops)'
+                             % (table, column, table, column)))
+    session.commit()
+
+
+def similar(column, term):
+    # the pg_trgm similarity operator, escaped for psycopg2
+    return column.op('%%')(term)
+
+
+def level_query(level, search_term, year):
+    """ The query for places at +level+, with the columns: level, code,
+    name, rank, prefix (whether it's a prefix match) and similarity.
+    """
+    term = search_term.lower()
+    no_similarity = literal(0.0)
+
+    if level == 'ward':
+        st = search_term.lower().strip('ward').strip()
+        matches = [Ward.code.like(st + '%')]
+        try:
+            matches.append(Ward.ward_no == int(st))
+        except ValueError:
+            pass
+
+        return select([literal('ward').label('level'), Ward.code.label('code'), Ward.code.label('name'),
+                       literal(ORDER['ward']).label('rank'), literal(1).label('prefix'),
+                       no_similarity.label('similarity')])\
+            .where(and_(Ward.year == year, or_(*matches)))
+
+    if level == 'subplace':
+        # subplaces find their wards
+        prefix = or_(Subplace.subplace_name.ilike(term + '%'),
+                     Subplace.subplace_name.ilike('City of %s' % term + '%'),
+                     Subplace.mainplace_name.ilike(term + '%'),
+                     Subplace.code == search_term)
+        similarity = func.greatest(func.similarity(Subplace.subplace_name, term),
+                                   func.similarity(Subplace.mainplace_name, term))
+
+        return select([literal('ward').label('level'), Subplace.ward_code.label('code'),
+                       Subplace.ward_code.label('name'), literal(ORDER['ward']).label('rank'),
+                       case([(prefix, 1)], else_=0).label('prefix'), similarity.label('similarity')])\
+            .where(and_(Subplace.year == year,
+                        or_(prefix,
+                            similar(Subplace.subplace_name, term),
+                            similar(Subplace.mainplace_name, term))))
+
+    model = get_geo_model(level)
+    prefix = or_(model.name.ilike(term + '%'),
+                 model.name.ilike('City of %s' % term + '%'),
+                 model.code == search_term.upper())
+
+    return select([literal(level).label('level'), model.code.label('code'), model.name.label('name'),
+                   literal(ORDER.get(level, len(ORDER) + 1)).label('rank'),
+                   case([(prefix, 1)], else_=0).label('prefix'),
+                   func.similarity(model.name, term).label('similarity')])\
+        .where(and_(model.year == year, or_(prefix, similar(model.name, term))))
+
+
+def search_locations_postgres(search_term, levels, year, limit=10):
+    """
+    Search for places matching +search_term+ at each of +levels+, with one
+    query. Places are ranked by level, then prefix matches before similar
+    names, then by similarity and name.
+
+    :return: a list of `GeoRecord`s
+    """
+    search_term = search_term.strip()
+
+    places = union_all(*[level_query(level, search_term, year) for level in levels]).alias('places')
+
+    # a ward can be found more than once, eg. through its subplaces
+    query = select([places.c.level, places.c.code])\
+        .group_by(places.c.level, places.c.code, places.c.name, places.c.rank)\
+        .order_by(places.c.rank,
+                  desc(func.max(places.c.prefix)),
+                  desc(func.max(places.c.similarity)),
+                  places.c.name)\
+        .limit(limit)
+
+    session = get_session()
+    try:
+        rows = session.execute(query).fetchall()
+    finally:
+        session.close()
+
+    index = get_geo_index()
+    return filter(None, [index.get(level, code) for level, code in rows])
@@ -0,0 +1,194 @@
+import threading
+from bisect import bisect_left
+
+from api.geo_index import get_geo_index
+from api.models import Subplace
+from api.utils import get_session
+
+
+'''
+An in-memory index for searching places by name and code.
+
+Every keystroke in the place search autocomplete used to run a prefix query
+at each level, including a join from subplaces to wards. Place names only
+change when the data is reloaded, so instead each process builds this index
+once and answers searches from memory, with the same matching and ordering as
+the database search (`api.controller.geography.search_locations_db`):
+
+    - places match if their name starts with the search term, ignoring case,
+      or with "City of " and then the term, or if their code is the term
+    - wards match if their code starts with the term, or if the term is their
+      ward number, such as "ward 5"
+    - subplaces and mainplaces match as for names, but find the ward
+      they're in
+    - at most 10 places match at each level
+'''
+
+# results are ordered by level, then by name
+ORDER = {'province': 1, 'municipality': 2, 'ward': 3, 'country': 4}
+
+CITY_OF = 'city of '
+
+
+def name_keys(name):
+    """ The search keys for a place called +name+. """
+    key = name.lower()
+    yield key
+    if key.startswith(CITY_OF):
+        yield key[len(CITY_OF):]
+
+
+def sort_key(geo):
+    name = geo.name if geo.name is not None else geo.code
+    return [ORDER.get(geo.level, len(ORDER) + 1), name, geo.code]
+
+
+class PrefixIndex(object):
+    """ Records looked up by the prefixes of their keys. """
+
+    def __init__(self):
+        self.entries = []
+        self.keys = []
+
+    def add(self, key, record):
+        self.entries.append((key, record))
+
+    def freeze(self):
+        self.entries.sort(key=lambda e: (e[0], e[1].code))
+        self.keys = [key for key, record in self.entries]
+
+    def search(self, prefix):
+        """ Generate the records with a key that starts with +prefix+,
+        in key order.
+        """
+        for i in xrange(bisect_left(self.keys, prefix), len(self.keys)):
+            if not self.keys[i].startswith(prefix):
+                break
+            yield self.entries[i][1]
+
+
+class PlaceSearchIndex(object):
+    """
+    Searches the places in +geo_index+, a `GeoIndex`, and +subplaces+,
+    a list of (code, subplace name, mainplace name, ward code) tuples.
+    """
+
+    def __init__(self, geo_index, subplaces):
+        # map from level to a PrefixIndex of names
+        self.names = {}
+        # map from level to a map from code to records
+        self.codes = {}
+
+        for record in geo_index.records.itervalues():
+            if record.level == 'subplace':
+                continue
+
+            if record.level == 'ward':
+                # wards are found by code prefix, rather than name
+                names = [record.code]
+                code = None
+            else:
+                names = name_keys(record.name or '')
+                code = record.code.upper()
+
+            index = self.names.setdefault(record.level, PrefixIndex())
+            for key in names:
+                index.add(key, record)
+
+            if code is not None:
+                self.codes.setdefault(record.level, {}).setdefault(code, []).append(record)
+
+        self.ward_nos = {}
+        for ward in geo_index.at_level('ward'):
+            self.ward_nos.setdefault(ward.ward_no, []).append(ward)
+
+        # subplaces lead to their wards
+        index = self.names['subplace'] = PrefixIndex()
+        self.codes['subplace'] = {}
+        for code, subplace_name, mainplace_name, ward_code in subplaces:
+            ward = geo_index.get('ward', ward_code)
+            if ward is None:
+                continue
+
+            for key in name_keys(subplace_name):
+                index.add(key, ward)
+            index.add(mainplace_name.lower(), ward)
+            self.codes['subplace'].setdefault(code, []).append(ward)
+
+        for index in self.names.itervalues():
+            index.freeze()
+
+    def search(self, search_term, levels, year='2011', limit=10):
+        """ Search for places matching +search_term+ at each of +levels+,
+        returning at most +limit+ of them in total.
+        """
+        search_term = search_term.strip()
+        found = set()
+
+        for level in levels:
+            if level == 'ward':
+                st = search_term.lower().strip('ward').strip()
+                prefixes = [st]
+                exact = []
+                try:
+                    exact = self.ward_nos.get(int(st), [])
+                except ValueError:
+                    pass
+            elif level == 'subplace':
+                # "City of" names are also indexed without it
+                prefixes = [search_term.lower()]
+                exact = self.codes['subplace'].get(search_term, [])
+            else:
+                prefixes = [search_term.lower()]
+                exact = self.codes.get(level, {}).get(search_term.upper(), [])
+
+            found.update(self.first_matches(level, prefixes, exact, year, limit))
+
+        return sorted(found, key=sort_key)[0:limit]
+
+    def first_matches(self, level, prefixes, exact, year, limit):
+        matches = []
+        seen = set()
+
+        candidates = [exact]
+        index = self.names.get(level)
+        if index is not None:
+            candidates.extend(index.search(p) for p in prefixes)
+
+        for records in candidates:
+            for record in records:
+                if record.year != year or record.full_geoid in seen:
+                    continue
+                seen.add(record.full_geoid)
+                matches.append(record)
+                if len(matches) == limit:
+                    return matches
+
+        return matches
+
+
+def load_place_search_index(session, geo_index):
+    subplaces = session.query(Subplace.code, Subplace.subplace_name,
+                              Subplace.mainplace_name, Subplace.ward_code).all()
+    return PlaceSearchIndex(geo_index, subplaces)
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_place_search_index():
+    """ The place search index for this process, built on first use. """
+    global _index
+
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                geo_index = get_geo_index()
+                session = get_session()
+                try:
+                    _index = load_place_search_index(session, geo_index)
+                finally:
+                    session.close()
+
+    return _index
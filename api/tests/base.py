@@ -0,0 +1,31 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from api import utils
+
+
+class TempDirTestCase(unittest.TestCase):
+    """ A test case with a temporary directory, +root+, that's removed
+    after each test. """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+
+
+class DataVersionTestCase(TempDirTestCase):
+    """ A test case with its own data version file, at version 2011.1. """
+
+    def setUp(self):
+        super(DataVersionTestCase, self).setUp()
+        self.version_file = utils.DATA_VERSION_FILE
+        utils.DATA_VERSION_FILE = os.path.join(self.root, 'VERSION')
+        utils._data_version = None
+        with open(utils.DATA_VERSION_FILE, 'w') as f:
+            f.write('2011.1\n')
+
+    def tearDown(self):
+        utils.DATA_VERSION_FILE = self.version_file
+        utils._data_version = None
@@ -0,0 +1,20 @@
+from api.geo_index import GeoIndex, GeoRecord
+
+
+def sample_geo_index():
+    """ A small `GeoIndex`: two provinces, and two municipalities and
+    three wards in the Western Cape. """
+    return GeoIndex([
+        GeoRecord('country', 'province', code='ZA', name='South Africa', year='2011'),
+        GeoRecord('province', 'municipality', code='WC', name='Western Cape', year='2011'),
+        GeoRecord('province', 'municipality', code='GT', name='Gauteng', year='2011'),
+        GeoRecord('municipality', 'ward', code='CPT', name='City of Cape Town', year='2011',
+                  province_code='WC'),
+        GeoRecord('municipality', 'ward', code='WC044', name='George', year='2011', province_code='WC'),
+        GeoRecord('ward', code='19100001', ward_no=1, year='2011', municipality_code='CPT',
+                  province_code='WC'),
+        GeoRecord('ward', code='19100002', ward_no=2, year='2011', municipality_code='CPT',
+                  province_code='WC'),
+        GeoRecord('ward', code='10404001', ward_no=1, year='2011', municipality_code='WC044',
+                  province_code='WC'),
+    ])
@@ -0,0 +1,28 @@
+import json
+import math
+import struct
+import unittest
+
+from api.columnar import columnar_data, pack_columnar, BINARY_HEADER, ARRAY_HEADER
+
+
+class ColumnarTestCase(unittest.TestCase):
+    class Table(object):
+        id = 'population'
+        columns = {'total': {}}
+
+    def test_columnar(self):
+        data = {'ward-1': {'POPULATION': {'estimate': {'total': 10}, 'error': {'total': 0}}}}
+        columnar = columnar_data([self.Table()], ['ward-1', 'ward-2'], data)
+        self.assertEqual(columnar, {'POPULATION': {'columns': ['total'], 'estimate': [[10, None]]}})
+
+        packed = pack_columnar({'data': columnar}, ['POPULATION'])
+        magic, _, _, header_len, _ = BINARY_HEADER.unpack_from(packed)
+        header = json.loads(packed[BINARY_HEADER.size:BINARY_HEADER.size + header_len])
+        self.assertEqual(header['data']['POPULATION'], {'columns': ['total'], 'estimate': 1, 'error': False})
+
+        offset = BINARY_HEADER.size + header_len
+        count, _ = ARRAY_HEADER.unpack_from(packed, offset)
+        values = struct.unpack_from('<%dd' % count, packed, offset + ARRAY_HEADER.size)
+        self.assertEqual(values[0], 10)
+        self.assertTrue(math.isnan(values[1]))
@@ -0,0 +1,54 @@
+from api import utils
+from api.controller import utils as controller_utils
+from api.controller.utils import memoize_section, profile_section_cache, build_profile_sections
+from .base import DataVersionTestCase
+
+
+class MemoizeSectionTestCase(DataVersionTestCase):
+    def setUp(self):
+        super(MemoizeSectionTestCase, self).setUp()
+        profile_section_cache.clear()
+        self.calls = []
+
+        @memoize_section
+        def section(geo_code, geo_level, session=None):
+            self.calls.append(geo_code)
+            return {'values': {'this': geo_code}}
+        self.section = section
+
+    def test_cached_until_new_data(self):
+        self.assertEqual(self.section('WC', 'province'), {'values': {'this': 'WC'}})
+        self.section('WC', 'province')
+        self.section('1', 'ward')
+        self.section('1', 'ward')
+        self.assertEqual(self.calls, ['WC', '1', '1'])
+        self.assertEqual(profile_section_cache.stats()['size'], 1)
+
+        utils.bump_data_version()
+        self.assertEqual(profile_section_cache.stats()['size'], 0)
+        self.section('WC', 'province')
+        self.assertEqual(self.calls, ['WC', '1', '1', 'WC'])
+
+    def test_plans_only_missed_geos(self):
+        planned = []
+
+        class Planner(object):
+            def __init__(self, geos):
+                planned.append(geos)
+
+        self.addCleanup(setattr, controller_utils, 'QueryPlanner', controller_utils.QueryPlanner)
+        controller_utils.QueryPlanner = Planner
+
+        sections = [('section', self.section, [])]
+        summary_levels = [('province', 'WC'), ('country', 'ZA')]
+        data = build_profile_sections(sections, '1', 'ward', summary_levels)
+        self.assertEqual(data['section'], {'values': {'this': '1', 'province': 'WC', 'country': 'ZA'}})
+        self.assertEqual(planned, [[('ward', '1'), ('province', 'WC'), ('country', 'ZA')]])
+
+        # the summary sections are cached now
+        build_profile_sections(sections, '2', 'ward', summary_levels)
+        self.assertEqual(planned[1], [('ward', '2')])
+
+        # and nothing is planned when everything is cached
+        build_profile_sections(sections, 'WC', 'province', [('country', 'ZA')])
+        self.assertEqual(len(planned), 2)
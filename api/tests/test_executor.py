@@ -0,0 +1,61 @@
+import time
+import unittest
+
+from api import executor
+from api.executor import run_concurrently
+
+try:
+    import gevent
+except ImportError:
+    gevent = None
+
+
+class RunConcurrentlyTestCase(unittest.TestCase):
+    def test_order(self):
+        # later tasks finish first
+        tasks = [lambda i=i: time.sleep(0.01 * (5 - i)) or i for i in range(5)]
+
+        for mode in ('serial', 'threads'):
+            self.assertEqual(run_concurrently(tasks, concurrency=5, mode=mode), range(5))
+
+    def test_errors(self):
+        def fail():
+            raise ValueError('failed')
+        tasks = [lambda: 1, fail, lambda: 3]
+
+        for mode in ('serial', 'threads'):
+            self.assertRaises(ValueError, run_concurrently, tasks, concurrency=2, mode=mode)
+
+    def test_unknown_mode(self):
+        self.assertRaises(ValueError, run_concurrently, [lambda: 1] * 2, concurrency=2, mode='fork')
+
+
+@unittest.skipIf(gevent is None, 'gevent is not installed')
+class RunConcurrentlyGeventTestCase(unittest.TestCase):
+    def setUp(self):
+        # don't change how psycopg2 waits for the rest of the tests
+        self.addCleanup(setattr, executor, '_green_psycopg', executor._green_psycopg)
+        executor._green_psycopg = True
+
+    def test_interleaves(self):
+        events = []
+
+        def task(i):
+            events.append(('start', i))
+            gevent.sleep(0.01 * (3 - i))
+            events.append(('end', i))
+            return i
+
+        tasks = [lambda i=i: task(i) for i in range(3)]
+        self.assertEqual(run_concurrently(tasks, concurrency=3, mode='gevent'), [0, 1, 2])
+        # every task started before any of them finished
+        self.assertEqual(events[:3], [('start', 0), ('start', 1), ('start', 2)])
+        self.assertEqual(events[3:], [('end', 2), ('end', 1), ('end', 0)])
+
+    def test_errors(self):
+        def fail():
+            gevent.sleep(0)
+            raise ValueError('failed')
+        tasks = [lambda: gevent.sleep(0.05), fail, lambda: 3]
+
+        self.assertRaises(ValueError, run_concurrently, tasks, concurrency=3, mode='gevent')
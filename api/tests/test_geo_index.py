@@ -0,0 +1,33 @@
+import unittest
+
+from .fixtures import sample_geo_index
+
+
+class GeoIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.index = sample_geo_index()
+
+    def test_parents_and_names(self):
+        ward = self.index.get('ward', '19100001')
+        self.assertEqual([p.full_geoid for p in ward.parents()],
+                         ['municipality-CPT', 'province-WC', 'country-ZA'])
+        self.assertEqual(ward.parent.code, 'CPT')
+        self.assertEqual(ward.long_name, 'Ward 1 (19100001), City of Cape Town, Western Cape')
+        self.assertEqual(ward.context_name, 'Ward 1 (19100001), City of Cape Town, WC')
+
+    def test_descendants(self):
+        province = self.index.get('province', 'WC')
+        self.assertEqual([c.code for c in province.children()], ['CPT', 'WC044'])
+        self.assertEqual(province.descendant_levels(), ['municipality', 'ward'])
+        self.assertEqual(self.index.get('province', 'GT').children(), [])
+        self.assertEqual(province.split_into('country'), [])
+        self.assertRaises(ValueError, province.split_into, 'planet')
+
+    def test_split_reparents(self):
+        wards = self.index.get('province', 'WC').split_into('ward')
+        self.assertEqual([w.code for w in wards], ['10404001', '19100001', '19100002'])
+        self.assertTrue(all(w.parent.full_geoid == 'province-WC' for w in wards))
+
+        # the index's own records are unchanged
+        self.assertEqual(self.index.get('ward', '19100001').parent.full_geoid, 'municipality-CPT')
+        self.assertEqual(wards[1].long_name, self.index.get('ward', '19100001').long_name)
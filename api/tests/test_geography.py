@@ -0,0 +1,78 @@
+import unittest
+
+from api import geo_index
+from api.controller import geography
+from api.controller.geography import get_locations_batch
+from api.fake_ward_search import FakeWardSearchServer
+from api.utils import WardSearchAPI
+from .fixtures import sample_geo_index
+
+
+def ward_response(ward_code):
+    return [{'address': 'Cape Town', 'province': 'Western Cape', 'ward': ward_code, 'wards_no': 1,
+             'municipality': 'City of Cape Town', 'coords': [-33.9, 18.4]}]
+
+
+class GetLocationsBatchTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeWardSearchServer({
+            '1 Main Road': ward_response('19100001'),
+            '-33.9,18.4': ward_response('19100001'),
+            # missing the fields of a location
+            '3 Main Road': [{'ward': '19100001'}],
+        }, failures=['2 Main Road'])
+        self.server.start()
+        self.addCleanup(self.server.stop)
+
+        self.patch(geography, 'ward_search_api', WardSearchAPI(self.server.url))
+        self.patch(geography, 'get_ward_locator', lambda: None)
+        self.patch(geo_index, '_index', sample_geo_index())
+
+    def patch(self, obj, attr, value):
+        self.addCleanup(setattr, obj, attr, getattr(obj, attr))
+        setattr(obj, attr, value)
+
+    def test_batch(self):
+        results = get_locations_batch([
+            {'address': '1 Main Road'},
+            {'lat': '-33.9', 'lon': '18.4'},
+            {'address': 'Nowhere'},
+            {'lat': 'north'},
+            'an address',
+            {'address': '1 Main Road'},
+        ])
+
+        self.assertEqual(len(results), 6)
+        self.assertEqual([p['geo_level'] for p in results[0]['places']], ['ward', 'municipality', 'province', 'country'])
+        self.assertEqual(results[0]['places'][0]['geo_code'], '19100001')
+        self.assertEqual(results[1], results[0])
+        self.assertEqual(results[2], {'error': 'Location not found'})
+        self.assertEqual(results[3], {'error': 'Expected an address, or lat and lon'})
+        self.assertEqual(results[4], {'error': 'Expected an address, or lat and lon'})
+        self.assertEqual(results[5], results[0])
+
+        # each distinct term is searched once
+        self.assertEqual(sorted(self.server.requests), ['-33.9,18.4', '1 Main Road', 'Nowhere'])
+
+    def test_points_outside_local_wards(self):
+        class Locator(object):
+            def locate(self, longitude, latitude):
+                return '19100002' if longitude > 20 else None
+        self.patch(geography, 'get_ward_locator', lambda: Locator())
+
+        results = get_locations_batch([{'lat': '-33.9', 'lon': '21'}, {'lat': '-33.9', 'lon': '18.4'}])
+        self.assertEqual(results[0]['places'][0]['geo_code'], '19100002')
+        # asked the Wards API, since the point isn't in one of our wards
+        self.assertEqual(results[1]['places'][0]['geo_code'], '19100001')
+        self.assertEqual(self.server.requests, ['-33.9,18.4'])
+
+    def test_search_errors(self):
+        results = get_locations_batch([
+            {'address': '2 Main Road'},
+            {'address': '3 Main Road'},
+            {'address': '1 Main Road'},
+        ])
+
+        self.assertIn('error', results[0])
+        self.assertEqual(results[1], {'error': 'Search failed'})
+        self.assertIn('places', results[2])
@@ -0,0 +1,25 @@
+import os
+
+from api.geometry_store import GeometryStore, GeometryStoreWriter
+from .base import TempDirTestCase
+
+
+class GeometryStoreTestCase(TempDirTestCase):
+    def setUp(self):
+        super(GeometryStoreTestCase, self).setUp()
+        self.path = os.path.join(self.root, 'geometries.bin')
+
+    def test_lookup(self):
+        writer = GeometryStoreWriter(self.path)
+        for i in range(100):
+            writer.add('ward-%d' % i, 'wkb %d' % i)
+        writer.add('country-ZA', 'za')
+        writer.commit()
+
+        store = GeometryStore(self.path)
+        self.assertEqual(store.get('ward-42'), 'wkb 42')
+        self.assertEqual(store.get('country-ZA'), 'za')
+        self.assertIsNone(store.get('ward-100'))
+
+    def test_missing_store(self):
+        self.assertIsNone(GeometryStore(self.path).get('ward-1'))
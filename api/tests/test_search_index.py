@@ -0,0 +1,36 @@
+import unittest
+
+from api.search_index import PlaceSearchIndex
+from .fixtures import sample_geo_index
+
+
+class PlaceSearchIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        subplaces = [('199001', 'Sea Point', 'Cape Town', '19100002'),
+                     ('199002', 'Nowhere', 'Nowhere', '99999999')]
+        self.index = PlaceSearchIndex(sample_geo_index(), subplaces)
+
+    def search(self, term, levels, **kwargs):
+        return [r.full_geoid for r in self.index.search(term, levels, **kwargs)]
+
+    def test_names(self):
+        # ordered by level, then name
+        self.assertEqual(self.search('g', ['municipality', 'province']), ['province-GT', 'municipality-WC044'])
+        # "City of" is optional, and case doesn't matter
+        self.assertEqual(self.search('CAPE', ['municipality']), ['municipality-CPT'])
+        self.assertEqual(self.search('city of cape', ['municipality']), ['municipality-CPT'])
+        self.assertEqual(self.search(' wc ', ['province']), ['province-WC'])
+        self.assertEqual(self.search('cape', ['municipality'], year='2016'), [])
+
+    def test_wards(self):
+        self.assertEqual(self.search('191', ['ward']), ['ward-19100001', 'ward-19100002'])
+        # by ward number, and code prefix
+        self.assertEqual(self.search('Ward 2', ['ward']), ['ward-19100002'])
+        self.assertEqual(self.search('1', ['ward']), ['ward-10404001', 'ward-19100001', 'ward-19100002'])
+        self.assertEqual(self.search('191', ['ward'], limit=1), ['ward-19100001'])
+
+    def test_subplaces(self):
+        self.assertEqual(self.search('sea', ['subplace']), ['ward-19100002'])
+        self.assertEqual(self.search('cape town', ['subplace']), ['ward-19100002'])
+        self.assertEqual(self.search('199001', ['subplace']), ['ward-19100002'])
+        self.assertEqual(self.search('nowhere', ['subplace']), [])
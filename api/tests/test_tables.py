@@ -0,0 +1,65 @@
+import unittest
+from collections import namedtuple
+
+from api.models import tables
+from api.models.tables import FieldTable
+
+
+class FieldTableTestCase(unittest.TestCase):
+    Row = namedtuple('Row', ['geo_code', 'grouping', 'total', 'denominator', 'gender', 'age'])
+
+    def table(self, fields, denominator_key=None):
+        # only what build_raw_data needs, without the database or manifest
+        table = FieldTable.__new__(FieldTable)
+        table.fields = fields
+        table.denominator_key = denominator_key
+        table.table_per_level = True
+        table.total_column = table.column_id([denominator_key or 'total'])
+        return table
+
+    def test_build_raw_data(self):
+        table = self.table(['gender', 'age'])
+        rows = [
+            self.Row('1', 3, 10, None, None, None),
+            self.Row('1', 1, 6, None, 'female', None),
+            self.Row('1', 0, 4, None, 'female', 'child'),
+            self.Row('1', 0, 2, None, 'female', 'adult'),
+            self.Row('1', 1, 4, None, 'male', None),
+            self.Row('1', 0, 4, None, 'male', 'adult'),
+        ]
+
+        data = table.build_raw_data({'ward': ['1', '2']}, rows)
+        self.assertEqual(data['ward-1']['estimate'], {
+            'total': 10, 'female': 6, 'female-child': 4, 'female-adult': 2, 'male': 4, 'male-adult': 4})
+        self.assertEqual(data['ward-1']['error']['female-child'], 0)
+        self.assertEqual(data['ward-2'], {'estimate': {}, 'error': {}})
+
+    def test_build_raw_data_denominator(self):
+        table = self.table(['gender', 'age'], denominator_key='people')
+        # the denominator is the sum of the 'people' rows
+        rows = [
+            self.Row('1', 3, 20, 10, None, None),
+            self.Row('1', 1, 12, 6, 'female', None),
+            self.Row('1', 0, 6, None, 'female', 'people'),
+            self.Row('1', 0, 6, None, 'female', 'child'),
+        ]
+
+        data = table.build_raw_data({'ward': ['1']}, rows)
+        self.assertEqual(data['ward-1']['estimate'], {'people': 10, 'female': 6, 'female-child': 6})
+
+    def test_not_in_manifest(self):
+        sessions = []
+        for name, func in [('get_table_manifest', lambda: {}),
+                           ('get_session', lambda: sessions.append(1))]:
+            self.addCleanup(setattr, tables, name, getattr(tables, name))
+            setattr(tables, name, func)
+
+        table = self.table(['gender'])
+        table.id = 'test_not_in_manifest'
+        table.dataset_name = 'Census 2011'
+        table.table_per_level = False
+        table.setup_columns()
+
+        # the table is left for sync_tables, without going to the database
+        self.assertEqual(sessions, [])
+        self.assertEqual(table.columns.keys(), ['total'])
@@ -0,0 +1,117 @@
+import json
+import os
+import sqlite3
+import threading
+import unittest
+
+from sqlalchemy.exc import TimeoutError
+
+from api import utils
+from api.fake_ward_search import FakeWardSearchServer
+from api.utils import (get_data_version, InstrumentedQueuePool, WardSearchAPI, WardSearchException,
+                       CopyRowsFile)
+from .base import TempDirTestCase, DataVersionTestCase
+
+
+class InstrumentedQueuePoolTestCase(unittest.TestCase):
+    def test_counts_waits_for_exhausted_pool(self):
+        pool = InstrumentedQueuePool(lambda: sqlite3.connect(':memory:'),
+                                     pool_size=1, max_overflow=0, timeout=0.01)
+        conn = pool.connect()
+        self.assertRaises(TimeoutError, pool.connect)
+        conn.close()
+        pool.connect()
+
+        self.assertEqual(pool.checkouts, 3)
+        self.assertEqual(pool.waits, 1)
+        self.assertEqual(pool.timeouts, 1)
+
+
+class BumpDataVersionTestCase(DataVersionTestCase):
+    def test_bump(self):
+        self.assertEqual(utils.bump_data_version(), '2011.2')
+        modified = utils.get_data_modified()
+
+        utils._data_version = None
+        self.assertEqual(get_data_version(), '2011.2')
+        self.assertEqual(utils.get_data_modified(), modified)
+
+    def test_sees_bumps_by_other_processes(self):
+        changes = []
+        utils.on_data_version_change(lambda: changes.append(get_data_version()))
+        self.addCleanup(utils._data_version_listeners.pop)
+        self.assertEqual(get_data_version(), '2011.1')
+
+        with open(utils.DATA_VERSION_FILE, 'w') as f:
+            f.write('2011.5\n')
+        os.utime(utils.DATA_VERSION_FILE, (1, 1))
+
+        self.assertEqual(get_data_version(), '2011.5')
+        self.assertEqual(changes, ['2011.5'])
+
+    def test_bump_without_file(self):
+        os.remove(utils.DATA_VERSION_FILE)
+        self.assertEqual(utils.read_data_version(), ('0', None))
+        self.assertEqual(utils.bump_data_version(), '1')
+
+
+class WardSearchAPITestCase(TempDirTestCase):
+    def setUp(self):
+        super(WardSearchAPITestCase, self).setUp()
+        self.cache_file = os.path.join(self.root, 'ward_search_cache.json')
+        self.server = FakeWardSearchServer({'1 Main Road': [{'ward': '19100001'}]}, delay=0.2,
+                                           failures=['2 Main Road'])
+        self.server.start()
+        self.addCleanup(self.server.stop)
+
+    def lookup_concurrently(self, api, address, count=5):
+        results = []
+
+        def lookup():
+            try:
+                results.append(json.loads(api.lookup(address)))
+            except WardSearchException as e:
+                results.append(e)
+
+        threads = [threading.Thread(target=lookup) for _ in range(count)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return results
+
+    def test_coalesce_and_cache(self):
+        api = WardSearchAPI(self.server.url, cache_file=self.cache_file)
+
+        results = self.lookup_concurrently(api, ' 1 Main Road')
+        self.assertEqual(results, [[{'ward': '19100001'}]] * 5)
+        # the address is sent as it was given
+        self.assertEqual(self.server.requests, ['1 Main Road'])
+
+        # saved, and loaded by the next process
+        api.save_cache()
+        self.assertEqual([n for n in os.listdir(self.root) if n.endswith('.tmp')], [])
+        api = WardSearchAPI(self.server.url, cache_file=self.cache_file)
+        self.assertEqual(json.loads(api.lookup('1 main  road')), [{'ward': '19100001'}])
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_shares_errors(self):
+        api = WardSearchAPI(self.server.url)
+
+        results = self.lookup_concurrently(api, '2 Main Road')
+        self.assertEqual(len(results), 5)
+        self.assertTrue(all(isinstance(r, WardSearchException) for r in results))
+        self.assertEqual(self.server.requests, ['2 Main Road'])
+
+
+class CopyRowsFileTestCase(unittest.TestCase):
+    def test_read(self):
+        f = CopyRowsFile([(1, None, u'caf\xe9'), ('a\tb', 'c\\d', 3)])
+        data = ''
+        while True:
+            chunk = f.read(4)
+            if not chunk:
+                break
+            data += chunk
+
+        self.assertEqual(data, '1\t\\N\tcaf\xc3\xa9\na\\tb\tc\\\\d\t3\n')
@@ -0,0 +1,49 @@
+import unittest
+
+from api.votes_loader import VotesLoader, VOTES_COLUMNS
+
+
+class FakeLookups(object):
+    codes = {
+        'province': set(['WC']),
+        'district': set(['DC1']),
+        'municipality': set(['CPT']),
+        'ward': set(['19100001']),
+    }
+
+
+class VotesLoaderTestCase(unittest.TestCase):
+    def setUp(self):
+        self.loader = VotesLoader()
+        self.addCleanup(self.loader.file.close)
+
+    def row(self, **values):
+        row = {'electoral_event': 'municipal 2011', 'province_code': 'WC', 'municipality_code': 'CPT',
+               'district_code': None, 'ward_code': '19100001', 'party': 'ANC'}
+        row.update(values)
+        return row
+
+    def test_add(self):
+        self.loader.add(self.row())
+        self.assertEqual(self.loader.count, 1)
+
+        self.loader.file.seek(0)
+        line = self.loader.file.read()
+        self.assertEqual(len(line.rstrip('\n').split('\t')), len(VOTES_COLUMNS))
+        self.assertTrue(line.startswith('municipal 2011\tWC\tCPT\t\\N\t19100001\t'))
+
+    def test_validate(self):
+        # None keys, eg. metros without a district, are fine
+        self.loader.add(self.row())
+        self.loader.validate(FakeLookups())
+
+        self.loader.add(self.row(province_code='XX', municipality_code='ABC', ward_code='99'))
+        self.loader.add(self.row(ward_code='98'))
+
+        with self.assertRaises(ValueError) as cm:
+            self.loader.validate(FakeLookups())
+        self.assertEqual(str(cm.exception).split('\n'), [
+            '1 unknown province_code values: XX',
+            '1 unknown municipality_code values: ABC',
+            '2 unknown ward_code values: 98, 99',
+        ])
@@ -0,0 +1,62 @@
+import os
+import struct
+
+from api import ward_locator
+from api.geometry_store import GeometryStore, GeometryStoreWriter
+from api.ward_locator import load_ward_locator, get_ward_locator
+from .base import TempDirTestCase
+
+
+def polygon_wkb(*rings):
+    wkb = struct.pack('<BII', 1, 3, len(rings))
+    for ring in rings:
+        wkb += struct.pack('<I', len(ring))
+        wkb += ''.join(struct.pack('<dd', x, y) for x, y in ring)
+    return wkb
+
+
+class WardLocatorTestCase(TempDirTestCase):
+    def setUp(self):
+        super(WardLocatorTestCase, self).setUp()
+        self.path = os.path.join(self.root, 'geometries.bin')
+
+    def test_locate(self):
+        writer = GeometryStoreWriter(self.path)
+        # a square with a hole, and the square to its right
+        writer.add('ward-1', polygon_wkb([(0, 0), (1, 0), (1, 1), (0, 1), (0, 0)],
+                                         [(0.4, 0.4), (0.6, 0.4), (0.6, 0.6), (0.4, 0.6), (0.4, 0.4)]))
+        writer.add('ward-2', polygon_wkb([(1, 0), (2, 0), (2, 1), (1, 1), (1, 0)]))
+        writer.add('province-WC', polygon_wkb([(0, 0), (2, 0), (2, 1), (0, 0)]))
+        writer.commit()
+
+        locator = load_ward_locator(GeometryStore(self.path))
+        self.assertEqual(locator.locate(0.2, 0.2), '1')
+        self.assertEqual(locator.locate(1.5, 0.7), '2')
+        self.assertIsNone(locator.locate(0.5, 0.5))
+        self.assertIsNone(locator.locate(3, 3))
+
+    def test_empty_hole(self):
+        writer = GeometryStoreWriter(self.path)
+        writer.add('ward-1', polygon_wkb([(0, 0), (1, 0), (1, 1), (0, 1), (0, 0)], []))
+        writer.commit()
+
+        locator = load_ward_locator(GeometryStore(self.path))
+        self.assertEqual(locator.locate(0.5, 0.5), '1')
+
+    def test_reloads_rebuilt_store(self):
+        store = GeometryStore(self.path)
+        self.addCleanup(setattr, ward_locator, 'get_ward_boundaries', ward_locator.get_ward_boundaries)
+        self.addCleanup(setattr, ward_locator, '_locator', None)
+        ward_locator.get_ward_boundaries = lambda: store
+        ward_locator._locator = None
+
+        writer = GeometryStoreWriter(self.path)
+        writer.add('ward-1', polygon_wkb([(0, 0), (1, 0), (1, 1), (0, 1), (0, 0)]))
+        writer.commit()
+        self.assertEqual(get_ward_locator().locate(0.5, 0.5), '1')
+
+        writer = GeometryStoreWriter(self.path)
+        writer.add('ward-2', polygon_wkb([(0, 0), (1, 0), (1, 1), (0, 1), (0, 0)]))
+        writer.commit()
+        os.utime(self.path, (1, 1))
+        self.assertEqual(get_ward_locator().locate(0.5, 0.5), '2')
@@ -0,0 +1,22 @@
+import unittest
+import zipfile
+from StringIO import StringIO
+
+from api.zipstream import stream_zip
+
+
+class StreamZipTestCase(unittest.TestCase):
+    def test_round_trip(self):
+        for compress in (True, False):
+            members = [
+                ('data/data.csv', ['a,b\n', '', '1,2\n' * 1000]),
+                (u'caf\xe9.txt', []),
+            ]
+            zf = zipfile.ZipFile(StringIO(''.join(stream_zip(members, compress=compress))))
+
+            self.assertIsNone(zf.testzip())
+            self.assertEqual(zf.namelist(), ['data/data.csv', u'caf\xe9.txt'])
+            self.assertEqual(zf.read('data/data.csv'), 'a,b\n' + '1,2\n' * 1000)
+            self.assertEqual(zf.read(u'caf\xe9.txt'), '')
+            self.assertEqual(zf.getinfo('data/data.csv').compress_type,
+                             zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED)
@@ -1,17 +1,155 @@
 from __future__ import division
 
+import atexit
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime
+
 import requests
+import requests.adapters
+
+from sqlalchemy import create_engine, event, exc, MetaData, Table
+from sqlalchemy.orm import sessionmaker, scoped_session, Session
+from sqlalchemy.pool import QueuePool
+
+from .cache import LRUCache
+from .config import (DATABASE_URL, WARD_SEARCH_ENDPOINT, DATA_VERSION_FILE, DB_POOL_SIZE,
+                     DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE, DB_POOL_PRE_PING,
+                     HTTP_POOL_SIZE, WARD_SEARCH_TIMEOUT, WARD_SEARCH_CACHE_FILE, WARD_SEARCH_CACHE_SIZE,
+                     WARD_SEARCH_CACHE_TTL, WARD_SEARCH_CACHE_SAVE_SECS)
 
-from sqlalchemy import create_engine, MetaData, Table
-from sqlalchemy.orm import sessionmaker
+import logging
+log = logging.getLogger('censusreporter')
 
-from .config import DATABASE_URL, WARD_SEARCH_ENDPOINT
+try:
+    from greenlet import getcurrent as _current_scope
+except ImportError:
+    from threading import current_thread as _current_scope
 
 
-_engine = create_engine(DATABASE_URL)
+class InstrumentedQueuePool(QueuePool):
+    """
+    A QueuePool that counts checkouts and how often, and for how long, callers
+    had to wait for a connection because the pool was exhausted. Under gevent
+    a starved pool otherwise just looks like slow queries.
+    """
+    def __init__(self, *args, **kwargs):
+        super(InstrumentedQueuePool, self).__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.timeouts = 0
+
+    def _do_get(self):
+        # no idle connections and no room to overflow means we're going to block
+        exhausted = self._pool.empty() and \
+            self._max_overflow > -1 and self._overflow >= self._max_overflow
+        start = time.time()
+        timed_out = False
+
+        try:
+            return super(InstrumentedQueuePool, self)._do_get()
+        except exc.TimeoutError:
+            timed_out = True
+            raise
+        finally:
+            with self._stats_lock:
+                self.checkouts += 1
+                if exhausted:
+                    self.waits += 1
+                    self.wait_time += time.time() - start
+                if timed_out:
+                    self.timeouts += 1
+
+    def recreate(self):
+        # keep counting across engine.dispose()
+        pool = super(InstrumentedQueuePool, self).recreate()
+        pool.checkouts = self.checkouts
+        pool.waits = self.waits
+        pool.wait_time = self.wait_time
+        pool.timeouts = self.timeouts
+        return pool
+
+
+_engine = create_engine(DATABASE_URL,
+                        poolclass=InstrumentedQueuePool,
+                        pool_size=DB_POOL_SIZE,
+                        max_overflow=DB_MAX_OVERFLOW,
+                        pool_timeout=DB_POOL_TIMEOUT,
+                        pool_recycle=DB_POOL_RECYCLE)
 _metadata = MetaData()
 _Session = sessionmaker(bind=_engine)
 
+
+if DB_POOL_PRE_PING:
+    @event.listens_for(_engine, 'checkout')
+    def _ping_checkout(dbapi_connection, connection_record, connection_proxy):
+        """ Make sure a pooled connection is still alive before handing it
+        out, so that a database restart doesn't break the next request
+        on every worker. """
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute('SELECT 1')
+        except Exception:
+            # the pool will discard this connection and try another
+            raise exc.DisconnectionError()
+        finally:
+            cursor.close()
+
+
+def pool_stats():
+    """
+    Statistics about the connection pool of this process.
+    """
+    pool = _engine.pool
+    return {
+        'size': pool.size(),
+        'max_overflow': pool._max_overflow,
+        'checked_in': pool.checkedin(),
+        'checked_out': pool.checkedout(),
+        'overflow': max(pool.overflow(), 0),
+        'checkouts': pool.checkouts,
+        'waits': pool.waits,
+        'wait_time': round(pool.wait_time, 3),
+        'timeouts': pool.timeouts,
+    }
+
+
+class RequestSession(Session):
+    """
+    The session shared by everything that runs within a web request (see
+    `get_session`). Code that gets a session and closes it when it's done
+    would otherwise hand the connection back mid-request, so +close+ does
+    nothing; the session is closed by `close_request_session` instead.
+    """
+    def close(self):
+        pass
+
+    def close_request(self):
+        super(RequestSession, self).close()
+
+
+# request sessions, one per greenlet (or thread)
+_request_session = scoped_session(sessionmaker(bind=_engine, class_=RequestSession),
+                                  scopefunc=_current_scope)
+
+
+def open_request_session():
+    """ Start sharing a session for the current greenlet, until
+    `close_request_session` is called. """
+    return _request_session()
+
+
+def close_request_session():
+    if _request_session.registry.has():
+        _request_session().close_request()
+        _request_session.registry.clear()
+
+
 province_codes = {
     'kwazulu-natal': 'KZN',
     'free state': 'FS',
@@ -26,13 +164,191 @@ province_codes = {
 
 
 def get_session():
+    """
+    The session for the current request, if one has been opened with
+    `open_request_session`, otherwise a new session.
+
+    Work run on other greenlets or threads, such as concurrent profile
+    sections, always gets a new session of its own.
+    """
+    if _request_session.registry.has():
+        return _request_session()
     return _Session()
 
 
-def get_table_model(name):
+def get_table_model(name, columns=None):
+    """ A Table for the database table +name+. Its columns are reflected
+    from the database, unless they're given in +columns+.
+    """
+    if columns is not None:
+        return Table(name, _metadata, *columns)
     return Table(name, _metadata, autoload=True, autoload_with=_engine)
 
 
+def copy_line(values):
+    """ A line of Postgres COPY text format for +values+. """
+    fields = []
+    for value in values:
+        if value is None:
+            fields.append('\\N')
+            continue
+
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        else:
+            value = str(value)
+        fields.append(value.replace('\\', '\\\\').replace('\t', '\\t')
+                      .replace('\n', '\\n').replace('\r', '\\r'))
+
+    return '\t'.join(fields) + '\n'
+
+
+class CopyRowsFile(object):
+    """ A file that reads +rows+, tuples of values, in COPY text format, so
+    that they can be streamed to the database without holding them all in
+    memory.
+    """
+
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.buffer = ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            try:
+                self.buffer += copy_line(next(self.rows))
+            except StopIteration:
+                break
+
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def copy_from(cursor, table_name, columns, rows):
+    """
+    Load +rows+ into the +columns+ of +table_name+ with COPY FROM STDIN,
+    which is much faster than inserting them. +cursor+ is a psycopg2 cursor,
+    eg. from `_engine.raw_connection()`, and +rows+ is either an iterable of
+    tuples of values, or a file already in COPY text format.
+    """
+    quote = _engine.dialect.identifier_preparer.quote
+    if not hasattr(rows, 'read'):
+        rows = CopyRowsFile(rows)
+
+    cursor.copy_expert('COPY %s (%s) FROM STDIN' % (quote(table_name), ', '.join(quote(c) for c in columns)),
+                       rows)
+
+
+_data_version = None
+_data_modified = None
+# the modification time of `DATA_VERSION_FILE` when it was last read
+_data_version_mtime = None
+# functions called when the data version changes
+_data_version_listeners = []
+
+
+def on_data_version_change(func):
+    """ Call +func+ whenever this process sees a new data version, eg. to
+    throw away anything cached from the old data. Can be used as a decorator.
+    """
+    _data_version_listeners.append(func)
+    return func
+
+
+def set_data_version(version, modified, mtime):
+    global _data_version, _data_modified, _data_version_mtime
+
+    changed = _data_version is not None and version != _data_version
+    _data_version, _data_modified, _data_version_mtime = version, modified, mtime
+
+    if changed:
+        for func in _data_version_listeners:
+            func()
+
+
+def data_version_mtime():
+    try:
+        return os.stat(DATA_VERSION_FILE).st_mtime
+    except OSError:
+        return None
+
+
+def read_data_version():
+    """ Read the (version, modified time) from `DATA_VERSION_FILE`.
+
+    The file holds the version on its first line and, once the version has
+    been bumped by `bump_data_version`, the time of the bump as a unix
+    timestamp on its second line. Otherwise the file's own modification time
+    is used.
+    """
+    try:
+        with open(DATA_VERSION_FILE) as f:
+            lines = f.read().split()
+            modified = os.fstat(f.fileno()).st_mtime
+    except IOError:
+        return '0', None
+
+    version = lines[0] if lines else '0'
+    if len(lines) > 1:
+        try:
+            modified = float(lines[1])
+        except ValueError:
+            pass
+
+    return version, datetime.utcfromtimestamp(modified)
+
+
+def get_data_version():
+    """
+    The version of the dataset currently loaded into the database, as
+    recorded in `DATA_VERSION_FILE`. The file is only read again once it's
+    changed, so running processes see a new version as soon as it's bumped.
+    """
+    mtime = data_version_mtime()
+    if _data_version is None or mtime != _data_version_mtime:
+        version, modified = read_data_version()
+        set_data_version(version, modified, mtime)
+
+    return _data_version
+
+
+def get_data_modified():
+    """ When the dataset currently loaded into the database was last changed,
+    as a UTC datetime, or None if unknown.
+    """
+    get_data_version()
+    return _data_modified
+
+
+def bump_data_version():
+    """
+    Record that the data in the database has changed, by incrementing the
+    last part of the data version (eg. 2011.1 becomes 2011.2). Anything tagged
+    with the old version, such as cached profiles and downloads, is no longer
+    used, by this process or any other that's running.
+
+    Call this after loading or changing any data.
+    """
+    version, _ = read_data_version()
+    parts = version.split('.')
+    if parts[-1].isdigit():
+        parts[-1] = str(int(parts[-1]) + 1)
+    else:
+        parts.append('1')
+    version = '.'.join(parts)
+
+    now = time.time()
+    tmp_path = '%s.tmp' % DATA_VERSION_FILE
+    with open(tmp_path, 'w') as f:
+        f.write('%s\n%d\n' % (version, now))
+    os.rename(tmp_path, DATA_VERSION_FILE)
+
+    set_data_version(version, datetime.utcfromtimestamp(int(now)), data_version_mtime())
+    return version
+
+
 class LocationNotFound(Exception):
     pass
 
@@ -68,15 +384,125 @@ class WardSearchException(Exception):
     pass
 
 
+_http_session = None
+
+
+def get_http_session():
+    """
+    The HTTP session shared by everything in this process that calls
+    other services, so that connections are kept alive and reused.
+    """
+    global _http_session
+    if _http_session is None:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        _http_session = session
+    return _http_session
+
+
+class PendingLookup(object):
+    """ A lookup in progress. Once +event+ is set, either +body+ or +error+
+    is set. """
+    __slots__ = ('event', 'body', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.body = None
+        self.error = None
+
+
 class WardSearchAPI(object):
+    """
+    Client for the wards API, which finds the ward for an address.
+
+    Responses are cached by normalized address, in memory and in +cache_file+
+    so that they survive restarts. The cache file is saved in the background
+    every so often, and when the process exits. When many requests look up
+    the same address at once, only one of them calls the API, with the
+    address as it was given, and the others wait for its answer, or its
+    error.
+    """
 
-    def __init__(self, endpoint_url):
+    def __init__(self, endpoint_url, timeout=WARD_SEARCH_TIMEOUT, cache_file=None):
         self.endpoint_url = endpoint_url
+        self.timeout = timeout
+        self.cache = LRUCache(max_size=WARD_SEARCH_CACHE_SIZE, ttl=WARD_SEARCH_CACHE_TTL)
+        self.cache_file = cache_file
+        self.saved = time.time()
+        # whether there's anything new to save
+        self.dirty = False
+        self.save_lock = threading.Lock()
+        # addresses being looked up, mapped to their PendingLookup
+        self.pending = {}
+        self.lock = threading.Lock()
+
+        if self.cache_file:
+            self.load_cache()
+            atexit.register(self.save_cache)
+
+    def normalize(self, address):
+        return ' '.join(address.lower().split())
+
+    def lookup(self, address):
+        """ The body of the API's response for +address+, as a JSON string. """
+        key = self.normalize(address)
+
+        body = self.cache.get(key)
+        if body is not None:
+            return body
+
+        with self.lock:
+            pending = self.pending.get(key)
+            if pending is None:
+                # we're going to look it up
+                pending = self.pending[key] = PendingLookup()
+                fetching = True
+            else:
+                fetching = False
+
+        if not fetching:
+            # someone else is looking it up, wait for them and share their
+            # answer, or their error
+            pending.event.wait()
+            if pending.error is not None:
+                raise pending.error
+            return pending.body
+
+        try:
+            pending.body = self.fetch(address.strip())
+            self.cache.set(key, pending.body)
+            self.dirty = True
+        except Exception as e:
+            pending.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.pending[key]
+            pending.event.set()
+
+        if self.cache_file:
+            with self.lock:
+                save = time.time() - self.saved > WARD_SEARCH_CACHE_SAVE_SECS
+                if save:
+                    self.saved = time.time()
+            if save:
+                thread = threading.Thread(target=self.save_cache)
+                thread.daemon = True
+                thread.start()
+
+        return pending.body
+
+    def fetch(self, address):
+        try:
+            resp = get_http_session().get(self.endpoint_url,
+                                          params={'address': address,
+                                                  'database': 'wards_2011'},
+                                          timeout=self.timeout)
+        except requests.RequestException as e:
+            raise WardSearchException(str(e))
 
-    def search(self, term):
-        resp = requests.get(self.endpoint_url,
-                            params={'address': term,
-                                    'database': 'wards_2011'})
         if resp.status_code != 200:
             raise WardSearchException('%s response code' % resp.status_code)
         # if the request is invalid it returns the landing page html
@@ -84,7 +510,10 @@ class WardSearchAPI(object):
                                               'text/javascript'):
             raise WardSearchException('Invalid request')
 
-        data = resp.json()
+        return resp.text
+
+    def search(self, term):
+        data = json.loads(self.lookup(term))
         # this is not actually an error condition, just not found
         if isinstance(data, dict) and 'error' in data:
             return []
@@ -94,6 +523,32 @@ class WardSearchAPI(object):
                          obj['coords'])
                 for obj in data]
 
+    def load_cache(self):
+        try:
+            with open(self.cache_file) as f:
+                self.cache.load(json.load(f))
+        except (IOError, ValueError):
+            pass
+
+    def save_cache(self):
+        with self.save_lock:
+            if not self.dirty:
+                return
+            self.dirty = False
+            self.saved = time.time()
+
+            tmp_path = None
+            try:
+                fd, tmp_path = tempfile.mkstemp(suffix='.tmp',
+                                                dir=os.path.dirname(os.path.abspath(self.cache_file)))
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(self.cache.dump(), f)
+                os.rename(tmp_path, self.cache_file)
+            except (IOError, OSError) as e:
+                log.warn("Couldn't save the ward search cache to %s: %s" % (self.cache_file, e))
+                if tmp_path and os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
     def clean_province(self, value):
         if 2 <= len(value) <=3:
             # pre-2011 data provides province code in the 'province' field
@@ -107,7 +562,7 @@ class WardSearchAPI(object):
                 pass
 
 
-ward_search_api = WardSearchAPI(WARD_SEARCH_ENDPOINT)
+ward_search_api = WardSearchAPI(WARD_SEARCH_ENDPOINT, cache_file=WARD_SEARCH_CACHE_FILE)
 
 def capitalize(s):
     """
@@ -0,0 +1,97 @@
+import tempfile
+import time
+
+from api.models import Province, District, Municipality, Ward, Votes, Base
+from api.utils import _engine, copy_line, copy_from
+
+
+'''
+Bulk loading of election results into the votes table, for the scripts
+in api/scripts that load each election.
+
+The geographies the results refer to are loaded once into `GeoLookups`,
+rather than queried for each row. The parsed rows are written to a
+temporary file in COPY format by a `VotesLoader`, which collects the
+distinct codes in each foreign key column as it goes. Once the whole file
+has been read, the codes are checked against the geographies in one pass,
+and if they're all known the rows are loaded with a single COPY.
+'''
+
+# the columns of the votes table that are loaded
+VOTES_COLUMNS = ['electoral_event', 'province_code', 'municipality_code', 'district_code', 'ward_code',
+                 'voting_district_code', 'party', 'ballot_type', 'registered_voters', 'voter_turnout',
+                 'mec7_votes', 'total_votes', 'valid_votes', 'spoilt_votes', 'section_24a_votes',
+                 'special_votes']
+
+# the foreign key columns of the votes table, and the level they refer to
+VOTES_FOREIGN_KEYS = [
+    ('province_code', 'province'),
+    ('municipality_code', 'municipality'),
+    ('district_code', 'district'),
+    ('ward_code', 'ward'),
+]
+
+
+class GeoLookups(object):
+    """ The codes of the provinces, districts, municipalities and wards,
+    loaded with a query for each. """
+
+    def __init__(self, session):
+        # map from province name to code
+        self.province_codes = dict(session.query(Province.name, Province.code))
+        # map from municipality code to the code of its district
+        self.district_codes = dict(session.query(Municipality.code, Municipality.district_code))
+
+        self.codes = {
+            'province': set(self.province_codes.itervalues()),
+            'district': set(code for code, in session.query(District.code)),
+            'municipality': set(self.district_codes.iterkeys()),
+            'ward': set(code for code, in session.query(Ward.code)),
+        }
+
+
+class VotesLoader(object):
+    """ Collects rows for the votes table, then validates and loads them. """
+
+    def __init__(self):
+        self.file = tempfile.TemporaryFile()
+        self.count = 0
+        # the distinct values of each foreign key column
+        self.keys = dict((column, set()) for column, level in VOTES_FOREIGN_KEYS)
+
+    def add(self, values):
+        """ Add a row, given as a dict from column name to value. """
+        for column, codes in self.keys.iteritems():
+            codes.add(values.get(column))
+        self.file.write(copy_line([values.get(column) for column in VOTES_COLUMNS]))
+        self.count += 1
+
+    def validate(self, lookups):
+        """ Raise a ValueError if any of the rows refer to geographies
+        that aren't in +lookups+. """
+        errors = []
+        for column, level in VOTES_FOREIGN_KEYS:
+            missing = sorted(self.keys[column] - lookups.codes[level] - set([None]))
+            if missing:
+                errors.append('%d unknown %s values: %s%s' % (
+                    len(missing), column, ', '.join(missing[:10]), ', ...' if len(missing) > 10 else ''))
+
+        if errors:
+            raise ValueError('\n'.join(errors))
+
+    def load(self):
+        """ Load the rows with COPY, creating the votes table if necessary.
+        Returns the number of seconds it took. """
+        start = time.time()
+        Base.metadata.create_all(_engine, tables=[Votes.__table__])
+
+        conn = _engine.raw_connection()
+        try:
+            self.file.seek(0)
+            copy_from(conn.cursor(), Votes.__table__.name, VOTES_COLUMNS, self.file)
+            conn.commit()
+        finally:
+            conn.close()
+            self.file.close()
+
+        return time.time() - start
@@ -0,0 +1,201 @@
+import struct
+import threading
+from array import array
+
+from api.geometry_store import get_ward_boundaries
+
+import logging
+log = logging.getLogger('censusreporter')
+
+
+'''
+Finds the ward containing a point, without calling out to the wards API.
+
+The ward boundaries come from their own geometry store (see
+`api.geometry_store`), rather than the one for downloads, since those are
+simplified one ward at a time and so neighbouring wards have gaps and
+overlaps along their boundaries. Build it with:
+
+    ./manage.py build_geometry_store --unsimplified --output=api/data/ward_boundaries.bin ward:wards.geojson
+
+Points that aren't in any ward, such as those in a gap between the
+boundaries, should still be looked up with the wards API.
+
+Each ward's polygons are put into a grid of cells covering the country, by
+their bounding boxes. To locate a point, only the wards in its cell whose
+bounding box contains it are tested exactly, by casting a ray from the point
+and counting the edges it crosses.
+'''
+
+# size of the grid cells, in degrees
+CELL_SIZE = 0.05
+
+WKB_POLYGON = 3
+WKB_MULTIPOLYGON = 6
+
+
+class Polygon(object):
+    """ A polygon with holes. Rings are flat arrays of x, y coordinates. """
+    __slots__ = ('code', 'rings', 'min_x', 'min_y', 'max_x', 'max_y')
+
+    def __init__(self, code, rings):
+        self.code = code
+        self.rings = rings
+
+        outer = rings[0]
+        self.min_x = min(outer[0::2])
+        self.max_x = max(outer[0::2])
+        self.min_y = min(outer[1::2])
+        self.max_y = max(outer[1::2])
+
+    def contains(self, x, y):
+        if not (self.min_x <= x <= self.max_x and self.min_y <= y <= self.max_y):
+            return False
+
+        # inside the outer ring, and not in any holes
+        if not ring_contains(self.rings[0], x, y):
+            return False
+
+        for hole in self.rings[1:]:
+            if ring_contains(hole, x, y):
+                return False
+
+        return True
+
+
+def ring_contains(ring, x, y):
+    """ Is (+x+, +y+) inside +ring+? """
+    inside = False
+    n = len(ring)
+    x1, y1 = ring[n - 2], ring[n - 1]
+
+    for i in xrange(0, n, 2):
+        x2, y2 = ring[i], ring[i + 1]
+        if (y2 > y) != (y1 > y) and x < (x1 - x2) * (y - y2) / (y1 - y2) + x2:
+            inside = not inside
+        x1, y1 = x2, y2
+
+    return inside
+
+
+def parse_wkb_polygons(wkb):
+    """ Parse a WKB Polygon or MultiPolygon into a list of polygons, each
+    a list of rings.
+    """
+    polygons = []
+
+    def parse(offset):
+        byte_order = '<' if wkb[offset] == '\x01' else '>'
+        geom_type, = struct.unpack_from(byte_order + 'I', wkb, offset + 1)
+        offset += 5
+
+        # Z and M coordinates are ignored, whether they're flagged in
+        # the EWKB or ISO style
+        has_z = bool(geom_type & 0x80000000)
+        has_m = bool(geom_type & 0x40000000)
+        if geom_type & 0x20000000:
+            # skip the SRID
+            offset += 4
+        geom_type &= 0x0fffffff
+        if geom_type >= 1000:
+            has_z = has_z or geom_type // 1000 in (1, 3)
+            has_m = has_m or geom_type // 1000 in (2, 3)
+            geom_type %= 1000
+        dims = 2 + has_z + has_m
+
+        if geom_type == WKB_MULTIPOLYGON:
+            count, = struct.unpack_from(byte_order + 'I', wkb, offset)
+            offset += 4
+            for _ in xrange(count):
+                offset = parse(offset)
+
+        elif geom_type == WKB_POLYGON:
+            ring_count, = struct.unpack_from(byte_order + 'I', wkb, offset)
+            offset += 4
+            rings = []
+            for _ in xrange(ring_count):
+                point_count, = struct.unpack_from(byte_order + 'I', wkb, offset)
+                offset += 4
+                coords = struct.unpack_from(byte_order + '%dd' % (point_count * dims), wkb, offset)
+                offset += point_count * dims * 8
+
+                ring = array('d')
+                for i in xrange(0, len(coords), dims):
+                    ring.append(coords[i])
+                    ring.append(coords[i + 1])
+                rings.append(ring)
+
+            # skip empty polygons, and empty holes
+            if rings and rings[0]:
+                polygons.append([rings[0]] + [ring for ring in rings[1:] if ring])
+
+        else:
+            raise ValueError('Unsupported WKB geometry type: %d' % geom_type)
+
+        return offset
+
+    parse(0)
+    return polygons
+
+
+class WardLocator(object):
+    """ Finds the ward that contains a point. """
+
+    def __init__(self, polygons):
+        # map from grid cell to the polygons that overlap it
+        self.grid = {}
+        self.count = len(polygons)
+
+        for polygon in polygons:
+            for cell_x in xrange(self.cell(polygon.min_x), self.cell(polygon.max_x) + 1):
+                for cell_y in xrange(self.cell(polygon.min_y), self.cell(polygon.max_y) + 1):
+                    self.grid.setdefault((cell_x, cell_y), []).append(polygon)
+
+    def cell(self, coord):
+        return int(coord // CELL_SIZE)
+
+    def locate(self, longitude, latitude):
+        """ The code of the ward containing this point, or None. """
+        for polygon in self.grid.get((self.cell(longitude), self.cell(latitude)), ()):
+            if polygon.contains(longitude, latitude):
+                return polygon.code
+
+        return None
+
+
+def load_ward_locator(store):
+    polygons = []
+    for geoid in store.geoids('ward-'):
+        code = geoid.split('-', 1)[1]
+        for rings in parse_wkb_polygons(store.get(geoid)):
+            polygons.append(Polygon(code, rings))
+
+    return WardLocator(polygons)
+
+
+_locator = None
+# the modification time of the geometry store the locator was loaded from
+_locator_mtime = None
+_locator_lock = threading.Lock()
+
+
+def get_ward_locator():
+    """ The ward locator for this process, or None if there are no ward
+    boundaries. It's loaded on first use, and again whenever the ward
+    boundaries are rebuilt.
+    """
+    global _locator, _locator_mtime
+
+    store = get_ward_boundaries()
+    store.open()
+
+    if _locator is None or store.mtime != _locator_mtime:
+        with _locator_lock:
+            mtime = store.mtime
+            if _locator is None or mtime != _locator_mtime:
+                _locator = load_ward_locator(store)
+                _locator_mtime = mtime
+                if not _locator.count:
+                    log.warn("No ward boundaries, locating wards with the wards API")
+
+    return _locator if _locator.count else None
@@ -0,0 +1,87 @@
+import struct
+import time
+import zlib
+
+
+'''
+A zip file writer that produces its output as a stream of chunks.
+
+Python's zipfile module needs a seekable file to go back and fill in each
+member's size and checksum, so a zip has to be written to disk (or memory)
+before any of it can be sent. Here each member is instead followed by a data
+descriptor holding its size and checksum, which lets the zip be generated
+and sent piece by piece while only ever holding one chunk in memory.
+
+    chunks = stream_zip([('data/data.csv', csv_chunks)])
+
+Zip64 isn't supported, so members and the whole archive must stay under 4GB.
+'''
+
+# general purpose flags: sizes and crc are in a data descriptor after the
+# data (bit 3), and names are utf-8 (bit 11)
+FLAGS = 0x08 | 0x800
+
+VERSION = 20
+
+
+def dos_datetime(t):
+    t = time.localtime(t)
+    dos_date = (t.tm_year - 1980) << 9 | t.tm_mon << 5 | t.tm_mday
+    dos_time = t.tm_hour << 11 | t.tm_min << 5 | t.tm_sec // 2
+    return dos_date, dos_time
+
+
+def stream_zip(members, compress=True):
+    """
+    Generate the chunks of a zip file containing +members+, a list of
+    (name, chunks) tuples where chunks is an iterable of byte strings
+    making up the member's contents.
+    """
+    method = 8 if compress else 0
+    dos_date, dos_time = dos_datetime(time.time())
+    offset = 0
+    directory = []
+
+    for name, chunks in members:
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+
+        header = struct.pack('<4s5H3L2H', 'PK\x03\x04', VERSION, FLAGS, method,
+                             dos_time, dos_date, 0, 0, 0, len(name), 0) + name
+        yield header
+
+        crc = 0
+        size = 0
+        compressed_size = 0
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15) if compress else None
+
+        for chunk in chunks:
+            if not chunk:
+                continue
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            if compressor:
+                chunk = compressor.compress(chunk)
+            if chunk:
+                compressed_size += len(chunk)
+                yield chunk
+
+        if compressor:
+            chunk = compressor.flush()
+            compressed_size += len(chunk)
+            yield chunk
+
+        crc &= 0xffffffff
+        yield struct.pack('<4s3L', 'PK\x07\x08', crc, compressed_size, size)
+
+        directory.append(struct.pack('<4s6H3L5H2L', 'PK\x01\x02', VERSION, VERSION, FLAGS, method,
+                                     dos_time, dos_date, crc, compressed_size, size,
+                                     len(name), 0, 0, 0, 0, 0, offset) + name)
+        offset += len(header) + compressed_size + 16
+
+    directory_size = sum(len(d) for d in directory)
+    for entry in directory:
+        yield entry
+
+    yield struct.pack('<4s4H2LH', 'PK\x05\x06', 0, 0, len(directory), len(directory),
+                      directory_size, offset, 0)
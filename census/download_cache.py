@@ -0,0 +1,208 @@
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+
+from django.conf import settings
+
+from api.utils import get_data_version
+
+import logging
+logger = logging.getLogger('censusreporter')
+
+
+'''
+A disk cache of finished download bundles.
+
+Building a download means querying every table for every geography and, for
+most formats, running it all through GDAL, and the same downloads are asked
+for again and again. Finished bundles are kept on disk, keyed by a hash of the
+normalized request and the data version, so a new data version never serves
+stale bundles.
+
+Bundles are written to a temporary file and renamed into place, so a reader
+never sees a partial bundle. When many requests ask for the same bundle at
+once, one of them builds it while the others wait for it: within a process
+with a lock, and across processes with an flock on a lock file. There's a
+fixed set of lock files, chosen by the key's hash, and they're never removed,
+since a process may be waiting on one. Once the cache holds more than its
+byte budget, the least recently used bundles are removed.
+'''
+
+CHUNK_SIZE = 64 * 1024
+
+# how often to check whether another process has finished a bundle
+LOCK_POLL_SECS = 0.1
+
+# the number of lock files that keys are spread over
+LOCK_FILES = 64
+
+
+def download_key(table_ids, geo_ids, fmt):
+    """ The cache key for a download of +table_ids+ for +geo_ids+ in +fmt+.
+    The order of the tables and geographies doesn't matter. """
+    request = {
+        'data_version': get_data_version(),
+        'format': fmt.strip().lower(),
+        'tables': sorted(t.strip().upper() for t in table_ids),
+        'geos': sorted(g.strip() for g in geo_ids),
+    }
+    return hashlib.sha1(json.dumps(request, sort_keys=True)).hexdigest()
+
+
+class DownloadCache(object):
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # in-process locks for bundles being built
+        self.building = {}
+
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+
+    def path(self, key):
+        return os.path.join(self.root, '%s.zip' % key)
+
+    def lock_path(self, key):
+        return os.path.join(self.root, 'lock-%02d' % (int(hashlib.sha1(key).hexdigest()[:8], 16) % LOCK_FILES))
+
+    def get(self, key):
+        """ An iterator over the chunks of the cached bundle for +key+, or None
+        if it isn't cached.
+        """
+        path = self.path(key)
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            return None
+
+        # mark it as recently used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        return read_chunks(f)
+
+    def get_or_build(self, key, build):
+        """
+        An iterator over the chunks of the bundle for +key+. If it isn't cached,
+        +build+ is called to get an iterator over the chunks of a new bundle.
+        The chunks are passed on as they're built and saved to the cache.
+
+        Only one caller builds a bundle at a time. Other callers for the same
+        key wait for it to finish and then read it from the cache.
+        """
+        chunks = self.get(key)
+        if chunks is not None:
+            return chunks
+
+        return self.build(key, build)
+
+    def build(self, key, build):
+        # nothing is locked until the response is actually being sent, so an
+        # abandoned response can't leave the lock held
+        lock = self.acquire(key)
+        tmp_path = '%s.%s.tmp' % (self.path(key), uuid.uuid4().hex[:8])
+        try:
+            # someone else may have built it while we waited
+            chunks = self.get(key)
+            if chunks is None:
+                with open(tmp_path, 'wb') as f:
+                    for chunk in build():
+                        f.write(chunk)
+                        yield chunk
+
+                os.rename(tmp_path, self.path(key))
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            self.release(key, lock)
+
+        if chunks is None:
+            self.evict()
+        else:
+            for chunk in chunks:
+                yield chunk
+
+    def acquire(self, key):
+        with self.lock:
+            key_lock = self.building.setdefault(key, [threading.Lock(), 0])
+            key_lock[1] += 1
+        key_lock[0].acquire()
+
+        # now lock out other processes
+        lock_file = open(self.lock_path(key), 'a')
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return lock_file
+            except IOError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    lock_file.close()
+                    key_lock[0].release()
+                    raise
+            # don't block the whole process (and all its greenlets) in flock
+            time.sleep(LOCK_POLL_SECS)
+
+    def release(self, key, lock_file):
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        lock_file.close()
+
+        with self.lock:
+            key_lock = self.building[key]
+            key_lock[1] -= 1
+            if key_lock[1] == 0:
+                del self.building[key]
+        key_lock[0].release()
+
+    def evict(self):
+        """ Remove the least recently used bundles until we're within budget. """
+        bundles = []
+        total = 0
+
+        for name in os.listdir(self.root):
+            if name.endswith('.zip'):
+                try:
+                    stat = os.stat(os.path.join(self.root, name))
+                except OSError:
+                    continue
+                bundles.append((stat.st_mtime, stat.st_size, name))
+                total += stat.st_size
+
+        bundles.sort()
+        while total > self.max_bytes and bundles:
+            _, size, name = bundles.pop(0)
+            key = name[:-len('.zip')]
+            try:
+                os.remove(os.path.join(self.root, name))
+            except OSError:
+                pass
+            total -= size
+            logger.info("Evicted download %s from cache" % key)
+
+
+def read_chunks(f):
+    try:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        f.close()
+
+
+_cache = None
+
+
+def get_download_cache():
+    global _cache
+    if _cache is None:
+        _cache = DownloadCache(settings.DOWNLOAD_CACHE_ROOT, settings.DOWNLOAD_CACHE_MAX_BYTES)
+    return _cache
@@ -0,0 +1,325 @@
+import errno
+import json
+import os
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.management import call_command, get_commands, load_command_class
+
+import logging
+logger = logging.getLogger('censusreporter')
+
+
+'''
+A simple file-backed queue of background jobs.
+
+Some work, like building a ward-level KML download or precomputing every
+profile, takes far longer than a web worker may spend on a request. Instead,
+it's put on this queue and picked up by a separate worker process, started
+with `./manage.py run_jobs`.
+
+The queue is a directory with a subdirectory for each state a job can be in:
+
+    pending/   waiting for a worker
+    running/   claimed by a worker
+    done/      finished successfully
+    failed/    finished with an error
+
+Each job is a JSON file named after its id, and moves between the
+directories with atomic renames, so many workers (on the same machine) can
+share a queue without any other locking: only one of them can rename a
+pending job into running/.
+
+A job's type determines the function that runs it, registered with the
++job_type+ decorator. The function is called with the job's arguments and a
++progress+ function it can call with a dict describing its progress, and
+returns a JSON-serializable result that's stored with the job.
+'''
+
+STATES = ['pending', 'running', 'done', 'failed']
+
+# how often a worker marks its running job as still alive
+HEARTBEAT_SECS = 30
+
+# running jobs that haven't had a heartbeat for this long are assumed to have
+# lost their worker and are put back on the queue
+STALE_SECS = 5 * HEARTBEAT_SECS
+
+# how long finished jobs are kept for
+RETENTION_SECS = 24 * 60 * 60
+
+
+# map from job type to the function that runs it
+JOB_TYPES = {}
+
+
+def job_type(name):
+    """ Register a function that runs jobs of type +name+. """
+    def register(func):
+        JOB_TYPES[name] = func
+        return func
+    return register
+
+
+class JobQueue(object):
+    def __init__(self, root):
+        self.root = root
+
+        for state in STATES:
+            path = os.path.join(self.root, state)
+            if not os.path.exists(path):
+                os.makedirs(path)
+
+    def path(self, state, job_id):
+        return os.path.join(self.root, state, '%s.json' % job_id)
+
+    def enqueue(self, type, args, job_id=None):
+        """
+        Add a job to the queue and return it.
+
+        If +job_id+ is given and a job with that id is already pending or
+        running, that job is returned instead, so that identical work is only
+        done once. Finished jobs with that id are replaced.
+        """
+        if job_id is None:
+            job_id = uuid.uuid4().hex
+        else:
+            existing = self.get(job_id)
+            if existing and existing['status'] in ('pending', 'running'):
+                return existing
+
+        now = time.time()
+        job = {
+            'id': job_id,
+            'type': type,
+            'args': args,
+            'status': 'pending',
+            'progress': None,
+            'result': None,
+            'error': None,
+            'created': now,
+            'started': None,
+            'heartbeat': None,
+            'finished': None,
+        }
+        self.write('pending', job)
+
+        for state in ('done', 'failed'):
+            self.remove(state, job_id)
+
+        return job
+
+    def get(self, job_id):
+        """ Get the job with id +job_id+, or None. """
+        # jobs only move forward through the states (unless they're
+        # requeued), so checking them in order never misses a job that
+        # moves while we're looking
+        for state in STATES:
+            job = self.read(state, job_id)
+            if job is not None:
+                # requeued jobs still say they're running
+                job['status'] = state
+                return job
+
+        return None
+
+    def claim(self):
+        """ Claim the oldest pending job for this worker, and return it,
+        or None if there are no pending jobs.
+        """
+        for job_id in self.job_ids('pending'):
+            try:
+                os.rename(self.path('pending', job_id), self.path('running', job_id))
+            except OSError as e:
+                if e.errno == errno.ENOENT:
+                    # another worker got it first
+                    continue
+                raise
+
+            # the rename keeps the pending file's mtime, which would make
+            # the job look stale until it's marked as started
+            try:
+                os.utime(self.path('running', job_id), None)
+            except OSError:
+                continue
+
+            job = self.read('running', job_id)
+            if job is None:
+                continue
+
+            job['status'] = 'running'
+            job['started'] = time.time()
+            job['heartbeat'] = None
+            self.write('running', job)
+            return job
+
+        return None
+
+    def update(self, job, progress):
+        job['progress'] = progress
+        self.write('running', job)
+
+    def finish(self, job, result):
+        job['status'] = 'done'
+        job['result'] = result
+        job['finished'] = time.time()
+        self.write('done', job)
+        self.remove('running', job['id'])
+
+    def fail(self, job, error):
+        job['status'] = 'failed'
+        job['error'] = error
+        job['finished'] = time.time()
+        self.write('failed', job)
+        self.remove('running', job['id'])
+
+    def heartbeat(self, job):
+        job['heartbeat'] = time.time()
+        self.write('running', job)
+
+    def requeue_stale(self, max_age=STALE_SECS):
+        """ Put running jobs whose worker seems to have died back on the
+        queue. A job is alive as long as it's had a heartbeat, or was started,
+        within +max_age+ seconds.
+        """
+        now = time.time()
+        for job_id, mtime in self.job_ids('running', mtimes=True):
+            job = self.read('running', job_id)
+            if job is None:
+                continue
+
+            # a job that's only just been claimed hasn't been marked as
+            # started yet, but its file was touched when it was claimed
+            alive = job.get('heartbeat') or job.get('started') or mtime
+            if now - alive > max_age:
+                job['status'] = 'pending'
+                job['started'] = job['heartbeat'] = None
+                self.write('pending', job)
+                self.remove('running', job_id)
+                logger.warn("Requeued stale job %s" % job_id)
+
+    def prune(self, max_age=RETENTION_SECS):
+        """ Remove finished jobs older than +max_age+ seconds. """
+        now = time.time()
+        for state in ('done', 'failed'):
+            for job_id, mtime in self.job_ids(state, mtimes=True):
+                if now - mtime > max_age:
+                    self.remove(state, job_id)
+
+    def job_ids(self, state, mtimes=False):
+        """ The ids of the jobs in +state+, oldest first. """
+        jobs = []
+        for name in os.listdir(os.path.join(self.root, state)):
+            if name.endswith('.json'):
+                job_id = name[:-len('.json')]
+                try:
+                    jobs.append((os.stat(self.path(state, job_id)).st_mtime, job_id))
+                except OSError:
+                    continue
+
+        jobs.sort()
+        if mtimes:
+            return [(job_id, mtime) for mtime, job_id in jobs]
+        return [job_id for mtime, job_id in jobs]
+
+    def read(self, state, job_id):
+        try:
+            with open(self.path(state, job_id)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def write(self, state, job):
+        path = self.path(state, job['id'])
+        tmp_path = '%s.%s.tmp' % (path, uuid.uuid4().hex[:8])
+        with open(tmp_path, 'w') as f:
+            json.dump(job, f)
+        os.rename(tmp_path, path)
+
+    def remove(self, state, job_id):
+        try:
+            os.remove(self.path(state, job_id))
+        except OSError:
+            pass
+
+
+def run_job(queue, job):
+    """ Run a job that's been claimed from +queue+, and record its result. """
+    runner = JOB_TYPES.get(job['type'])
+    if runner is None:
+        queue.fail(job, 'Unknown job type: %s' % job['type'])
+        return
+
+    # keep the job alive while it runs. The job's record is only written by
+    # one thread at a time, and never after it's finished.
+    done = threading.Event()
+    lock = threading.Lock()
+
+    def heartbeat():
+        while not done.wait(HEARTBEAT_SECS):
+            with lock:
+                if not done.is_set():
+                    queue.heartbeat(job)
+
+    def progress(progress):
+        with lock:
+            queue.update(job, progress)
+
+    thread = threading.Thread(target=heartbeat)
+    thread.daemon = True
+    thread.start()
+
+    logger.info("Running job %s (%s)" % (job['id'], job['type']))
+    try:
+        result = runner(job['args'], progress)
+    except Exception as e:
+        logger.exception("Job %s failed" % job['id'])
+        with lock:
+            done.set()
+        queue.fail(job, str(e))
+    else:
+        with lock:
+            done.set()
+        queue.finish(job, result)
+    finally:
+        done.set()
+
+
+# management commands that can be run as jobs
+JOB_COMMANDS = ['build_profile_store', 'build_geometry_store', 'cache_to_s3']
+
+
+def parse_command_args(name, args):
+    """ Parse +args+ for the management command +name+ as they would be
+    on the command line, and return (args, options).
+    """
+    if name not in JOB_COMMANDS:
+        raise ValueError('Command %s cannot be run as a job' % name)
+
+    command = load_command_class(get_commands()[name], name)
+    try:
+        options, args = command.create_parser('manage.py', name).parse_args(args)
+    except SystemExit:
+        # optparse has already described the problem
+        raise ValueError('Invalid arguments for command %s' % name)
+
+    return args, vars(options)
+
+
+@job_type('command')
+def run_command(args, progress):
+    """ Run one of the `JOB_COMMANDS` management commands. """
+    command_args, options = parse_command_args(args['name'], args.get('args', []))
+    call_command(args['name'], *command_args, **options)
+
+
+_queue = None
+
+
+def get_job_queue():
+    global _queue
+    if _queue is None:
+        _queue = JobQueue(settings.JOB_QUEUE_ROOT)
+    return _queue
@@ -0,0 +1,107 @@
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+
+import json
+import sys
+
+from osgeo import ogr
+
+from api.config import GEOMETRY_STORE_PATH, WARD_BOUNDARIES_PATH
+from api.download import MAPIT_LEVEL_TYPES, MAPIT_LEVEL_SIMPLIFY
+from api.geometry_store import GeometryStoreWriter
+
+
+class Command(BaseCommand):
+    args = '<level:boundary-file> [<level:boundary-file> ...]'
+    help = ('Builds the geometry store used for downloads from local boundary files, '
+            'eg. ward:wards.geojson province:provinces.shp. Geometries are simplified '
+            'with the same tolerances as MapIt, unless --unsimplified is given.')
+    option_list = BaseCommand.option_list + (
+        make_option('--code-field',
+                    dest='code_field',
+                    default='code',
+                    help='Feature attribute holding the geo code (default: code). '
+                         'MapIt-style "codes" attributes are also understood.'),
+        make_option('--output',
+                    dest='output',
+                    default=GEOMETRY_STORE_PATH,
+                    help='Store file to write (default: %s)' % GEOMETRY_STORE_PATH),
+        make_option('--unsimplified',
+                    action='store_true',
+                    dest='unsimplified',
+                    default=False,
+                    help="Don't simplify the geometries, eg. for the ward boundaries used "
+                         "to locate points (%s)" % WARD_BOUNDARIES_PATH),
+    )
+
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError('Give at least one level:boundary-file')
+
+        sources = []
+        for arg in args:
+            if ':' not in arg:
+                raise CommandError('Expected level:boundary-file, got %s' % arg)
+            level, path = arg.split(':', 1)
+            if level not in MAPIT_LEVEL_TYPES:
+                raise CommandError('Invalid level: %s' % level)
+            sources.append((level, path))
+
+        ogr.UseExceptions()
+        writer = GeometryStoreWriter(options['output'])
+        count = 0
+
+        try:
+            for level, path in sources:
+                count += self.add_geometries(writer, level, path, options['code_field'],
+                                             simplify=not options['unsimplified'])
+        except:
+            writer.abort()
+            raise
+
+        writer.commit()
+        sys.stderr.write('Wrote %d geometries to %s\n' % (count, options['output']))
+
+    def add_geometries(self, writer, level, path, code_field, simplify=True):
+        if not simplify:
+            tolerance = None
+        elif level == 'country':
+            # MapIt doesn't simplify the country
+            tolerance = None
+        else:
+            tolerance = MAPIT_LEVEL_SIMPLIFY[MAPIT_LEVEL_TYPES[level]]
+
+        source = ogr.Open(path)
+        if source is None:
+            raise CommandError("Couldn't open %s" % path)
+
+        count = 0
+        for layer in source:
+            for feat in layer:
+                code = self.get_code(feat, code_field)
+                geom = feat.GetGeometryRef()
+                if not code or geom is None:
+                    continue
+
+                if tolerance:
+                    geom = geom.SimplifyPreserveTopology(tolerance)
+                geom = ogr.ForceToMultiPolygon(geom)
+
+                writer.add('%s-%s' % (level, code), geom.ExportToWkb())
+                count += 1
+
+        sys.stderr.write('%s: %d geometries from %s\n' % (level, count, path))
+        return count
+
+    def get_code(self, feat, code_field):
+        if feat.GetFieldIndex(code_field) >= 0:
+            return feat.GetField(code_field)
+
+        if feat.GetFieldIndex('codes') >= 0:
+            # MapIt GeoJSON
+            codes = feat.GetField('codes')
+            if isinstance(codes, basestring):
+                codes = json.loads(codes)
+            return codes.get('MDB')
+
+        return None
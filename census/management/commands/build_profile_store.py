@@ -0,0 +1,109 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import simplejson
+from multiprocessing import Pool
+from optparse import make_option
+
+import sys
+
+from api.controller import get_geography
+from api.models import get_geo_model
+from api.utils import get_session, get_data_version, _engine
+from ...profile_store import ProfileStoreWriter
+from ...utils import LazyEncoder
+from ...wazi import get_profile_data
+
+import logging
+logging.basicConfig(level=logging.WARN)
+logger = logging.getLogger(__name__)
+
+
+LEVELS = ['country', 'province', 'municipality', 'ward']
+
+
+def init_worker():
+    # don't share database connections with the parent process
+    _engine.dispose()
+
+
+def build_profile(geoid):
+    try:
+        geo_level, geo_code = geoid.split('-', 1)
+        geo = get_geography(geo_code, geo_level)
+        profile_data = get_profile_data(geo)
+        return geoid, simplejson.dumps(profile_data, cls=LazyEncoder), None
+    except Exception as e:
+        logger.exception(e)
+        return geoid, None, str(e)
+
+
+def get_geoids(levels):
+    session = get_session()
+    try:
+        geoids = []
+        for level in levels:
+            model = get_geo_model(level)
+            geoids.extend('%s-%s' % (level, code) for code, in session.query(model.code).order_by(model.code))
+        return geoids
+    finally:
+        session.close()
+
+
+class Command(BaseCommand):
+    help = 'Precomputes profile JSON for every geography and writes it into the profile store.'
+    option_list = BaseCommand.option_list + (
+        make_option('--processes',
+                    type='int',
+                    dest='processes',
+                    default=4,
+                    help='Number of profiles to build in parallel (default: 4)'),
+        make_option('--levels',
+                    dest='levels',
+                    default=','.join(LEVELS),
+                    help='Comma-separated geo levels to build (default: %s)' % ','.join(LEVELS)),
+        make_option('--root',
+                    dest='root',
+                    default=None,
+                    help='Store directory (default: settings.PROFILE_STORE_ROOT)'),
+    )
+
+    def handle(self, *args, **options):
+        levels = options['levels'].split(',')
+        for level in levels:
+            if level not in LEVELS:
+                raise CommandError('Invalid level: %s' % level)
+
+        root = options['root'] or settings.PROFILE_STORE_ROOT
+        geoids = get_geoids(levels)
+        total = len(geoids)
+
+        # release connections before forking
+        _engine.dispose()
+        pool = Pool(options['processes'], initializer=init_worker)
+
+        # when only some levels are rebuilt, the profiles for the others are kept
+        writer = ProfileStoreWriter(root, get_data_version(),
+                                    levels=None if set(levels) == set(LEVELS) else levels)
+        failed = []
+        try:
+            for i, (geoid, profile_json, error) in enumerate(pool.imap_unordered(build_profile, geoids)):
+                if profile_json is None:
+                    failed.append((geoid, error))
+                else:
+                    writer.add(geoid, profile_json)
+
+                sys.stderr.write('\r%d / %d' % (i + 1, total))
+                sys.stderr.flush()
+
+            pool.close()
+            pool.join()
+        except:
+            pool.terminate()
+            writer.abort()
+            raise
+
+        writer.commit()
+        sys.stderr.write('\nWrote %d profiles to %s\n' % (total - len(failed), root))
+
+        for geoid, error in failed:
+            sys.stderr.write('Failed to build %s: %s\n' % (geoid, error))
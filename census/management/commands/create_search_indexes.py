@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from api.search_db import create_search_indexes, SEARCH_INDEXES
+from api.utils import get_session
+
+
+class Command(BaseCommand):
+    help = 'Creates the pg_trgm indexes used by the postgres place search backend.'
+
+    def handle(self, *args, **options):
+        session = get_session()
+        try:
+            create_search_indexes(session)
+        finally:
+            session.close()
+
+        self.stdout.write('Created %d search indexes' % len(SEARCH_INDEXES))
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ...jobs import get_job_queue, parse_command_args, JOB_COMMANDS
+
+
+class Command(BaseCommand):
+    args = '<command> [args ...]'
+    help = ('Queues a management command to be run by the background job workers. '
+            'Commands that can be queued: %s' % ', '.join(JOB_COMMANDS))
+
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError('Which command should be queued?')
+
+        try:
+            # check the arguments now, rather than when the job runs
+            parse_command_args(args[0], list(args[1:]))
+        except ValueError as e:
+            raise CommandError(e.message)
+
+        job = get_job_queue().enqueue('command', {'name': args[0], 'args': list(args[1:])})
+        self.stdout.write('Queued job %s' % job['id'])
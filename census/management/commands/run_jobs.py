@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand
+from optparse import make_option
+
+import time
+
+from ...jobs import get_job_queue, run_job
+# register the job types defined by the views
+from ... import wazi  # noqa
+
+import logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Runs jobs from the background job queue, waiting for new jobs until stopped.'
+    option_list = BaseCommand.option_list + (
+        make_option('--poll',
+                    type='float',
+                    dest='poll',
+                    default=1.0,
+                    help='Seconds to wait between checks for new jobs (default: 1)'),
+        make_option('--once',
+                    action='store_true',
+                    dest='once',
+                    default=False,
+                    help='Exit once there are no pending jobs'),
+    )
+
+    def handle(self, *args, **options):
+        queue = get_job_queue()
+
+        while True:
+            queue.requeue_stale()
+            queue.prune()
+
+            job = queue.claim()
+            if job is not None:
+                run_job(queue, job)
+                continue
+
+            if options['once']:
+                break
+            time.sleep(options['poll'])
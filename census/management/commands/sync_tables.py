@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from optparse import make_option
+
+from api.models.tables import sync_table_manifest, TABLE_MANIFEST_FILE
+
+
+class Command(BaseCommand):
+    help = 'Creates missing data tables and writes the table manifest the site loads its data tables from.'
+    option_list = BaseCommand.option_list + (
+        make_option('--output',
+                    dest='output',
+                    default=TABLE_MANIFEST_FILE,
+                    help='Manifest file to write (default: %s)' % TABLE_MANIFEST_FILE),
+    )
+
+    def handle(self, *args, **options):
+        manifest = sync_table_manifest(options['output'])
+        self.stdout.write('Wrote %d field tables and %d simple tables to %s' % (
+            len(manifest['field_tables']), len(manifest['simple_tables']), options['output']))
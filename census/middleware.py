@@ -0,0 +1,15 @@
+from api.utils import open_request_session, close_request_session
+
+
+class RequestSessionMiddleware(object):
+    """
+    Share a single database session, and so a single pooled connection, between
+    everything that runs on the request's greenlet, and release it once the
+    response is ready.
+    """
+    def process_request(self, request):
+        open_request_session()
+
+    def process_response(self, request, response):
+        close_request_session()
+        return response
@@ -0,0 +1,233 @@
+import json
+import os
+import threading
+import time
+import uuid
+import zlib
+
+from django.conf import settings
+
+from api.utils import get_data_version
+
+import logging
+logger = logging.getLogger('censusreporter')
+
+
+'''
+A compact, read-only on-disk store of precomputed profile JSON.
+
+Profiles are expensive to build, so the `build_profile_store` command computes
+them ahead of time and writes them here. The views serve profiles from the store
+and only build them from the database when the store doesn't have them.
+
+The store is a directory containing a `manifest.json` file and a number of shard
+files. Each shard is a concatenation of independently gzipped JSON documents,
+so a single profile can be read with one seek and one read. The manifest maps
+each `full_geoid` to its (shard, offset, length) and records the data version
+the store was built from; a store built from a different data version is
+ignored.
+
+New builds write new shards next to the old ones and then atomically replace the
+manifest, so readers are never left with a half-written store. A build of only
+some levels keeps the profiles, and shards, of the other levels from the
+previous build, as long as it was for the same data version.
+'''
+
+MANIFEST = 'manifest.json'
+FORMAT_VERSION = 1
+
+# number of profiles per shard file
+SHARD_SIZE = 500
+
+
+def gzip_compress(data):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def gzip_decompress(data):
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+
+class ProfileStore(object):
+    """ Reads profiles from a store directory. """
+
+    def __init__(self, root):
+        self.root = root
+        self.lock = threading.Lock()
+        self.manifest = None
+        self.manifest_mtime = None
+
+    def get(self, geoid):
+        """ Get the profile JSON string for +geoid+, or None if the store
+        doesn't have an up to date version of it.
+        """
+        for attempt in (1, 2):
+            manifest = self.load_manifest(reload=attempt > 1)
+            if manifest is None:
+                return None
+
+            entry = manifest['index'].get(geoid)
+            if entry is None:
+                return None
+
+            shard, offset, length = entry
+            try:
+                with open(os.path.join(self.root, manifest['shards'][shard]), 'rb') as f:
+                    f.seek(offset)
+                    return gzip_decompress(f.read(length))
+            except (IOError, zlib.error) as e:
+                # the store was probably rebuilt underneath us, try again
+                # with the new manifest
+                logger.warn("Couldn't read %s from profile store: %s" % (geoid, e))
+
+        return None
+
+    def load_manifest(self, reload=False):
+        path = os.path.join(self.root, MANIFEST)
+
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return None
+
+        with self.lock:
+            if reload or self.manifest is None or mtime != self.manifest_mtime:
+                try:
+                    with open(path) as f:
+                        manifest = json.load(f)
+                except (IOError, ValueError) as e:
+                    logger.warn("Couldn't load profile store manifest %s: %s" % (path, e))
+                    return None
+
+                if manifest.get('format') != FORMAT_VERSION:
+                    logger.warn("Ignoring profile store with unknown format %s" % manifest.get('format'))
+                    manifest = None
+                elif manifest.get('data_version') != get_data_version():
+                    logger.info("Ignoring profile store for stale data version %s" % manifest.get('data_version'))
+                    manifest = None
+
+                self.manifest = manifest
+                self.manifest_mtime = mtime
+
+            return self.manifest
+
+
+class ProfileStoreWriter(object):
+    """ Writes a new version of a profile store.
+
+    Profiles are added with +add+ and only become visible to readers
+    once +commit+ is called. If +levels+ is given, only the profiles at
+    those levels are being rebuilt, and the others are kept from the
+    current store.
+    """
+
+    def __init__(self, root, data_version, shard_size=SHARD_SIZE, levels=None):
+        self.root = root
+        self.data_version = data_version
+        self.shard_size = shard_size
+        self.levels = set(levels) if levels is not None else None
+        self.build_id = uuid.uuid4().hex[:8]
+
+        self.shards = []
+        self.index = {}
+        self.shard_file = None
+        self.shard_count = 0
+
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+
+    def add(self, geoid, profile_json):
+        if self.shard_file is None or self.shard_count >= self.shard_size:
+            self.start_shard()
+
+        if isinstance(profile_json, unicode):
+            profile_json = profile_json.encode('utf-8')
+
+        data = gzip_compress(profile_json)
+        offset = self.shard_file.tell()
+        self.shard_file.write(data)
+
+        self.index[geoid] = [len(self.shards) - 1, offset, len(data)]
+        self.shard_count += 1
+
+    def start_shard(self):
+        self.close_shard()
+        name = 'profiles-%s-%03d.gz' % (self.build_id, len(self.shards))
+        self.shards.append(name)
+        self.shard_file = open(os.path.join(self.root, name), 'wb')
+        self.shard_count = 0
+
+    def close_shard(self):
+        if self.shard_file is not None:
+            self.shard_file.close()
+            self.shard_file = None
+
+    def commit(self):
+        """ Write the manifest, making this build visible, and remove
+        shards from previous builds.
+        """
+        self.close_shard()
+
+        if self.levels is not None:
+            self.merge_previous()
+
+        manifest = {
+            'format': FORMAT_VERSION,
+            'data_version': self.data_version,
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'shards': self.shards,
+            'index': self.index,
+        }
+
+        tmp_path = os.path.join(self.root, '%s.%s' % (MANIFEST, self.build_id))
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.rename(tmp_path, os.path.join(self.root, MANIFEST))
+
+        self.remove_old_shards()
+
+    def merge_previous(self):
+        """ Add the entries of the current store for the levels we're not
+        rebuilding, and keep the shards they're in. """
+        try:
+            with open(os.path.join(self.root, MANIFEST)) as f:
+                previous = json.load(f)
+        except (IOError, ValueError):
+            return
+
+        if previous.get('format') != FORMAT_VERSION or previous.get('data_version') != self.data_version:
+            return
+
+        shard_ids = dict((name, i) for i, name in enumerate(self.shards))
+        for geoid, (shard, offset, length) in previous['index'].iteritems():
+            if geoid.split('-', 1)[0] in self.levels or geoid in self.index:
+                continue
+
+            name = previous['shards'][shard]
+            if name not in shard_ids:
+                shard_ids[name] = len(self.shards)
+                self.shards.append(name)
+            self.index[geoid] = [shard_ids[name], offset, length]
+
+    def abort(self):
+        self.close_shard()
+        for name in self.shards:
+            os.remove(os.path.join(self.root, name))
+        self.shards = []
+
+    def remove_old_shards(self):
+        keep = set(self.shards)
+        for name in os.listdir(self.root):
+            if name.startswith('profiles-') and name not in keep:
+                os.remove(os.path.join(self.root, name))
+
+
+_store = None
+
+
+def get_profile_store():
+    global _store
+    if _store is None:
+        _store = ProfileStore(settings.PROFILE_STORE_ROOT)
+    return _store
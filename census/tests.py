@@ -1,5 +1,17 @@
+import os
+
+from django.http import HttpResponse, HttpResponseNotFound, Http404
 from django.test import TestCase
+from django.test.utils import override_settings
+from django.test.client import RequestFactory
+
+from api.tests.base import TempDirTestCase, DataVersionTestCase
+from api.utils import get_data_version
+from .utils import data_version_condition, internal_only
 from .views import GeographyDetailView
+from .profile_store import ProfileStore, ProfileStoreWriter
+from .download_cache import DownloadCache, download_key
+from .jobs import JobQueue, job_type, run_job
 
 class ParseTestCase(TestCase):
     def setUp(self):
@@ -33,3 +45,173 @@ class ParseTestCase(TestCase):
         self.assertEqual(geoid,'61000US50E-O')
         self.assertEqual(slug,'essex-orleans-state-senate-district-vt')
 
+
+
+class ProfileStoreTestCase(TempDirTestCase):
+    def test_round_trip(self):
+        writer = ProfileStoreWriter(self.root, get_data_version(), shard_size=2)
+        for i in range(5):
+            writer.add('ward-%d' % i, '{"ward": %d}' % i)
+        writer.commit()
+
+        store = ProfileStore(self.root)
+        self.assertEqual(store.get('ward-3'), '{"ward": 3}')
+        self.assertIsNone(store.get('ward-9'))
+
+    def test_rebuild_replaces_old_shards(self):
+        writer = ProfileStoreWriter(self.root, get_data_version())
+        writer.add('ward-1', '{"old": true}')
+        writer.commit()
+
+        store = ProfileStore(self.root)
+        self.assertEqual(store.get('ward-1'), '{"old": true}')
+
+        writer = ProfileStoreWriter(self.root, get_data_version())
+        writer.add('ward-1', '{"new": true}')
+        writer.commit()
+
+        self.assertEqual(store.get('ward-1'), '{"new": true}')
+        self.assertEqual(len([f for f in os.listdir(self.root) if f.startswith('profiles-')]), 1)
+
+    def test_rebuild_some_levels(self):
+        writer = ProfileStoreWriter(self.root, get_data_version(), shard_size=1)
+        writer.add('ward-1', '{"old": true}')
+        writer.add('province-WC', '{"province": true}')
+        writer.add('country-ZA', '{"country": true}')
+        writer.commit()
+
+        writer = ProfileStoreWriter(self.root, get_data_version(), levels=['ward'])
+        writer.add('ward-1', '{"new": true}')
+        writer.commit()
+
+        store = ProfileStore(self.root)
+        self.assertEqual(store.get('ward-1'), '{"new": true}')
+        self.assertEqual(store.get('province-WC'), '{"province": true}')
+        self.assertEqual(store.get('country-ZA'), '{"country": true}')
+        # the old ward shard is gone, the others are kept
+        self.assertEqual(len([f for f in os.listdir(self.root) if f.startswith('profiles-')]), 3)
+
+    def test_stale_data_version_is_ignored(self):
+        writer = ProfileStoreWriter(self.root, 'some-old-version')
+        writer.add('ward-1', '{}')
+        writer.commit()
+
+        self.assertIsNone(ProfileStore(self.root).get('ward-1'))
+
+
+class DownloadCacheTestCase(TempDirTestCase):
+    def setUp(self):
+        super(DownloadCacheTestCase, self).setUp()
+        self.cache = DownloadCache(self.root, max_bytes=10)
+        self.builds = []
+
+    def build(self, content):
+        def build():
+            self.builds.append(content)
+            return [content[:2], content[2:]]
+        return build
+
+    def test_builds_once(self):
+        key = download_key(['populationgroup'], ['province-GT'], 'csv')
+        self.assertEqual(key, download_key([' POPULATIONGROUP'], ['province-GT'], 'CSV'))
+        self.assertEqual(download_key(['a', 'b'], ['province-GT', 'province-WC'], 'csv'),
+                         download_key(['B', 'A'], ['province-WC', 'province-GT'], 'csv'))
+
+        self.assertEqual(''.join(self.cache.get_or_build(key, self.build('abcd'))), 'abcd')
+        self.assertEqual(''.join(self.cache.get_or_build(key, self.build('wxyz'))), 'abcd')
+        self.assertEqual(self.builds, ['abcd'])
+
+    def test_evicts_least_recently_used(self):
+        ''.join(self.cache.get_or_build('a', self.build('aaaa')))
+        ''.join(self.cache.get_or_build('b', self.build('bbbb')))
+        os.utime(self.cache.path('a'), (1, 1))
+        ''.join(self.cache.get_or_build('c', self.build('cccc')))
+
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(''.join(self.cache.get('c')), 'cccc')
+        # lock files are shared between keys, and never removed
+        self.assertTrue(os.path.exists(self.cache.lock_path('a')))
+        self.assertTrue(len([n for n in os.listdir(self.root) if n.startswith('lock-')]) <= 3)
+
+
+@job_type('test')
+def run_test_job(args, progress):
+    progress({'done': 1})
+    if args.get('fail'):
+        raise ValueError('failed')
+    return args['value'] * 2
+
+
+class JobQueueTestCase(TempDirTestCase):
+    def setUp(self):
+        super(JobQueueTestCase, self).setUp()
+        self.queue = JobQueue(self.root)
+
+    def test_run_jobs(self):
+        job = self.queue.enqueue('test', {'value': 2}, job_id='abc')
+        self.assertEqual(self.queue.enqueue('test', {'value': 3}, job_id='abc')['args'], {'value': 2})
+        failing = self.queue.enqueue('test', {'fail': True})
+
+        run_job(self.queue, self.queue.claim())
+        run_job(self.queue, self.queue.claim())
+        self.assertIsNone(self.queue.claim())
+
+        job = self.queue.get('abc')
+        self.assertEqual(job['status'], 'done')
+        self.assertEqual(job['result'], 4)
+        self.assertEqual(job['progress'], {'done': 1})
+        self.assertEqual(self.queue.get(failing['id'])['status'], 'failed')
+
+    def test_requeue_stale(self):
+        self.queue.enqueue('test', {'value': 2}, job_id='abc')
+        # it sat in the queue for a while before being claimed
+        os.utime(self.queue.path('pending', 'abc'), (1, 1))
+        job = self.queue.claim()
+        self.queue.requeue_stale()
+        self.assertEqual(self.queue.get('abc')['status'], 'running')
+
+        job['started'] = 1
+        self.queue.write('running', job)
+        self.queue.requeue_stale()
+        self.assertEqual(self.queue.get('abc')['status'], 'pending')
+        self.assertIsNone(self.queue.get('abc')['started'])
+
+
+class DataVersionConditionTestCase(DataVersionTestCase):
+    def test_not_modified(self):
+        calls = []
+
+        def view(request):
+            calls.append(request)
+            return HttpResponse('data')
+        view = data_version_condition(view)
+
+        response = view(RequestFactory().get('/'))
+        self.assertEqual(response.status_code, 200)
+
+        etag = response['ETag']
+        response = view(RequestFactory().get('/', HTTP_IF_NONE_MATCH=etag))
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(len(calls), 1)
+
+        # a new release changes the ETag
+        with override_settings(RELEASE='next'):
+            response = view(RequestFactory().get('/', HTTP_IF_NONE_MATCH=etag))
+        self.assertEqual(response.status_code, 200)
+
+
+    def test_errors_are_not_tagged(self):
+        view = data_version_condition(lambda request: HttpResponseNotFound('missing'))
+
+        response = view(RequestFactory().get('/'))
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(response.has_header('ETag'))
+        self.assertFalse(response.has_header('Last-Modified'))
+
+
+class InternalOnlyTestCase(TestCase):
+    def test_internal_only(self):
+        view = internal_only(lambda request: HttpResponse('stats'))
+
+        self.assertEqual(view(RequestFactory().get('/', REMOTE_ADDR='127.0.0.1')).status_code, 200)
+        self.assertRaises(Http404, view, RequestFactory().get('/', REMOTE_ADDR='10.1.2.3'))
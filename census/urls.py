@@ -11,7 +11,9 @@ from .views import (HomepageView, GeographySearchView,
     HealthcheckView, DataView, TopicView, ExampleView, Elasticsearch)
 
 from .wazi import (GeographyDetailView, GeographyJsonView, WardSearchProxy, PlaceSearchJson,
-        LocateView, DataAPIView, TableAPIView, AboutView, GeographyCompareView)
+        LocateView, BatchLocateView, DataAPIView, TableAPIView, AboutView, GeographyCompareView, PoolStatsView,
+        JobStatusView, JobDownloadView)
+from .utils import data_version_condition, internal_only
 
 admin.autodiscover()
 
@@ -48,7 +50,7 @@ urlpatterns = patterns('',
     # e.g. /profiles/province-GT.json
     url(
         regex   = '^(embed_data/)?profiles/(?P<geography_id>(%s)-[\w]+)\.json$' % geo_levels,
-        view    = cache_page(STANDARD_CACHE_TIME)(GeographyJsonView.as_view()),
+        view    = data_version_condition(cache_page(STANDARD_CACHE_TIME)(GeographyJsonView.as_view())),
         kwargs  = {},
         name    = 'geography_json',
     ),
@@ -64,7 +66,7 @@ urlpatterns = patterns('',
     # Custom data api
     url(
         regex   = '^api/1.0/data/show/latest$',
-        view    = cache_page(STANDARD_CACHE_TIME)(DataAPIView.as_view()),
+        view    = data_version_condition(cache_page(STANDARD_CACHE_TIME)(DataAPIView.as_view())),
         kwargs  = {'action': 'show'},
         name    = 'api_show_data',
     ),
@@ -77,10 +79,24 @@ urlpatterns = patterns('',
         name    = 'api_download_data',
     ),
 
+    # background jobs, such as large downloads
+    url(
+        regex   = '^api/1.0/jobs/(?P<job_id>[0-9a-f]+)$',
+        view    = JobStatusView.as_view(),
+        kwargs  = {},
+        name    = 'api_job_status',
+    ),
+    url(
+        regex   = '^api/1.0/jobs/(?P<job_id>[0-9a-f]+)/download$',
+        view    = JobDownloadView.as_view(),
+        kwargs  = {},
+        name    = 'api_job_download',
+    ),
+
     # table search API
     url(
         regex   = '^api/1.0/table$',
-        view    = cache_page(STANDARD_CACHE_TIME)(TableAPIView.as_view()),
+        view    = data_version_condition(cache_page(STANDARD_CACHE_TIME)(TableAPIView.as_view())),
         kwargs  = {},
         name    = 'api_list_tables',
     ),
@@ -178,12 +194,27 @@ urlpatterns = patterns('',
         name    = 'locate',
     ),
 
+    # locate many addresses or points at once
+    url(
+        regex   = '^api/1.0/locate/batch$',
+        view    = BatchLocateView.as_view(),
+        kwargs  = {},
+        name    = 'api_locate_batch',
+    ),
+
     url(
         regex   = '^healthcheck$',
         view    = HealthcheckView.as_view(),
         kwargs  = {},
         name    = 'healthcheck',
     ),
+
+    url(
+        regex   = '^healthcheck/pool$',
+        view    = internal_only(PoolStatsView.as_view()),
+        kwargs  = {},
+        name    = 'pool_stats',
+    ),
     
     url(
         regex = '^robots.txt$',
@@ -195,7 +226,7 @@ urlpatterns = patterns('',
 
     url(
         regex   = '^place-search/json/$',
-        view    = PlaceSearchJson.as_view(),
+        view    = data_version_condition(PlaceSearchJson.as_view()),
         kwargs  = {},
         name    = 'place_search_json',
     ),
@@ -1,9 +1,17 @@
 from __future__ import division
+from calendar import timegm
 from collections import OrderedDict
 
+from functools import wraps
+
+from django.conf import settings
+from django.http import Http404, HttpResponseNotModified
 from django.utils import simplejson
 from django.utils.functional import lazy, Promise
 from django.utils.encoding import force_unicode
+from django.utils.http import http_date, parse_etags, parse_http_date_safe, quote_etag
+
+from api.utils import get_data_version, get_data_modified
 
 
 def get_object_or_none(klass, *args, **kwargs):
@@ -12,6 +20,66 @@ def get_object_or_none(klass, *args, **kwargs):
     except klass.DoesNotExist:
         return None
 
+def data_version_etag(request, *args, **kwargs):
+    return '%s-data-%s' % (settings.RELEASE, get_data_version())
+
+def data_version_modified(request, *args, **kwargs):
+    modified = get_data_modified()
+    return timegm(modified.utctimetuple()) if modified else None
+
+def data_version_condition(view):
+    '''
+    For views whose responses only change when the data or the code does.
+    Successful responses get an ETag for the release and data version, and a
+    Last-Modified for the data, and conditional requests for an unchanged
+    version get a 304 before the view does any work. Other responses, such as
+    errors, get neither, so clients don't keep using them.
+    '''
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        etag = data_version_etag(request)
+        modified = data_version_modified(request)
+
+        if request.method in ('GET', 'HEAD'):
+            if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+            if if_none_match:
+                etags = parse_etags(if_none_match)
+                not_modified = etag in etags or '*' in etags
+            else:
+                since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE'))
+                not_modified = bool(since and modified and modified <= since)
+
+            if not_modified:
+                response = HttpResponseNotModified()
+                response['ETag'] = quote_etag(etag)
+                return response
+
+        response = view(request, *args, **kwargs)
+
+        if response.status_code == 200:
+            if not response.has_header('ETag'):
+                response['ETag'] = quote_etag(etag)
+            if modified and not response.has_header('Last-Modified'):
+                response['Last-Modified'] = http_date(modified)
+
+        return response
+
+    return wrapper
+
+def internal_only(view):
+    '''
+    Only staff, and requests from `INTERNAL_IPS`, can see +view+.
+    Everyone else gets a 404.
+    '''
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        user = getattr(request, 'user', None)
+        if not (user and user.is_staff) and request.META.get('REMOTE_ADDR') not in settings.INTERNAL_IPS:
+            raise Http404
+        return view(request, *args, **kwargs)
+
+    return wrapper
+
 class LazyEncoder(simplejson.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, Promise):
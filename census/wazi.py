@@ -1,4 +1,4 @@
-import requests
+from collections import OrderedDict
 from itertools import chain
 
 import logging
@@ -6,17 +6,32 @@ logger = logging.getLogger('censusreporter')
 
 from django.utils.safestring import SafeString
 from django.utils import simplejson
-from django.http import HttpResponse, Http404, HttpResponseBadRequest
+from django.conf import settings
+from django.core.urlresolvers import reverse
+from django.http import HttpResponse, Http404, HttpResponseBadRequest, StreamingHttpResponse
+from django.utils.decorators import method_decorator
+from django.views.decorators.csrf import csrf_exempt
 from django.views.generic import View, TemplateView
 
 from .views import GeographyDetailView as BaseGeographyDetailView, LocateView as BaseLocateView, render_json_to_response
 from .utils import LazyEncoder
 from .profile import enhance_api_data
+from .profile_store import get_profile_store
+from .download_cache import get_download_cache, download_key
+from .jobs import get_job_queue, job_type
 
 from api.models.tables import get_datatable, DATA_TABLES
-from api.controller import get_census_profile, get_geography, get_locations, get_locations_from_coords, get_elections_profile
-from api.utils import LocationNotFound
-from api.download import generate_download_bundle, supported_formats
+from api.controller import (get_census_profile, get_geography, get_locations, get_locations_from_coords,
+                            get_locations_batch, get_elections_profile, split_geography, get_raw_data)
+from api.controller.utils import profile_section_cache
+from api.config import BATCH_LOCATE_MAX_ITEMS
+from api.utils import LocationNotFound, WardSearchException, pool_stats, ward_search_api
+from api.columnar import columnar_data, pack_columnar
+from api.download import (generate_download_bundle, stream_download_bundle, supported_formats, streaming_formats,
+                          get_file_ident)
+
+# how often download jobs report their progress
+DOWNLOAD_PROGRESS_BYTES = 1024 * 1024
 
 
 def render_json_error(message, status_code=400):
@@ -29,6 +44,39 @@ def render_json_error(message, status_code=400):
     return response
 
 
+def get_profile_data(geo):
+    '''
+    Build the full profile data for a geography from the database.
+    '''
+    profile_data = get_census_profile(geo.code, geo.level)
+    profile_data['elections'] = get_elections_profile(geo.code, geo.level)
+    profile_data['geography'] = geo.as_dict_deep()
+
+    return enhance_api_data(profile_data)
+
+
+def get_profile_json(geography_id):
+    '''
+    Get the profile data for a geography as a JSON string, using the
+    precomputed profile store if possible.
+
+    Returns a (profile_data, profile_data_json) tuple. profile_data is None
+    if the profile came from the store and hasn't been parsed.
+    '''
+    profile_data_json = get_profile_store().get(geography_id)
+    if profile_data_json is not None:
+        return None, profile_data_json
+
+    try:
+        geo_level, geo_code = geography_id.split('-', 1)
+        geo = get_geography(geo_code, geo_level)
+    except (ValueError, LocationNotFound):
+        raise Http404
+
+    profile_data = get_profile_data(geo)
+    return profile_data, simplejson.dumps(profile_data, cls=LazyEncoder)
+
+
 class GeographyDetailView(BaseGeographyDetailView):
     def dispatch(self, *args, **kwargs):
         self.geo_id = self.kwargs.get('geography_id', None)
@@ -36,27 +84,15 @@ class GeographyDetailView(BaseGeographyDetailView):
         return TemplateView.dispatch(self, *args, **kwargs)
 
     def get_context_data(self, *args, **kwargs):
-        geography_id = self.geo_id
         page_context = {}
 
-        try:
-            geo_level, geo_code = geography_id.split('-', 1)
-
-            geo = get_geography(geo_code, geo_level)
-        except (ValueError, LocationNotFound):
-            raise Http404
-
-        profile_data = get_census_profile(geo_code, geo_level)
-        profile_data['elections'] = get_elections_profile(geo_code, geo_level)
-        profile_data['geography'] = geo.as_dict_deep()
-
-        profile_data = enhance_api_data(profile_data)
+        profile_data, profile_data_json = get_profile_json(self.geo_id)
+        if profile_data is None:
+            profile_data = simplejson.loads(profile_data_json, object_pairs_hook=OrderedDict)
         page_context.update(profile_data)
 
-        profile_data_json = SafeString(simplejson.dumps(profile_data, cls=LazyEncoder))
-
         page_context.update({
-            'profile_data_json': profile_data_json
+            'profile_data_json': SafeString(profile_data_json)
         })
 
         # is this a head-to-head view?
@@ -72,8 +108,8 @@ class GeographyDetailView(BaseGeographyDetailView):
 class GeographyJsonView(GeographyDetailView):
     """ Return geo profile data as json. """
     def get(self, request, *args, **kwargs):
-        context = self.get_context_data(**kwargs)
-        return HttpResponse(context['profile_data_json'], mimetype='application/javascript')
+        _, profile_data_json = get_profile_json(self.geo_id)
+        return HttpResponse(profile_data_json, mimetype='application/javascript')
 
 
 class PlaceSearchJson(View):
@@ -88,29 +124,66 @@ class PlaceSearchJson(View):
         return HttpResponseBadRequest('"q" parameter is required')
 
 
+class PoolStatsView(View):
+    """ Database connection pool and cache statistics for this process. """
+    def get(self, request, *args, **kwargs):
+        stats = pool_stats()
+        stats['caches'] = {
+            'profile_sections': profile_section_cache.stats(),
+            'ward_search': ward_search_api.cache.stats(),
+        }
+        return render_json_to_response(stats)
+
+
 class WardSearchProxy(View):
+    """ Finds wards by address with the wards API, through its cache. """
 
     def get(self, request, *args, **kwargs):
         try:
-            resp = requests.get('http://wards.code4sa.org',
-                                params={'address': request.GET['address'],
-                                        'database': 'wards_2011'})
-            if resp.status_code != 200:
-                return HttpResponseBadRequest()
-            elif resp.text.strip().startswith('{'):
-                return HttpResponse(self.pad_content(request, '[]'),
-                                    mimetype='application/javascript')
-            return HttpResponse(self.pad_content(request, resp.text),
-                                mimetype='application/javascript')
-        except (KeyError, AttributeError):
+            content = ward_search_api.lookup(request.GET['address'])
+        except (KeyError, WardSearchException):
             return HttpResponseBadRequest()
 
+        if content.strip().startswith('{'):
+            # not found
+            content = '[]'
+        return HttpResponse(self.pad_content(request, content),
+                            mimetype='application/javascript')
+
     def pad_content(self, request, content):
         if 'callback' in request.GET:
             return '%s(%s);' % (request.GET['callback'], content)
         return content
 
 
+class BatchLocateView(View):
+    """
+    Finds the wards for many addresses or points at once. POST a JSON list
+    of items, each either {"address": "..."} or {"lat": ..., "lon": ...}.
+    The results are in the same order, each with the places found for the
+    item, narrowest first, or an error.
+    """
+
+    @method_decorator(csrf_exempt)
+    def dispatch(self, *args, **kwargs):
+        return super(BatchLocateView, self).dispatch(*args, **kwargs)
+
+    def post(self, request, *args, **kwargs):
+        try:
+            items = simplejson.loads(request.body)
+        except ValueError:
+            return render_json_error('Expected a JSON list of addresses or points')
+
+        if isinstance(items, dict):
+            items = items.get('items')
+        if not isinstance(items, list):
+            return render_json_error('Expected a JSON list of addresses or points')
+        if len(items) > BATCH_LOCATE_MAX_ITEMS:
+            return render_json_error('Too many items, the most is %d' % BATCH_LOCATE_MAX_ITEMS)
+
+        return render_json_to_response({'results': get_locations_batch(items)})
+
+
 class LocateView(BaseLocateView):
     def get_context_data(self, *args, **kwargs):
         page_context = {}
@@ -142,14 +215,10 @@ class DataAPIView(View):
 
     def get(self, request, *args, **kwargs):
         try:
-            self.geo_ids = request.GET.get('geo_ids', 'country-ZA').split(',')
-            self.data_geos, self.info_geos = self.get_geos(self.geo_ids)
+            self.load(request.GET.get('geo_ids', 'country-ZA').split(','),
+                      request.GET.get('table_ids', '').split(','))
         except LocationNotFound as e:
             return render_json_error(e.message, 404)
-
-        try:
-            self.table_ids = request.GET.get('table_ids', '').split(',')
-            self.tables = [get_datatable(t) for t in self.table_ids]
         except KeyError as e:
             return render_json_error('Unknown table: %s' % e.message, 404)
 
@@ -158,13 +227,20 @@ class DataAPIView(View):
         if kwargs.get('action') == 'download':
             return self.download(request)
 
+    def load(self, geo_ids, table_ids):
+        self.geo_ids = geo_ids
+        self.data_geos, self.info_geos = self.get_geos(self.geo_ids)
+
+        self.table_ids = table_ids
+        self.tables = [get_datatable(t) for t in self.table_ids]
+
     def show(self, request):
         dataset = ', '.join(sorted(list(set(t.dataset_name for t in self.tables))))
         years = ', '.join(sorted(list(set(t.year for t in self.tables))))
 
         data = self.get_data(self.data_geos, self.tables)
 
-        return render_json_to_response({
+        response = {
             'release': {
                 'name': dataset,
                 'years': years,
@@ -172,7 +248,26 @@ class DataAPIView(View):
             'tables': dict((t.id.upper(), t.as_dict()) for t in self.tables),
             'data': data,
             'geography': dict((g.full_geoid, g.as_dict()) for g in chain(self.data_geos, self.info_geos)),
-        })
+        }
+
+        fmt = request.GET.get('format', 'json')
+        if fmt == 'json':
+            return render_json_to_response(response)
+
+        if fmt not in ('columnar', 'columnar-binary'):
+            return render_json_error('Unsupported format %s. Supported formats: json, columnar, columnar-binary' % fmt)
+
+        # see api/columnar.py
+        geo_ids = [g.full_geoid for g in self.data_geos]
+        response['geo_ids'] = geo_ids
+        response['data'] = columnar_data(self.tables, geo_ids, data)
+
+        if fmt == 'columnar':
+            return HttpResponse(simplejson.dumps(response, separators=(',', ':')),
+                                mimetype='application/javascript')
+
+        return HttpResponse(pack_columnar(response, [t.id.upper() for t in self.tables]),
+                            mimetype='application/octet-stream')
 
     def download(self, request):
         fmt = request.GET.get('format', 'csv')
@@ -181,15 +276,55 @@ class DataAPIView(View):
             response.status_code = 400
             return response
 
-        data = self.get_data(self.data_geos, self.tables)
-
-        content, fname, mime_type = generate_download_bundle(self.tables, self.data_geos, self.geo_ids, data, fmt)
-
-        response = HttpResponse(content, content_type=mime_type)
+        # identical downloads are served from the cache, and only the
+        # first request for a bundle builds it
+        key = download_key([t.id for t in self.tables], self.geo_ids, fmt)
+        cache = get_download_cache()
+        chunks = cache.get(key)
+
+        if chunks is None:
+            # streamed formats start sending straight away however big they
+            # are, others are built in the background if they're too big to
+            # build while the client waits
+            too_big = (fmt not in streaming_formats and
+                       len(self.data_geos) * len(self.tables) > settings.DOWNLOAD_JOB_THRESHOLD)
+            if request.GET.get('async') or too_big:
+                return self.queue_download(key, fmt)
+
+            chunks = cache.get_or_build(key, lambda: self.build_download(fmt))
+
+        fname = get_file_ident(self.tables, self.data_geos) + '.zip'
+        response = StreamingHttpResponse(chunks, content_type='application/zip')
         response['Content-Disposition'] = 'attachment; filename="%s"' % fname
 
         return response
 
+    def queue_download(self, key, fmt):
+        job = get_job_queue().enqueue('download', {
+            'table_ids': self.table_ids,
+            'geo_ids': self.geo_ids,
+            'format': fmt,
+        }, job_id=key)
+
+        response = render_json_to_response({
+            'job_id': job['id'],
+            'status': job['status'],
+            'status_url': reverse('api_job_status', kwargs={'job_id': job['id']}),
+        })
+        response.status_code = 202
+        return response
+
+    def build_download(self, fmt):
+        """ An iterator over the chunks of a new download bundle in +fmt+. """
+        if fmt in streaming_formats:
+            # the data is fetched as the response is sent
+            chunks, fname, mime_type = stream_download_bundle(self.tables, self.data_geos, fmt)
+            return chunks
+
+        data = self.get_data(self.data_geos, self.tables)
+        content, fname, mime_type = generate_download_bundle(self.tables, self.data_geos, self.geo_ids, data, fmt)
+        return [content]
+
     def get_geos(self, geo_ids):
         """
         Return a tuple (data_geos, info_geos) of geo objects,
@@ -213,7 +348,7 @@ class DataAPIView(View):
                 geo = get_geography(code, level)
                 info_geos.append(geo)
                 try:
-                    data_geos.extend(geo.split_into(split_level))
+                    data_geos.extend(split_geography(geo, split_level))
                 except ValueError:
                     raise LocationNotFound('Invalid geo level: %s' % split_level)
 
@@ -224,13 +359,66 @@ class DataAPIView(View):
         return data_geos, info_geos
 
     def get_data(self, geos, tables):
-        data = {}
+        return get_raw_data(tables, geos)
+
+
+@job_type('download')
+def download_job(args, progress):
+    """ Build a download bundle in the background, into the download cache. """
+    view = DataAPIView()
+    view.load(args['geo_ids'], args['table_ids'])
+
+    key = download_key([t.id for t in view.tables], view.geo_ids, args['format'])
+    size = 0
+    for chunk in get_download_cache().get_or_build(key, lambda: view.build_download(args['format'])):
+        size += len(chunk)
+        if size // DOWNLOAD_PROGRESS_BYTES != (size - len(chunk)) // DOWNLOAD_PROGRESS_BYTES:
+            progress({'bytes': size})
+
+    return {
+        'key': key,
+        'filename': get_file_ident(view.tables, view.data_geos) + '.zip',
+        'bytes': size,
+    }
+
+
+class JobStatusView(View):
+    """
+    The status of a background job, such as a download.
+    """
 
-        for table in tables:
-            for geo_id, table_data in table.raw_data_for_geos(geos).iteritems():
-                data.setdefault(geo_id, {})[table.id.upper()] = table_data
+    def get(self, request, job_id, *args, **kwargs):
+        job = get_job_queue().get(job_id)
+        if job is None:
+            return render_json_error('Unknown job: %s' % job_id, 404)
 
-        return data
+        status = dict((k, job[k]) for k in ('id', 'type', 'status', 'progress', 'error',
+                                             'created', 'started', 'finished'))
+        if job['status'] == 'done' and job['type'] == 'download':
+            status['download_url'] = reverse('api_job_download', kwargs={'job_id': job_id})
+
+        return render_json_to_response(status)
+
+
+class JobDownloadView(View):
+    """
+    The download bundle built by a finished download job.
+    """
+
+    def get(self, request, job_id, *args, **kwargs):
+        job = get_job_queue().get(job_id)
+        if job is None or job['type'] != 'download':
+            return render_json_error('Unknown download job: %s' % job_id, 404)
+        if job['status'] != 'done':
+            return render_json_error('Download job %s is %s' % (job_id, job['status']), 409)
+
+        chunks = get_download_cache().get(job['result']['key'])
+        if chunks is None:
+            return render_json_error('This download has expired, please request it again', 410)
+
+        response = StreamingHttpResponse(chunks, content_type='application/zip')
+        response['Content-Disposition'] = 'attachment; filename="%s"' % job['result']['filename']
+        return response
 
 
 class TableAPIView(View):
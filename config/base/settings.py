@@ -1,5 +1,6 @@
 # Django settings for censusreporter project.
 import os
+import subprocess
 
 dirname = os.path.dirname
 PROJECT_ROOT = os.path.abspath(os.path.join(dirname(__file__),"..",".."))
@@ -30,6 +31,8 @@ INSTALLED_APPS = (
 )
 
 ALLOWED_HOSTS = []
+# addresses allowed to see internal diagnostics, such as /healthcheck/pool
+INTERNAL_IPS = ('127.0.0.1',)
 TIME_ZONE = 'Africa/Johannesburg'
 LANGUAGE_CODE = 'en-za'
 SITE_ID = 1
@@ -71,6 +74,7 @@ MIDDLEWARE_CLASSES = (
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
+    'census.middleware.RequestSessionMiddleware',
     # 'django.middleware.clickjacking.XFrameOptionsMiddleware',
 )
 
@@ -117,3 +121,32 @@ ADMINS = (
 MANAGERS = ADMINS
 
 API_URL = 'http://api.censusreporter.org'
+
+# Where precomputed profiles are stored, see census/profile_store.py
+PROFILE_STORE_ROOT = os.environ.get('PROFILE_STORE_ROOT', PROJECT_ROOT + '/profile_store/')
+
+# Where finished download bundles are cached, see census/download_cache.py
+DOWNLOAD_CACHE_ROOT = os.environ.get('DOWNLOAD_CACHE_ROOT', PROJECT_ROOT + '/download_cache/')
+# Bundles are evicted, least recently used first, once they take up more than this
+DOWNLOAD_CACHE_MAX_BYTES = int(os.environ.get('DOWNLOAD_CACHE_MAX_BYTES', 1024 * 1024 * 1024))
+
+# Where the background job queue lives, see census/jobs.py
+JOB_QUEUE_ROOT = os.environ.get('JOB_QUEUE_ROOT', PROJECT_ROOT + '/jobs/')
+# Downloads in formats that can't be streamed (all but CSV) with more than this
+# many (geography, table) pairs are built by a background job rather than
+# while the client waits
+DOWNLOAD_JOB_THRESHOLD = int(os.environ.get('DOWNLOAD_JOB_THRESHOLD', 2000))
+
+def git_revision():
+    """ The short hash of the checked out commit, or None if it can't be found. """
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                           cwd=PROJECT_ROOT, stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# Identifies the deployed code. It's part of the ETag of responses that
+# depend on the data, so a new release isn't hidden by cached responses.
+# Dokku sets GIT_REV on deploy.
+RELEASE = os.environ.get('RELEASE') or os.environ.get('GIT_REV') or git_revision() or 'dev'
@@ -0,0 +1,10 @@
+# Gunicorn settings, used with `gunicorn -c config/gunicorn.py`
+
+
+def post_fork(server, worker):
+    # With gevent workers, psycopg2 must wait for the database through gevent
+    # before the worker opens any connections, or a query blocks every
+    # greenlet in the worker. See api/executor.py.
+    if type(worker).__module__ == 'gunicorn.workers.ggevent':
+        from api.executor import make_psycopg_green
+        make_psycopg_green()